@@ -7,9 +7,10 @@ import os
 import numpy as np
 
 from becca.affect import Affect
+import becca.capacity_planner as capacity_planner
 from becca.featurizer import Featurizer
 from becca.model import Model
-from becca.preprocessor import Preprocessor
+from becca.input_filter import Preprocessor
 import becca.viz as viz
 
 
@@ -27,11 +28,20 @@ class Brain(object):
         self,
         backup_interval=int(2**20),
         brain_name='test_brain',
+        counter_dtype=None,
+        dtype=np.float64,
+        fused_step=False,
         log_directory=None,
+        memory_budget=None,
         n_actions=int(2**2),
         n_features=int(2**6),
         # n_inputs=int(2**6),
+        n_levels=1,
         n_sensors=int(2**2),
+        n_threads=1,
+        pipelined=False,
+        recycle_bundles=False,
+        sequence_backend='dense',
         timestep=0,
         visualize_interval=int(2**18),
     ):
@@ -45,9 +55,27 @@ class Brain(object):
             in timesteps.
         brain_name: str
             A descriptive string identifying the brain.
+        counter_dtype: numpy dtype
+            The floating point precision of the model's occurrence
+            counts, including the large sequence array.
+            See Model.counter_dtype. By default, np.float64.
+        dtype: numpy dtype
+            The floating point precision of the large arrays in
+            the model and the featurizer. Memory bandwidth tends to limit
+            speed more than precision limits learning, so np.float32
+            is a good choice for large numbers of features.
+        fused_step: boolean
+            Whether the model updates all its prefixes in a single
+            fused pass. See Model.fused_step.
         log_directory : str
             The full path name to a directory where information and
             backups for the world can be stored and retrieved.
+        memory_budget: int
+            The number of bytes the brain is allowed to use.
+            If the projected footprint of the fully grown brain
+            is larger than this, the brain refuses to be created.
+            Brain.plan() can pick a configuration that fits.
+            By default, there is no limit.
         # n_inputs: int
         #     An upper bound on the number of inputs to the featurizer.
         #     This includes discretized sensors as well as actions.
@@ -64,6 +92,29 @@ class Brain(object):
             If this is smaller, Becca will run faster. If it is larger
             Becca will have more capacity to learn. It's an important
             input for determining performance.
+        n_levels: int
+            The number of Zipties stacked in the featurizer.
+            Each level bundles the bundles of the level below.
+            The featurizer's bundles are shared out among them.
+            See Featurizer.n_levels.
+        n_threads: int
+            The number of threads that the model and featurizer
+            kernels can spread their work across. Values greater than 1
+            switch to the parallel variants of the kernels.
+        pipelined: boolean
+            Whether the featurizer's levels learn in worker threads,
+            alongside the rest of the time step. It learns the same
+            bundles either way. See Featurizer.pipelined.
+        recycle_bundles: boolean
+            Whether the featurizer keeps learning once it is full,
+            replacing its least useful bundles with new ones.
+            Everything the model has learned about a replaced bundle's
+            feature is forgotten. See Ziptie.recycle_bundles.
+        sequence_backend: str
+            How the model stores its sequences, 'dense' or 'sparse'.
+            Dense storage takes memory proportional to n_features**3.
+            Sparse storage grows only with the sequences that have
+            actually been observed, and makes room for many more features.
         timestep: int
             The age of the brain in discrete time steps.
         visualize_interval: int
@@ -75,6 +126,21 @@ class Brain(object):
         self.n_features = np.maximum(
             n_features, self.n_actions + 4 * self.n_sensors)
 
+        if memory_budget is not None:
+            footprint = capacity_planner.brain_footprint(
+                self.n_features,
+                dtype,
+                sequence_backend,
+                counter_dtype=counter_dtype,
+                n_levels=n_levels)
+            if sum(footprint.values()) > memory_budget:
+                capacity_planner.report(footprint)
+                raise ValueError(' '.join([
+                    'A brain with', str(self.n_features), 'features',
+                    'would need more than the memory budget of',
+                    str(memory_budget), 'bytes.',
+                    'Try Brain.plan() to find one that fits.']))
+
         self.input_activities = np.zeros(self.n_features)
         # input_pool: set of ints
         #     These are the indices of available inputs.
@@ -98,7 +164,10 @@ class Brain(object):
 
         # The preprocessor takes raw sensors and actions and converts
         # them into discrete inputs.
+        # Every input gets a cable in the featurizer, so there
+        # can't be more of them than it has room for.
         self.preprocessor = Preprocessor(
+            max_n_inputs=self.n_features,
             n_actions=self.n_actions,
             n_sensors=self.n_sensors,
         )
@@ -113,13 +182,30 @@ class Brain(object):
         # features from the inputs.
         self.featurizer = Featurizer(
             self.n_features,
+            dtype=dtype,
+            n_levels=n_levels,
+            n_threads=n_threads,
+            pipelined=pipelined,
+            recycle_bundles=recycle_bundles,
             threshold=1e3,
-            debug=True,
+            verbose=True,
         )
         # The model builds sequences of features and goals and uses
-        # them to choose new goals.
-        self.model = Model(self.n_features, self)
+        # them to choose new goals. Every input and bundle
+        # from the featurizer is a feature to the model.
+        self.model = Model(
+            self.featurizer.n_features,
+            self,
+            counter_dtype=counter_dtype,
+            dtype=dtype,
+            fused_step=fused_step,
+            n_threads=n_threads,
+            sequence_backend=sequence_backend,
+        )
         print('n features', self.n_features)
+        # live_features : array of bools
+        #     True for each feature that has ever been active.
+        self.live_features = np.zeros(self.featurizer.n_features, dtype=bool)
 
         self.timestep = timestep
         self.visualize_interval = visualize_interval
@@ -145,6 +231,43 @@ class Brain(object):
         self.pickle_filename = os.path.join(
             self.log_dir, '{0}.pickle'.format(brain_name))
 
+    @staticmethod
+    def plan(
+        memory_budget,
+        target_step_latency=None,
+        n_actions=int(2**2),
+        n_sensors=int(2**2),
+        n_threads=1,
+    ):
+        """
+        Choose the size and storage of a Brain to fit a memory budget.
+
+        The projected footprint of each component is printed.
+        See capacity_planner.plan for how the choice is made.
+
+        Parameters
+        ----------
+        memory_budget: int
+            The number of bytes the brain can use.
+        target_step_latency: float, optional
+            The longest the model should take to step, in seconds.
+        n_actions, n_sensors, n_threads: int
+            The values that will be passed to the Brain.
+            The number of actions and sensors sets the fewest
+            features the brain can have.
+
+        Returns
+        -------
+        config: dict
+            Keyword arguments for the Brain: n_features, dtype,
+            counter_dtype and sequence_backend.
+        """
+        return capacity_planner.plan(
+            memory_budget,
+            target_step_latency=target_step_latency,
+            min_n_features=n_actions + 4 * n_sensors,
+            n_threads=n_threads)
+
     def sense_act_learn(self, sensors, reward):
         """
         Take sensor and reward data in and use them to choose an action.
@@ -188,41 +311,36 @@ class Brain(object):
         self.satisfaction = self.affect.update(reward)
 
         # Turn the raw sensors into discretized inputs.
-        # self.input_activities =(
+        # There are never more of them than the featurizer's n_features,
+        # and the unused ones are left at zero.
+        input_activities = self.preprocessor.convert_to_inputs(
+            self.actions, sensors)
+        self.input_activities = np.zeros(self.n_features)
+        self.input_activities[:input_activities.size] = input_activities
 
         # Calculate new activities in a bottom-up pass.
-        input_activities = self.preprocessor.convert_to_inputs(
-            self.consolidated_actions, sensors)
-        print(input_activities)
-
-        # self.featurizer.update_masks(new_input_indices)
-        # feature_activities, live_features = self.featurizer.featurize(
-        #     self.input_activities)
-        feature_activities, feature_resets = self.featurizer.featurize(
-            input_activities)
-        # TODO: straighten this out
-        # feature_activities = feature_activities[:self.n_features]
-        # feature_goals = self.model.step(
-        predicted_rewards, predicted_features = self.model.step(
-            feature_activities, feature_resets, reward)
-        feature_goals = self.actor.choose(
-            predicted_rewards, predicted_features)
-
-        # live_features,
+        feature_activities = self.featurizer.featurize(
+            self.input_activities)
+        self.live_features[np.where(feature_activities > 0.)[0]] = True
+        feature_goals = self.model.step(
+            feature_activities, np.where(self.live_features)[0], reward)
+
         # Pass goals back down.
         input_goals = self.featurizer.defeaturize(feature_goals)
 
         # Isolate the actions from the rest of the goals.
         self.previous_actions = self.actions
-        # self.actions = input_goals[:self.n_actions]
-        self.actions, self.consolidated_actions = self.postprocessor(
-            input_goals)
+        self.actions = input_goals[:self.n_actions]
 
         # Update the inputs in a pair of top-down/bottom-up passes.
-        feature_fitness = self.model.calculate_fitness()
-        self.featurizer.calculate_fitness(feature_fitness)
+        # Features of evicted bundles are reset in the model first,
+        # so their stale fitness isn't passed back down to the
+        # new bundles that replaced them.
         resets = self.featurizer.update_inputs()
         self.model.update_inputs(resets)
+        feature_fitness = self.model.calculate_fitness()
+        # Trim off the model's two internal features.
+        self.featurizer.update_fitness(feature_fitness[2:])
 
 
         # Create a set of random actions.
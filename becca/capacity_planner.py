@@ -0,0 +1,381 @@
+"""
+Project the memory footprint of a Brain and pick a size that fits.
+
+The largest arrays in a Brain all grow with its number of features, N.
+    The featurizer's Ziptie keeps the packed upper triangle of the
+    n_cables x n_cables nucleation energy and an n_bundles x n_cables
+    agglomeration energy, where n_cables is N and n_bundles is 4N.
+    Each has a mask of the same shape, stored one bit per element.
+    The model sees every cable and bundle as a feature, M = 5N.
+    Its prefix arrays are M x M.
+    Its dense sequence array is M x M x M.
+The cube makes the choice of N unforgiving. Doubling it takes eight
+times the memory. The functions here work out what each piece will
+take once every feature has come to life and choose the largest
+configuration that fits within a memory budget.
+
+    brain = Brain(**Brain.plan(2 ** 30))
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+import becca.model_benchmark as model_benchmark
+
+
+def model_footprint(
+    n_features,
+    dtype=np.float64,
+    sequence_backend='dense',
+    sequences_per_prefix=4.,
+    counter_dtype=None,
+):
+    """
+    Project the number of bytes the Model will use when full grown.
+
+    Parameters
+    ----------
+    n_features : int
+        The number of features the brain passes to the model.
+        The model adds two internal features of its own.
+    dtype : numpy dtype
+        See Model.dtype.
+    sequence_backend : str
+        See Model.sequence_backend.
+    sequences_per_prefix : float
+        For the sparse backend, the average number of distinct
+        sequences expected to be observed for each prefix.
+        Most prefixes never occur at all, so this is a generous guess.
+    counter_dtype : numpy dtype, optional
+        See Model.counter_dtype. Default is float64.
+
+    Returns
+    -------
+    footprint : dict of str to int
+        The bytes taken by each part of the model.
+    """
+    n_model = n_features + 2
+    itemsize = np.dtype(dtype).itemsize
+    if counter_dtype is None:
+        counter_dtype = np.float64
+    counter_itemsize = np.dtype(counter_dtype).itemsize
+    n_prefixes = n_model ** 2
+    footprint = {}
+    # Activities, credit, curiosities, rewards, uncertainties and
+    # sequence values are all dtype. Occurrences are counter_dtype.
+    # The two time step arrays are int32 and the two prefix set masks
+    # are bools.
+    footprint['model prefixes'] = n_prefixes * (
+        6 * itemsize + counter_itemsize + 8 + 2)
+    if sequence_backend == 'sparse':
+        # Each slot holds an int64 key and a counter_dtype value.
+        # The table is grown before it is half full, so right after
+        # it doubles it can have up to four slots per sequence.
+        n_sequences = int(sequences_per_prefix * n_prefixes)
+        footprint['model sequences'] = (
+            4 * n_sequences * (8 + counter_itemsize))
+    else:
+        footprint['model sequences'] = counter_itemsize * n_model ** 3
+    # A dozen or so per-feature arrays of float64
+    footprint['model features'] = 12 * 8 * n_model
+    return footprint
+
+
+def featurizer_footprint(n_features, dtype=np.float64, n_levels=1):
+    """
+    Project the number of bytes the Featurizer's Zipties will use.
+
+    Parameters
+    ----------
+    n_features : int
+        The number of features, which is also the number of cables
+        the bottom Ziptie is built to handle.
+    dtype : numpy dtype
+        See Ziptie.dtype.
+    n_levels : int
+        The number of Zipties in the stack. See Featurizer.n_levels.
+
+    Returns
+    -------
+    footprint : dict of str to int
+        The bytes taken by each part of the featurizer.
+    """
+    # See Featurizer.level_n_bundles.
+    n_bundles = 4 * n_features // n_levels
+    itemsize = np.dtype(dtype).itemsize
+    footprint = {
+        'ziptie nucleation': 0,
+        'ziptie agglomeration': 0,
+        'ziptie activities': 0,
+    }
+    n_cables = n_features
+    for _ in range(n_levels):
+        # The masks are bitsets, with each row packed into 8-byte words.
+        mask_row_bytes = 8 * ((n_cables + 63) // 64)
+        # The nucleation energy is a packed upper triangle.
+        footprint['ziptie nucleation'] += (
+            itemsize * n_cables * (n_cables - 1) // 2
+            + mask_row_bytes * n_cables)
+        footprint['ziptie agglomeration'] += (
+            itemsize * n_bundles * n_cables + mask_row_bytes * n_bundles)
+        # Cable and bundle activities and the like are float64.
+        footprint['ziptie activities'] += 8 * (3 * n_cables + 2 * n_bundles)
+        # Each level's bundles are the next level's cables.
+        n_cables = n_bundles
+    return footprint
+
+
+def brain_footprint(
+    n_features,
+    dtype=np.float64,
+    sequence_backend='dense',
+    sequences_per_prefix=4.,
+    counter_dtype=None,
+    n_levels=1,
+):
+    """
+    Project the number of bytes a Brain will use when full grown.
+
+    Parameters
+    ----------
+    n_levels : int
+        See featurizer_footprint.
+    Other parameters are described in model_footprint.
+
+    Returns
+    -------
+    footprint : dict of str to int
+        The bytes taken by each part of the brain.
+    """
+    footprint = model_footprint(
+        model_n_features(n_features, n_levels),
+        dtype,
+        sequence_backend,
+        sequences_per_prefix,
+        counter_dtype)
+    footprint.update(featurizer_footprint(n_features, dtype, n_levels))
+    return footprint
+
+
+def model_n_features(n_features, n_levels=1):
+    """
+    Find the number of features a Brain passes to its model.
+
+    Parameters
+    ----------
+    n_features : int
+        The Brain's n_features, the number of inputs to the featurizer.
+    n_levels : int
+        The number of Zipties in the featurizer's stack.
+
+    Returns
+    -------
+    n_model_features : int
+        The featurizer's inputs together with its bundles.
+        See Featurizer.n_features.
+    """
+    # See Featurizer.level_n_bundles.
+    return n_features + n_levels * (4 * n_features // n_levels)
+
+
+def largest_fit(
+    memory_budget,
+    dtype=np.float64,
+    sequence_backend='dense',
+    sequences_per_prefix=4.,
+    max_n_features=2 ** 20,
+    counter_dtype=None,
+):
+    """
+    Find the largest number of features that fits in a memory budget.
+
+    Parameters
+    ----------
+    memory_budget : int
+        The number of bytes available.
+    max_n_features : int
+        The largest number of features to consider.
+    Other parameters are described in model_footprint.
+
+    Returns
+    -------
+    n_features : int
+        The number of features. Zero if not even one will fit.
+    """
+    def fits(n_features):
+        return sum(brain_footprint(
+            n_features,
+            dtype,
+            sequence_backend,
+            sequences_per_prefix,
+            counter_dtype).values()) <= memory_budget
+
+    # The footprint only grows with n_features, so bisect.
+    lowest, highest = 0, max_n_features
+    while lowest < highest:
+        middle = (lowest + highest + 1) // 2
+        if fits(middle):
+            lowest = middle
+        else:
+            highest = middle - 1
+    return lowest
+
+
+# PRECISIONS : list of (numpy dtype, numpy dtype)
+#     The combinations of dtype and counter_dtype to try,
+#     from the most precise to the least.
+PRECISIONS = [
+    (np.float64, np.float64),
+    (np.float32, np.float64),
+    (np.float32, np.float32),
+]
+
+
+def plan(
+    memory_budget,
+    target_step_latency=None,
+    min_n_features=1,
+    n_threads=1,
+    sequences_per_prefix=4.,
+    verbose=True,
+):
+    """
+    Choose the number of features, precision and sequence backend
+    for a Brain.
+
+    Every combination of precision (see PRECISIONS) and sequence
+    backend (dense, sparse) is tried. The one that fits the most
+    features in the budget wins. Ties go to the more precise
+    and to dense over sparse, since these are more precise and,
+    for the same number of features, faster.
+
+    If a target step latency is given, the model step is timed
+    on this machine with every feature live and active features
+    chosen at random. The number of features is halved until
+    the target is met.
+
+    Parameters
+    ----------
+    memory_budget : int
+        The number of bytes the brain can use.
+    target_step_latency : float, optional
+        The longest the model should take to step, in seconds.
+    min_n_features : int
+        The fewest features that will do. For a brain, this is at least
+        n_actions + 4 * n_sensors.
+    n_threads : int
+        The number of threads the brain will use. This only
+        matters for timing the model step.
+    sequences_per_prefix : float
+        See model_footprint.
+    verbose : boolean
+        If True, print the projected footprint of each component,
+        and the total footprint at each precision.
+
+    Returns
+    -------
+    config : dict
+        Keyword arguments for Brain: n_features, dtype,
+        counter_dtype and sequence_backend.
+    """
+    best = None
+    for dtype, counter_dtype in PRECISIONS:
+        for sequence_backend in ('dense', 'sparse'):
+            n_features = largest_fit(
+                memory_budget,
+                dtype,
+                sequence_backend,
+                sequences_per_prefix,
+                counter_dtype=counter_dtype)
+            if best is None or n_features > best['n_features']:
+                best = {
+                    'n_features': n_features,
+                    'dtype': dtype,
+                    'counter_dtype': counter_dtype,
+                    'sequence_backend': sequence_backend,
+                }
+    if best['n_features'] < min_n_features:
+        raise ValueError(' '.join([
+            'A memory budget of', str(memory_budget),
+            'bytes is too small for', str(min_n_features), 'features.']))
+
+    if target_step_latency is not None:
+        while best['n_features'] > min_n_features:
+            step_latency = model_benchmark.time_step(
+                model_n_features(best['n_features']),
+                n_threads,
+                dtype=best['dtype'],
+                sequence_backend=best['sequence_backend'],
+                counter_dtype=best['counter_dtype'])
+            if step_latency <= target_step_latency:
+                break
+            best['n_features'] = max(
+                best['n_features'] // 2, min_n_features)
+
+    if verbose:
+        report(brain_footprint(
+            best['n_features'],
+            best['dtype'],
+            best['sequence_backend'],
+            sequences_per_prefix,
+            best['counter_dtype']))
+        report_precisions(
+            best['n_features'],
+            best['sequence_backend'],
+            sequences_per_prefix)
+        print('{0} features, {1}, {2} counters, {3} sequences'.format(
+            best['n_features'],
+            np.dtype(best['dtype']).name,
+            np.dtype(best['counter_dtype']).name,
+            best['sequence_backend']))
+    return best
+
+
+def report_precisions(
+    n_features,
+    sequence_backend='dense',
+    sequences_per_prefix=4.,
+):
+    """
+    Print the total footprint of a Brain at each precision.
+
+    This shows how much reduced precision saves. Going to float32
+    for the prefix arrays alone leaves the largest array,
+    the sequence occurrences, as it is. Float32 counters halve that too.
+
+    Parameters
+    ----------
+    See brain_footprint.
+    """
+    full_total = None
+    for dtype, counter_dtype in PRECISIONS:
+        total = sum(brain_footprint(
+            n_features,
+            dtype,
+            sequence_backend,
+            sequences_per_prefix,
+            counter_dtype).values())
+        if full_total is None:
+            full_total = total
+        print('{0:<8}{1:<16}{2:>12.1f} MB {3:>6.1f}% saved'.format(
+            np.dtype(dtype).name,
+            np.dtype(counter_dtype).name + ' counters',
+            total / 2. ** 20,
+            100. * (1. - total / full_total)))
+
+
+def report(footprint):
+    """
+    Print a table of the bytes used by each component.
+
+    Parameters
+    ----------
+    footprint : dict of str to int
+        See brain_footprint.
+    """
+    for component in sorted(footprint):
+        print('{0:<24}{1:>12.1f} MB'.format(
+            component, footprint[component] / 2. ** 20))
+    print('{0:<24}{1:>12.1f} MB'.format(
+        'total', sum(footprint.values()) / 2. ** 20))
@@ -4,6 +4,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 import numpy as np
 
+import becca.cat_tree_numba as nb
 from becca.str_cat_tree_node import StrCatTreeNode
 from becca.num_cat_tree_node import NumCatTreeNode
 
@@ -52,10 +53,14 @@ class CatTree(object):
         # observation_set: <type>CatTreeNode
         #     A one-node tree that keeps a record of the set of values
         #     observed recently.
+        # numeric: boolean
+        #     Is this a numeric tree? Numeric trees are also kept
+        #     flattened into arrays. See _flatten.
         self.verbose = verbose
         if self.verbose:
             print('\'' + type + '\'' + ' tree requested.')
-        if type.lower() in ['string', 'str']:
+        self.numeric = type.lower() not in ['string', 'str']
+        if not self.numeric:
             self.root = StrCatTreeNode(
                 # i_input=input_pool.pop(),
                 i_input=i_input,
@@ -68,7 +73,8 @@ class CatTree(object):
                 # i_input=input_pool.pop(),
                 i_input=i_input,
                 position=base_position)
-            self.observation_set = NumCatTreeNode()
+            # Only the count and variance of the whole tree are needed.
+            self.observation_set = NumCatTreeNode(reservoir_size=0)
             if self.verbose:
                 print('numeric tree created.')
 
@@ -82,6 +88,8 @@ class CatTree(object):
         # n_cats: int
         #     The number of categories represented in this tree.
         self.n_cats = 1
+        if self.numeric:
+            self._flatten()
 
     def __str__(self):
         """
@@ -96,6 +104,49 @@ class CatTree(object):
             tree_string += str(node)
         return tree_string
 
+    def _flatten(self):
+        """
+        Lay the numeric tree out in arrays for cat_tree_numba.
+
+        This walks the whole tree, so it is only done when
+        the tree changes shape, after a split.
+
+        The arrays are split_values, lo_children, hi_children and
+        i_inputs, described in cat_tree_numba. nodes holds the node
+        objects in the same order, so that they can be retrieved.
+        """
+        nodes = []
+        split_values = []
+        lo_children = []
+        hi_children = []
+        i_inputs = []
+
+        def flatten_descend(node):
+            """
+            Recursively walk the tree, adding each node before its children.
+            """
+            i_node = len(nodes)
+            nodes.append(node)
+            i_inputs.append(node.i_input)
+            split_values.append(0.)
+            lo_children.append(-1)
+            hi_children.append(-1)
+            if not node.leaf:
+                split_values[i_node] = node.lo_child.hi_bound
+                lo_children[i_node] = flatten_descend(node.lo_child)
+                hi_children[i_node] = flatten_descend(node.hi_child)
+            return i_node
+
+        flatten_descend(self.root)
+        self.nodes = nodes
+        self.split_values = np.array(split_values, dtype=float)
+        self.lo_children = np.array(lo_children, dtype=int)
+        self.hi_children = np.array(hi_children, dtype=int)
+        self.i_inputs = np.array(i_inputs, dtype=int)
+        # lineage: array of ints
+        #     Scratch space for cat_tree_numba.categorize.
+        self.lineage = np.zeros(int(self.depth) + 1, dtype=int)
+
     def count(self):
         """
         How many values have been assigned to this tree?
@@ -143,18 +194,32 @@ class CatTree(object):
         @return CatTreeNode
             The leaf node containing value.
         """
-        def get_leaf_descend(node):
-            """
-            Recursively descend through the tree to find the leaf node.
-            """
-            if node.leaf:
-                return node
-            elif node.lo_child.has(value):
-                return get_leaf_descend(node.lo_child)
-            else:
-                return get_leaf_descend(node.hi_child)
+        if self.numeric:
+            return self.nodes[nb.find_leaf(
+                value, 0, self.split_values, self.lo_children,
+                self.hi_children)]
+        return self._get_str_leaf(value)
+
+    def _get_str_leaf(self, name):
+        """
+        Retrieve the leaf associated with a string.
+
+        A string that has been seen before is looked up in the tree's
+        NameTable. A new one belongs with the other strings that
+        aren't in any node's in_crowd, at the end of the chain of
+        catch-all lo children.
 
-        return get_leaf_descend(self.root)
+        @param name: string
+
+        @return StrCatTreeNode
+        """
+        i_name = self.root.name_table.find(name)
+        if i_name != -1:
+            return self.root.name_table.leaves[i_name]
+        node = self.root
+        while not node.leaf:
+            node = node.lo_child
+        return node
 
     def get_lineage(self, value):
         """
@@ -170,19 +235,19 @@ class CatTree(object):
             the leaf node containing the value and including every
             node in between, in order.
         """
-        def get_lineage_descend(node, lineage):
-            """
-            Recursively descend through the tree to find the lineage.
-            """
+        if self.numeric:
+            n_lineage = nb.find_lineage(
+                value, 0, self.split_values, self.lo_children,
+                self.hi_children, self.lineage)
+            return [self.nodes[i_node]
+                    for i_node in self.lineage[:n_lineage]]
+
+        node = self._get_str_leaf(value)
+        lineage = []
+        while node is not None:
             lineage.append(node)
-            if node.leaf:
-                return lineage
-            elif node.lo_child.has(value):
-                return get_lineage_descend(node.lo_child, lineage)
-            else:
-                return get_lineage_descend(node.hi_child, lineage)
-
-        return get_lineage_descend(self.root, [])
+            node = node.parent
+        return lineage[::-1]
 
     def get_parent_indices(self, node, parent_indices):
         """
@@ -239,6 +304,20 @@ class CatTree(object):
             Membership varies from 0. (non-member)
             to 1. (full member).
         """
+        if self.numeric:
+            # Like the loop below, this holds the discount at .5 for now.
+            nb.categorize(
+                value,
+                0,
+                self.split_values,
+                self.lo_children,
+                self.hi_children,
+                self.i_inputs,
+                .5,
+                self.lineage,
+                input_activities)
+            return
+
         lineage = self.get_lineage(value)
         cumulative_discount = 1.
         for node in lineage[::-1]:
@@ -256,6 +335,27 @@ class CatTree(object):
         self.observation_set.add(value)
         self.get_leaf(value).add(value)
 
+    def add_many(self, values):
+        """
+        Add several values to a numeric tree at once.
+
+        This has the same effect as calling add on each value in turn,
+        except for which values the leaves keep in their reservoirs.
+
+        @param values: array of floats
+        """
+        self.observation_set.add_many(values)
+        leaves = np.zeros(values.size, dtype=int)
+        nb.find_leaves(
+            values, 0, self.split_values, self.lo_children,
+            self.hi_children, leaves)
+        # A stable sort keeps each leaf's values in the order they came.
+        order = np.argsort(leaves, kind='stable')
+        i_leaves, starts = np.unique(leaves[order], return_index=True)
+        stops = np.append(starts[1:], values.size)
+        for i_leaf, i_start, i_stop in zip(i_leaves, starts, stops):
+            self.nodes[i_leaf].add_many(values[order[i_start:i_stop]])
+
     # def grow(self, input_pool, new_input_indices):
     def grow(self, n_inputs):
         """
@@ -314,6 +414,8 @@ class CatTree(object):
                 #     (best_leaf.hi_child.i_input, parent_indices))
                 self.n_cats += 2
                 n_inputs += 2
+                if self.numeric:
+                    self._flatten()
                 # success = True
         # return success, new_input_indices
         return n_inputs
@@ -0,0 +1,190 @@
+"""
+Numba functions for looking values up in numeric category trees.
+
+A numeric CatTree is flattened into parallel arrays, one element
+per node, so that finding a value's leaf is a tight loop over
+integers and floats instead of a recursive walk through Python objects.
+    split_values : array of floats
+        Where each node's children divide. Values below the split
+        belong to the lo child, the rest to the hi child.
+    lo_children, hi_children : array of ints
+        The index of each node's children. Both are -1 for a leaf.
+    i_inputs : array of ints
+        The element of the input activities each node is associated with.
+A tree's root is node 0. The arrays of several trees can also be
+laid end to end, with each tree's child indices offset to match.
+Then each tree is identified by the index of its root.
+"""
+import numpy as np
+from numba import jit
+
+
+@jit(nopython=True, nogil=True)
+def find_leaf(value, i_root, split_values, lo_children, hi_children):
+    """
+    Find the leaf a value belongs to.
+
+    Parameters
+    ----------
+    value : float
+    i_root : int
+        The index of the tree's root.
+    split_values, lo_children, hi_children : arrays
+        The flattened tree.
+
+    Returns
+    -------
+    i_node : int
+        The index of the leaf.
+    """
+    i_node = i_root
+    while lo_children[i_node] != -1:
+        if value < split_values[i_node]:
+            i_node = lo_children[i_node]
+        else:
+            i_node = hi_children[i_node]
+    return i_node
+
+
+@jit(nopython=True, nogil=True)
+def find_leaves(values, i_root, split_values, lo_children, hi_children,
+                leaves):
+    """
+    Find the leaf each of several values belongs to.
+
+    Parameters
+    ----------
+    values : array of floats
+    i_root : int
+        The index of the tree's root.
+    split_values, lo_children, hi_children : arrays
+        The flattened tree.
+    leaves : array of ints
+        Filled in with the index of the leaf for each value.
+    """
+    for i_value in range(values.size):
+        leaves[i_value] = find_leaf(
+            values[i_value], i_root, split_values, lo_children, hi_children)
+
+
+@jit(nopython=True, nogil=True)
+def find_lineage(
+    value, i_root, split_values, lo_children, hi_children, lineage):
+    """
+    Find the nodes between the root and the leaf a value belongs to.
+
+    Parameters
+    ----------
+    value : float
+    i_root : int
+        The index of the tree's root.
+    split_values, lo_children, hi_children : arrays
+        The flattened tree.
+    lineage : array of ints
+        Filled in with the node indices, starting with the root.
+        It has to be at least one longer than the depth of the tree.
+
+    Returns
+    -------
+    n_lineage : int
+        The number of nodes in the lineage.
+    """
+    i_node = i_root
+    n_lineage = 0
+    lineage[n_lineage] = i_node
+    n_lineage += 1
+    while lo_children[i_node] != -1:
+        if value < split_values[i_node]:
+            i_node = lo_children[i_node]
+        else:
+            i_node = hi_children[i_node]
+        lineage[n_lineage] = i_node
+        n_lineage += 1
+    return n_lineage
+
+
+@jit(nopython=True, nogil=True)
+def categorize(
+    value,
+    i_root,
+    split_values,
+    lo_children,
+    hi_children,
+    i_inputs,
+    generational_discount,
+    lineage,
+    input_activities,
+):
+    """
+    Set the activities of the inputs for every node in a value's lineage.
+
+    The leaf's input is set to 1, its parent's to
+    generational_discount, its grandparent's to the square of that,
+    and so on up to the root.
+
+    Parameters
+    ----------
+    value : float
+    i_root : int
+        The index of the tree's root.
+    split_values, lo_children, hi_children, i_inputs : arrays
+        The flattened tree.
+    generational_discount : float
+    lineage : array of ints
+        Scratch space, at least one longer than the depth of the tree.
+    input_activities : array of floats
+        The under-construction array of input activities. Modified.
+    """
+    n_lineage = find_lineage(
+        value, i_root, split_values, lo_children, hi_children, lineage)
+    cumulative_discount = 1.
+    for i_lineage in range(n_lineage - 1, -1, -1):
+        input_activities[i_inputs[lineage[i_lineage]]] = cumulative_discount
+        cumulative_discount *= generational_discount
+
+
+@jit(nopython=True, nogil=True)
+def categorize_all(
+    values,
+    i_roots,
+    split_values,
+    lo_children,
+    hi_children,
+    i_inputs,
+    generational_discount,
+    lineage,
+    input_activities,
+):
+    """
+    Categorize one value in each of several trees laid end to end.
+
+    Values that aren't finite are skipped.
+
+    Parameters
+    ----------
+    values : array of floats
+        One value for each tree.
+    i_roots : array of ints
+        The index of each tree's root.
+    split_values, lo_children, hi_children, i_inputs : arrays
+        The flattened trees.
+    generational_discount : float
+    lineage : array of ints
+        Scratch space, at least one longer than the depth
+        of the deepest tree.
+    input_activities : array of floats
+        The under-construction array of input activities. Modified.
+    """
+    for i_tree in range(values.size):
+        if not np.isfinite(values[i_tree]):
+            continue
+        categorize(
+            values[i_tree],
+            i_roots[i_tree],
+            split_values,
+            lo_children,
+            hi_children,
+            i_inputs,
+            generational_discount,
+            lineage,
+            input_activities)
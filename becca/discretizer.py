@@ -11,6 +11,35 @@ import matplotlib.pyplot as plt
 from becca.cat_tree import CatTree
 
 
+def classify(raw_val):
+    """
+    Determine whether a value is a string or a number.
+
+    Not-a-numbers and infinities are treated as strings.
+
+    Parameters
+    ----------
+    raw_val: float or string or convertable to string
+
+    Returns
+    -------
+    val: float or string
+        The value, converted to a float or string.
+    is_string: boolean
+    """
+    try:
+        float_val = float(raw_val)
+    except (TypeError, ValueError):
+        return str(raw_val), True
+    if np.isnan(float_val):
+        return "NaN", True
+    elif np.isposinf(float_val):
+        return "positive_infinity", True
+    elif np.isneginf(float_val):
+        return "negative_infinity", True
+    return float_val, False
+
+
 class Discretizer(object):
     """
     Incrementally break a set of values and/or strings into categories.
@@ -107,20 +136,7 @@ class Discretizer(object):
         self.timestep += 1
 
         # Determine whether the observation is string or numerical.
-        is_string = True
-        try:
-            float_val = float(raw_val)
-            if np.isnan(float_val):
-                val = "NaN"
-            elif np.isposinf(float_val):
-                val = "positive_infinity"
-            elif np.isneginf(float_val):
-                val = "negative_infinity"
-            else:
-                val = float_val
-                is_string = False
-        except ValueError:
-            val = str(raw_val)
+        val, is_string = classify(raw_val)
 
         # input_activities is modified by calls to categorize()
         if is_string:
@@ -136,11 +152,34 @@ class Discretizer(object):
             #     input_pool, new_input_indices)
             # success, n_inputs, new_input_indices = self.string_cats.grow(
             #     input_pool, new_input_indices)
-            n_inputs = self.numeric_cats.grow(n_inputs)
-            n_inputs = self.string_cats.grow(n_inputs)
+            n_inputs = self.grow(n_inputs)
 
         return input_activities, n_inputs
 
+    def grow(self, n_inputs, max_n_inputs=None):
+        """
+        Try to grow new categories.
+
+        Parameters
+        ----------
+        n_inputs : int
+            The number of inputs currently assigned.
+        max_n_inputs : int, optional
+            The most inputs there is room for. A split makes two
+            new categories, each with an input of its own. Once there
+            isn't room for two more, the categories stop growing.
+            By default, there is no limit.
+
+        Returns
+        -------
+        n_inputs: int
+            The number of inputs assigned, including any new categories.
+        """
+        for cats in (self.numeric_cats, self.string_cats):
+            if max_n_inputs is None or n_inputs + 2 <= max_n_inputs:
+                n_inputs = cats.grow(n_inputs)
+        return n_inputs
+
     def find_cats(self, vals):
         """
         Find a set of categories for vals.
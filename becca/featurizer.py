@@ -3,9 +3,13 @@ The Featurizer class.
 """
 
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import time
+
 import numpy as np
 
 import becca.featurizer_viz as viz
+from becca.preprocessor import InputFilter
 from becca.ziptie import Ziptie
 
 
@@ -14,11 +18,20 @@ class Featurizer(object):
     Convert inputs to bundles and learn new bundles.
 
     Inputs are transformed into bundles, sets of inputs that tend to co-occur.
+    Zipties are stacked into levels. The inputs are the cables of the
+    first level, and the bundles of each level are the cables of
+    the next. The features are the inputs followed by the bundles
+    of every level, from the bottom up.
     """
     def __init__(
             self,
             n_inputs,
+            dtype=np.float64,
             # max_n_features=None,
+            n_levels=1,
+            n_threads=1,
+            pipelined=False,
+            recycle_bundles=False,
             threshold=None,
             verbose=False,
             ):
@@ -27,9 +40,23 @@ class Featurizer(object):
 
         Parameters
         ---------
+        dtype : numpy dtype
+            The floating point type of each Ziptie's energies.
         n_inputs : int
-            The number of inputs (cables) that each Ziptie will be
+            The number of inputs (cables) that the first Ziptie will be
             equipped to handle.
+        n_levels : int
+            The number of Zipties stacked on top of each other.
+            Default is 1.
+        n_threads : int
+            The number of threads each Ziptie can use.
+        pipelined : boolean
+            If True, each level learns in a worker thread of its own,
+            while the brain goes on with its time step.
+            See Featurizer.pipelined.
+        recycle_bundles : boolean
+            If True, the zipties replace their least useful bundles
+            once they are full. See Ziptie.recycle_bundles.
         threshold : float
             See Ziptie.nucleation_threshold
         """
@@ -55,6 +82,22 @@ class Featurizer(object):
         self.n_inputs = n_inputs
         # self.max_n_features = self.n_inputs
         self.n_bundles = 4 * self.n_inputs
+        # n_levels : int
+        #     The number of Zipties in the stack.
+        # level_n_bundles : int
+        #     The number of bundles in each level. The bundles are
+        #     shared out evenly between the levels.
+        self.n_levels = n_levels
+        self.level_n_bundles = self.n_bundles // self.n_levels
+        self.n_bundles = self.level_n_bundles * self.n_levels
+        # n_features : int
+        #     The total number of inputs and bundles.
+        self.n_features = self.n_inputs + self.n_bundles
+        # level_offsets : array of ints
+        #     The position of each level's first bundle among the
+        #     features. The last element is n_features.
+        self.level_offsets = self.n_inputs + self.level_n_bundles * (
+            np.arange(self.n_levels + 1))
         # if max_n_features is None:
         #     # Choose the total number of bundles (created features) allowed,
         #     # in terms of the number of inputs allowed.
@@ -106,24 +149,94 @@ class Featurizer(object):
             n_inputs_final = self.n_inputs,
             verbose=self.verbose,
         )
-        # ziptie: Ziptie
-        #     The ziptie is an instance of the Ziptie algorithm class,
+        # zipties: list of Ziptie
+        #     Each ziptie is an instance of the Ziptie algorithm class,
         #     an incremental method for bundling inputs. Check out
         #     ziptie.py for a complete description. Zipties note which
         #     inputs tend to be co-active and creates bundles of them.
         #     This feature creation mechanism results in l0-sparse
         #     features, which sparsity helps keep Becca fast.
-        self.ziptie = Ziptie(
-            n_cables=self.n_inputs,
-            n_bundles=self.n_bundles,
-            threshold=threshold,
-            verbose=self.verbose)
+        #     The first ziptie is at the bottom of the stack.
+        ziptie_kwargs = {}
+        if threshold is not None:
+            ziptie_kwargs['threshold'] = threshold
+        self.zipties = []
+        n_cables = self.n_inputs
+        for i_level in range(self.n_levels):
+            self.zipties.append(Ziptie(
+                n_cables=n_cables,
+                n_bundles=self.level_n_bundles,
+                dtype=dtype,
+                name='ziptie_' + str(i_level),
+                n_threads=n_threads,
+                recycle_bundles=recycle_bundles,
+                debug=self.verbose,
+                **ziptie_kwargs))
+            n_cables = self.level_n_bundles
+        # ziptie: Ziptie
+        #     The bottom ziptie, the one that sees the inputs.
+        self.ziptie = self.zipties[0]
+
+        # pipelined : boolean
+        #     If True, learning is handed off to a pool of worker
+        #     threads, one per level, at the end of featurize.
+        #     The levels learn at the same time as each other and
+        #     as the rest of the brain's time step. Their kernels
+        #     release the GIL. Learning is waited on the next time
+        #     the zipties are used, so it always finishes before
+        #     the next featurize or defeaturize. The bundles that come
+        #     out of it are the same as without pipelining.
+        #     With n_threads > 1, parallel kernels from several levels
+        #     can run at once. This needs numba's tbb or omp
+        #     threading layer.
+        self.pipelined = pipelined
+        # _executor : ThreadPoolExecutor
+        #     The worker threads. Created when they are first needed.
+        # _pending_learning : list of Future
+        #     The learning that has been handed off and not waited on.
+        self._executor = None
+        self._pending_learning = []
+        # _pending_evictions : list of lists of arrays of ints
+        #     For each level, the bundles evicted while learning
+        #     that haven't yet been passed on to the level above.
+        # _feature_resets : list of arrays of ints
+        #     The features whose bundles have been evicted since the
+        #     last call to update_inputs.
+        self._pending_evictions = [[] for _ in range(self.n_levels)]
+        self._feature_resets = []
+
+        # featurize_time,
+        # learn_time : array of floats
+        #     The total number of seconds each level has spent
+        #     featurizing and learning.
+        # n_timed_steps : int
+        #     The number of time steps these were accumulated over.
+        #     See level_timing().
+        self.featurize_time = np.zeros(self.n_levels)
+        self.learn_time = np.zeros(self.n_levels)
+        self.n_timed_steps = 0
+
+    def update_inputs(self):
+        """
+        Collect the features that have been reset since the last call.
 
-    def calculate_fitness():
-        pass
+        When a ziptie evicts a bundle, its index is taken over by
+        a new bundle, and so is the corresponding feature. Whatever the
+        model has learned about the old feature doesn't apply to
+        the new one.
 
-    def update_inputs():
-        pass
+        Returns
+        -------
+        feature_resets : array of ints
+            The indices of the features that have been reset.
+        """
+        self._finish_learning()
+        if self._feature_resets:
+            feature_resets = np.unique(np.concatenate(self._feature_resets))
+        else:
+            feature_resets = np.zeros(0, dtype=int)
+        self._feature_resets = []
+        return feature_resets
 
     def featurize(self, new_inputs):
         """
@@ -138,42 +251,196 @@ class Featurizer(object):
         -------
         feature_activities: array of floats
         """
+        self._finish_learning()
+
         # Start by normalizing all the inputs.
         #self.input_activities = self.update_inputs(new_inputs)
         self.input_activities = new_inputs
-        cable_activities, cable_resets, cable_fitness = self.filter.step(
-            candidate_activities=self.input_activities, 
-
-        # Run the inputs through the ziptie to find bundle activities
-        # and to learn how to bundle them.
-        bundle_activities = self.ziptie.featurize(self.input_activities)
+        # TODO: Run the inputs through the filter, once it can step.
+        # cable_activities, cable_resets, cable_fitness = self.filter.step(
+        #     candidate_activities=self.input_activities)
+
+        # Run the inputs up through the zipties to find bundle activities.
+        # Each level's bundle activities are the next level's cables.
+        level_cable_activities = []
+        level_bundle_activities = []
+        cable_activities = self.input_activities
+        for i_level, ziptie in enumerate(self.zipties):
+            start = time.time()
+            bundle_activities = ziptie.featurize(cable_activities)
+            self.featurize_time[i_level] += time.time() - start
+            level_cable_activities.append(cable_activities)
+            level_bundle_activities.append(bundle_activities)
+            cable_activities = bundle_activities
         # The element activities are the combination of the residual
         # input activities and the bundle activities.
-        self.feature_activities = np.concatenate((self.input_activities,
-                                                  bundle_activities))
+        self.feature_activities = np.concatenate(
+            [self.input_activities] + level_bundle_activities)
 
         # Track features that are active.
         # self.live_features[np.where(
         #     self.feature_activities > self.epsilon)] = 1.
 
-        # Incrementally update the bundles in the ziptie.
-        self.ziptie.learn(self.input_activities)
+        # Incrementally update the bundles in each ziptie.
+        self._start_learning(level_cable_activities)
+        self.n_timed_steps += 1
 
         return self.feature_activities
 
+    def fit(self, input_activities, chunk_size=2 ** 14):
+        """
+        Pre-train the zipties from a recorded sequence of inputs.
+
+        The levels are trained one at a time, from the bottom up.
+        Each is fit to the bundle activities of the fully trained
+        levels below it. With a single level, this gives the same
+        bundles as calling featurize on every time step. With more,
+        it differs a little from online learning, where each level
+        learns from levels below it that are still changing.
+
+        Parameters
+        ----------
+        input_activities : 2D array of floats or str
+            One row of input activities per time step. It can be a
+            numpy memmap or the name of a .npy file. See Ziptie.fit.
+        chunk_size : int
+            The number of time steps to read into memory at once.
+        """
+        self._finish_learning()
+        if isinstance(input_activities, str):
+            input_activities = np.load(input_activities, mmap_mode='r')
+        n_steps = input_activities.shape[0]
+        for i_level, ziptie in enumerate(self.zipties):
+            start = time.time()
+            for i_chunk_start in range(0, n_steps, chunk_size):
+                if ziptie.bundles_full:
+                    break
+                cable_activities = np.ascontiguousarray(input_activities[
+                    i_chunk_start:i_chunk_start + chunk_size], dtype=float)
+                for lower_ziptie in self.zipties[:i_level]:
+                    cable_activities = lower_ziptie.featurize_batch(
+                        cable_activities)
+                self._pending_evictions[i_level].append(
+                    ziptie.fit(cable_activities, chunk_size))
+            self.learn_time[i_level] += time.time() - start
+            # Reset the level above before it is fit.
+            self._pass_on_evictions()
+
+    def _learn_level(self, i_level, cable_activities):
+        """
+        Update the bundles in one level and time it.
+        """
+        start = time.time()
+        evicted_bundles = self.zipties[i_level].learn(cable_activities)
+        if evicted_bundles.size > 0:
+            self._pending_evictions[i_level].append(evicted_bundles)
+        self.learn_time[i_level] += time.time() - start
+
+    def _start_learning(self, level_cable_activities):
+        """
+        Have every level learn from its cable activities.
+
+        Parameters
+        ----------
+        level_cable_activities : list of arrays of floats
+            The cable activities for each level.
+        """
+        if not self.pipelined:
+            for i_level, cable_activities in enumerate(
+                    level_cable_activities):
+                self._learn_level(i_level, cable_activities)
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_levels)
+        self._pending_learning = [
+            self._executor.submit(
+                self._learn_level, i_level, cable_activities)
+            for i_level, cable_activities in enumerate(
+                level_cable_activities)]
+
+    def _finish_learning(self):
+        """
+        Wait for any learning that is still going on in the workers.
+
+        Errors raised while learning are raised again here.
+        """
+        pending_learning = self._pending_learning
+        self._pending_learning = []
+        for future in pending_learning:
+            future.result()
+        self._pass_on_evictions()
+
+    def _pass_on_evictions(self):
+        """
+        Reset everything built on the bundles that have been evicted.
+
+        From the bottom level up, each evicted bundle's feature
+        is marked for reset, and the matching cable in the level above
+        is reset. That can evict bundles in the level above,
+        which are handled in turn.
+        """
+        for i_level, ziptie in enumerate(self.zipties):
+            if not self._pending_evictions[i_level]:
+                continue
+            evicted_bundles = np.unique(np.concatenate(
+                self._pending_evictions[i_level]))
+            self._pending_evictions[i_level] = []
+            if evicted_bundles.size == 0:
+                continue
+            self._feature_resets.append(
+                self.level_offsets[i_level] + evicted_bundles)
+            if i_level + 1 < self.n_levels:
+                self._pending_evictions[i_level + 1].append(
+                    self.zipties[i_level + 1].reset_cables(evicted_bundles))
+
+    def level_timing(self):
+        """
+        Find the average time each level takes per time step.
+
+        Returns
+        -------
+        featurize_time, learn_time : array of floats
+            The average number of seconds each level spent
+            featurizing and learning, from the bottom level up.
+        """
+        self._finish_learning()
+        n_steps = max(self.n_timed_steps, 1)
+        return self.featurize_time / n_steps, self.learn_time / n_steps
+
+    def __getstate__(self):
+        """
+        Leave out the worker threads when pickling.
+        """
+        self._finish_learning()
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
 
     def defeaturize(self, feature_activities):
         """
         Take a set of feature activities and represent them in inputs.
+
+        Starting from the top level, each level's bundle activities
+        are projected down onto its cables. These are combined with
+        the bundle activities of the level below, taking the larger
+        of the two, and the projection continues down to the inputs.
         """
+        self._finish_learning()
         input_activities = feature_activities[:self.n_inputs]
         # Project each ziptie down to inputs.
-        bundle_activities = feature_activities[self.n_inputs:]
-        # TODO: iterate over multiple zipties
-        ziptie_input_activities = self.ziptie.project_bundle_activities(
-            bundle_activities)
-        input_activities = np.maximum(
-            input_activities, ziptie_input_activities)
+        cable_activities = None
+        for i_level in range(self.n_levels - 1, -1, -1):
+            bundle_activities = feature_activities[
+                self.level_offsets[i_level]:
+                self.level_offsets[i_level + 1]]
+            if cable_activities is not None:
+                bundle_activities = np.maximum(
+                    bundle_activities, cable_activities)
+            cable_activities = self.zipties[
+                i_level].project_bundle_activities(bundle_activities)
+        input_activities = np.maximum(input_activities, cable_activities)
         return input_activities
 
 
@@ -181,15 +448,26 @@ class Featurizer(object):
         """
         Recalculate the fitness of each cable candidate in each ziptie.
 
+        Each bundle's feature fitness is passed on to its ziptie,
+        where it helps decide which bundles to recycle.
+        Call update_inputs first, so that bundles that have just been
+        evicted don't pick up the fitness of the features they replaced.
+
         Parameters
         ----------
         feature_fitness: array of floats
         """
+        self._finish_learning()
+        for i_level, ziptie in enumerate(self.zipties):
+            bundle_fitness = feature_fitness[
+                self.level_offsets[i_level]:
+                self.level_offsets[i_level + 1]]
+            ziptie.bundle_fitness[:bundle_fitness.size] = bundle_fitness
+
         # TODO: Cable candidate fitness is a combination of feature
         # fitness (from the model) and the feature fitness of any bundle
         # with which
         # the cable candidate might be affiliated.
-        pass
 
 
     # TODO: Remove ziptie masks and update_masks()
@@ -201,6 +479,7 @@ class Featurizer(object):
            Tuples of (child_index, parent_index). Each time a new child
            node is added, it is recorded on this list.
         """
+        self._finish_learning()
         for pair in new_input_indices:
             self.ziptie.update_masks(pair[0], pair[1])
 
@@ -278,4 +557,5 @@ class Featurizer(object):
         """
         Show the current state of the featurizer.
         """
+        self._finish_learning()
         viz.visualize(self, brain, world)
@@ -5,7 +5,8 @@ from __future__ import unicode_literals
 
 import numpy as np
 
-from becca.discretizer import Discretizer
+from becca.discretizer import Discretizer, classify
+from becca.sensor_bank import SensorBank
 import becca.tools as tools
 
 
@@ -13,20 +14,34 @@ class Preprocessor(object):
     """
     The Preprocessor takes the raw sensor signals in and creates a set of
     inputs for the Brain to learn from.
+
+    The sensor vector is handled in columns. It is converted to floats
+    in bulk, and every sensor with a finite value is categorized by
+    a SensorBank in one pass. Only sensors reporting strings,
+    not-a-numbers or infinities go through their Discretizer's
+    string tree one at a time.
     """
     def __init__(
         self,
+        max_n_inputs=None,
         n_actions=None,
         n_sensors=None,
+        split_frequency=int(1e3),
     ):
         """
         Parameters
         ----------
+        max_n_inputs: int, optional
+            The most inputs the preprocessor can pass on. Once there
+            are this many, the discretizers stop splitting categories.
+            By default, there is no limit.
         n_actions, n_sensors: int
             The number of actions that the world is expecting and the
             number of sensors that the world will be providing. These
             are the only pieces of information Becca needs about the
             world to get started.
+        split_frequency: int
+            How often to check for category splits. See Discretizer.
         """
         # Check for valid arguments.
         if not n_actions or not n_sensors:
@@ -39,7 +54,18 @@ class Preprocessor(object):
 
         # n_inputs: int
         #     The total number of inputs that the preprocessor passes on.
+        # max_n_inputs: int or None
+        #     The limit on n_inputs. It has to leave room for every
+        #     discretizer's first two categories.
         self.n_inputs = self.n_actions
+        self.max_n_inputs = max_n_inputs
+        if (self.max_n_inputs is not None and
+                self.max_n_inputs < self.n_actions + 2 * self.n_sensors):
+            raise ValueError(' '.join([
+                'There is only room for', str(self.max_n_inputs),
+                'inputs, but', str(self.n_actions), 'actions and',
+                str(self.n_sensors), 'sensors need at least',
+                str(self.n_actions + 2 * self.n_sensors) + '.']))
 
         # input_energies: array of floats
         #     The reservoirs of energy associated with each of the inputs.
@@ -59,10 +85,22 @@ class Preprocessor(object):
             new_discretizer = Discretizer(
                 base_position=float(i) + .5,
                 n_inputs=self.n_inputs,
-                name='sensor_' + str(i))
+                name='sensor_' + str(i),
+                split_frequency=split_frequency)
             self.discretizers.append(new_discretizer)
             self.n_inputs += 2
 
+        # sensor_bank: SensorBank
+        #     Categorizes the numeric sensor values for all
+        #     the discretizers at once.
+        self.sensor_bank = SensorBank(
+            self.discretizers, buffer_size=split_frequency)
+        # timestep: int
+        #     The number of time steps of sensor values handled so far.
+        #     This takes the place of each Discretizer's timestep.
+        self.timestep = 0
+        self.split_frequency = split_frequency
+
     def convert_to_inputs(self, actions, sensors):
         """
         Build a set of discretized inputs for the featurizer.
@@ -81,15 +119,29 @@ class Preprocessor(object):
             The activity levels of each of the inputs, which themselves
             are discretized versions of the sensors.
         """
+        self.timestep += 1
         raw_input_activities = np.zeros(self.input_energies.size)
         # This assumes that n_actions is constant.
         raw_input_activities[:self.n_actions] = actions
-        for i_sensor, discretizer in enumerate(self.discretizers):
-            raw_input_activities, self.n_inputs = discretizer.step(
-                input_activities=raw_input_activities,
-                n_inputs=self.n_inputs,
-                raw_val=sensors[i_sensor],
-            )
+
+        sensor_values = self.to_floats(sensors)
+        self.sensor_bank.step(sensor_values, raw_input_activities)
+        # Everything that isn't a finite number is a string category.
+        for i_sensor in np.where(np.logical_not(
+                np.isfinite(sensor_values)))[0]:
+            val, _ = classify(sensors[i_sensor])
+            string_cats = self.discretizers[i_sensor].string_cats
+            string_cats.add(val)
+            string_cats.categorize(val, raw_input_activities)
+
+        if self.timestep % self.split_frequency == 0:
+            # The trees need all their observations before they grow.
+            self.sensor_bank.flush()
+            for discretizer in self.discretizers:
+                self.n_inputs = discretizer.grow(
+                    self.n_inputs, max_n_inputs=self.max_n_inputs)
+            self.sensor_bank.rebuild()
+
         input_activities = tools.fatigue(
             raw_input_activities, self.input_energies)
 
@@ -101,3 +153,33 @@ class Preprocessor(object):
             self.input_energies = new_input_energies
 
         return input_activities[:self.n_inputs]
+
+    def to_floats(self, sensors):
+        """
+        Convert the sensor values to floats.
+
+        Parameters
+        ----------
+        sensors: list of floats, strings and/or stringifiable objects
+
+        Returns
+        -------
+        sensor_values: array of floats
+            The value of each sensor. Those that can't be converted
+            are not-a-number.
+        """
+        try:
+            sensor_values = np.asarray(sensors, dtype=float)
+            if sensor_values.shape == (self.n_sensors,):
+                return sensor_values
+        except (TypeError, ValueError):
+            pass
+        # There are some strings or other objects mixed in.
+        # Convert them one at a time.
+        sensor_values = np.full(self.n_sensors, np.nan)
+        for i_sensor in range(self.n_sensors):
+            try:
+                sensor_values[i_sensor] = float(sensors[i_sensor])
+            except (TypeError, ValueError):
+                pass
+        return sensor_values
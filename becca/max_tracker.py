@@ -0,0 +1,131 @@
+"""
+The MaxTracker class.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+import becca.ziptie_numba as nb
+
+
+class MaxTracker(object):
+    """
+    Keep track of the largest element of a 2D array as it changes.
+
+    The Ziptie needs to know the largest nucleation and agglomeration
+    energy on every time step, but only a few elements change
+    between steps. Rather than scan the whole array each time,
+    this keeps the maximum of each row and a tournament tree over
+    the rows. When an element increases, the gather kernels update
+    its row's maximum on the spot. The tree is then brought up to date
+    in log(n_rows) per changed row. When elements decrease, which only
+    happens when rows or columns are reset, the affected rows
+    are rescanned.
+
+    When several elements share the largest value, the one in the
+    earliest row wins, and within that row, the earliest column.
+
+    The array can also be the upper triangle of a symmetric array,
+    packed as described in ziptie_numba.packed_index.
+    Then only the part of each row above the diagonal is tracked.
+    """
+    def __init__(self, array2d, n_packed=None):
+        """
+        Parameters
+        ----------
+        array2d : 2D array of floats
+            The array to track. Everything is scanned once to start.
+        n_packed : int, optional
+            If given, array2d is the packed upper triangle of an
+            n_packed x n_packed array.
+        """
+        # n_packed : int or None
+        #     The number of rows of the packed array, or None if
+        #     the array isn't packed.
+        self.n_packed = n_packed
+        if n_packed is None:
+            n_rows = array2d.shape[0]
+        else:
+            n_rows = n_packed
+        # row_max : array of floats
+        #     The largest value in each row.
+        # row_argmax : array of ints
+        #     The column where each row's largest value is.
+        self.row_max = np.zeros(n_rows, dtype=array2d.dtype)
+        self.row_argmax = np.zeros(n_rows, dtype=int)
+        self._scan(array2d, np.arange(n_rows))
+        # tree : array of ints
+        #     A tournament tree over the rows. See
+        #     ziptie_numba.build_max_tree.
+        n_leaves = int(2 ** np.ceil(np.log2(max(n_rows, 1))))
+        self.tree = np.zeros(2 * n_leaves, dtype=int)
+        nb.build_max_tree(self.row_max, self.tree)
+
+    def max(self):
+        """
+        Find the largest value and where it is.
+
+        Returns
+        -------
+        max_val : float
+        i_row, i_col : int
+            The row and column of the largest value.
+        """
+        i_row = self.tree[1]
+        return self.row_max[i_row], i_row, self.row_argmax[i_row]
+
+    def update(self, i_rows):
+        """
+        Bring the tree up to date after the maxima of some rows increased.
+
+        Parameters
+        ----------
+        i_rows : array of ints
+            The rows that may have changed.
+        """
+        nb.update_max_tree(self.row_max, self.tree, i_rows)
+
+    def rescan(self, array2d, i_rows):
+        """
+        Find the maxima of some rows from scratch.
+
+        Parameters
+        ----------
+        array2d : 2D array of floats
+            The array being tracked.
+        i_rows : array of ints
+            The rows in which values may have decreased.
+        """
+        i_rows = np.asarray(i_rows, dtype=int)
+        self._scan(array2d, i_rows)
+        self.update(i_rows)
+
+    def rescan_cols(self, array2d, i_cols):
+        """
+        Update the row maxima after some columns have decreased.
+
+        Only the rows whose maximum was in one of the columns
+        need to be rescanned.
+
+        Parameters
+        ----------
+        array2d : 2D array of floats
+            The array being tracked.
+        i_cols : array of ints
+            The columns in which values may have decreased.
+        """
+        self.rescan(
+            array2d, np.where(np.isin(self.row_argmax, i_cols))[0])
+
+    def _scan(self, array2d, i_rows):
+        """
+        Find the maxima of some rows, without touching the tree.
+        """
+        if self.n_packed is None:
+            nb.find_row_maxima(
+                array2d, i_rows, self.row_max, self.row_argmax)
+        else:
+            nb.find_packed_row_maxima(
+                array2d, self.n_packed, i_rows,
+                self.row_max, self.row_argmax)
@@ -4,10 +4,14 @@ The Model class.
 
 from __future__ import print_function
 
+import numba
 import numpy as np
 
 import becca.model_numba as nb
 import becca.model_viz as viz
+import becca.tools as tools
+from becca.prefix_set import PrefixSet
+from becca.sparse_sequences import SparseSequences
 
 
 class Model(object):
@@ -40,7 +44,17 @@ class Model(object):
     be chained together to formulate multi-step plans while maximizing
     reward and prabability of successfully reaching the goal.
     """
-    def __init__(self, n_features, brain):
+    def __init__(
+        self,
+        n_features,
+        brain,
+        counter_dtype=None,
+        dtype=np.float64,
+        fused_step=False,
+        n_threads=1,
+        sequence_backend='dense',
+        initial_capacity=32,
+    ):
         """
         Get the Model set up by allocating its variables.
 
@@ -49,13 +63,43 @@ class Model(object):
         brain : Brain
             The Brain to which this model belongs. Some of the brain's
             parameters are useful in initializing the model.
+        counter_dtype : numpy dtype, optional
+            The floating point type of the prefix and sequence
+            occurrence counts. With np.float32, the dense sequence array
+            takes half the memory, and the counts are renormalized
+            from time to time so that they keep counting.
+            See _renormalize_counters. Default is np.float64.
+        dtype : numpy dtype
+            The floating point type of the prefix arrays.
+            np.float32 halves their memory and bandwidth.
+            Default is np.float64.
         n_features : int
             The total number of features allowed in this model.
+        fused_step : boolean
+            If True, update all the prefixes in a single pass through
+            memory each time step, rather than in a series of kernels
+            that each visit only the prefixes that can change.
+            This tends to be faster when a large fraction of
+            the features are active. Default is False.
+        n_threads : int
+            The number of threads to spread the model kernels across.
+            With more than one, the parallel variants of
+            the kernels are used. Default is 1.
+        sequence_backend : str
+            How to store sequence_occurrences, either 'dense' or 'sparse'.
+            The dense array takes N**3 memory up front. The sparse
+            store only grows as new sequences are observed.
+            Default is 'dense'.
+        initial_capacity : int
+            The number of features to make room for in the prefix
+            and sequence arrays at first. They grow as more features
+            come to life. Default is 32.
         """
         # n_features : int
         #     The maximum number of features that the model can expect
-        #     to incorporate. Knowing this allows the model to
-        #     pre-allocate all the data structures it will need.
+        #     to incorporate. The per-feature arrays are allocated
+        #     for all of them. The prefix and sequence arrays only grow
+        #     this large as features come to life. See capacity.
         #     Add 2 features/goals that are internal to the model,
         #     An "always on" and a "nothing else is on".
         self.n_features = n_features + 2
@@ -72,15 +116,16 @@ class Model(object):
         #     This helps determine which features to keep and which to
         #     swap out for new candidates.
         self.feature_fitness = np.zeros(self.n_features)
-
-        # filter: InputFilter
-        #     Reduce the possibly large number of inputs to the number
-        #     of cables that the Ziptie can handle. Each Ziptie will
-        #     have its own InputFilter.
-        self.filter = InputFilter(
-            n_inputs_final = self.n_inputs,
-            verbose=self.verbose,
-        )
+        # fitness_interval : int
+        #     How often, in time steps, calculate_fitness works the
+        #     fitness out afresh. Doing so takes a pass over every prefix
+        #     and sequence, and the featurizer only acts on fitness
+        #     over hundreds of time steps.
+        # fitness_timestep : int or None
+        #     The time step the fitness was last worked out on,
+        #     or None if it needs to be worked out on the next call.
+        self.fitness_interval = 2 ** 6
+        self.fitness_timestep = None
 
         # feature_goals,
         # previous_feature_goals,
@@ -105,7 +150,7 @@ class Model(object):
         # prefix_occurrences,
         # prefix_activities,
         # prefix_rewards : 2D array of floats
-        # sequence_occurrences : 3D array of floats
+        # sequence_occurrences : 3D array of floats or SparseSequences
         #     The properties associated with each sequence and prefix.
         #     If N is the number of features,
         #     the size of 2D arrays is N**2 and the shape of
@@ -116,17 +161,126 @@ class Model(object):
         #         index 2 : feature_2 (future)
         #     The prefix arrays can be 2D because they lack
         #     information about the resulting feature.
-        _2D_size = (self.n_features, self.n_features)
-        _3D_size = (self.n_features, self.n_features, self.n_features)
+        # capacity : int
+        #     The number of features there is currently room for in
+        #     the prefix and sequence arrays. Most features stay unborn
+        #     for a long time, so rather than allocate for all
+        #     n_features up front, the arrays start out small and are
+        #     doubled in size as new features come to life.
+        #     See _grow().
+        self.capacity = int(min(self.n_features, max(initial_capacity, 2)))
+        _2D_size = (self.capacity, self.capacity)
+        _3D_size = (self.capacity, self.capacity, self.capacity)
+        # dtype : numpy dtype
+        #     The precision of the prefix arrays.
+        # counter_dtype : numpy dtype
+        #     The precision of occurrence counts. Prefix and sequence
+        #     occurrences accumulate small increments over the lifetime
+        #     of the brain. A float32 sum stops growing once it gets
+        #     about 2**24 times larger than its increments.
+        # counter_limit : float
+        #     With float32 counts, the largest a prefix's occurrences
+        #     are allowed to grow before being renormalized. Increments
+        #     can be as small as .01, so this keeps the rounding error
+        #     on each one under a percent.
+        #     With float64 counts, there's no need and it is infinite.
+        # renormalize_interval : int
+        #     How often, in time steps, to check the counts against
+        #     counter_limit. A count grows by less than two per
+        #     time step, so it doesn't get far past the limit in between.
+        # n_renormalized : int
+        #     The number of times a prefix has been renormalized.
+        self.dtype = np.dtype(dtype)
+        if counter_dtype is None:
+            counter_dtype = np.float64
+        self.counter_dtype = np.dtype(counter_dtype)
+        if self.counter_dtype.itemsize < 8:
+            self.counter_limit = 2. ** 10
+        else:
+            self.counter_limit = np.inf
+        self.renormalize_interval = 2 ** 6
+        self.n_renormalized = 0
         # Making believe that everything has occurred once in the past
         # makes it easy to believe that it might happen again in the future.
-        self.prefix_activities = np.zeros(_2D_size)
-        self.prefix_credit = np.zeros(_2D_size)
-        self.prefix_occurrences = np.ones(_2D_size)
-        self.prefix_curiosities = np.zeros(_2D_size)
-        self.prefix_rewards = np.zeros(_2D_size)
-        self.prefix_uncertainties = np.zeros(_2D_size)
-        self.sequence_occurrences = np.ones(_3D_size)
+        self.prefix_activities = np.zeros(_2D_size, dtype=self.dtype)
+        self.prefix_credit = np.zeros(_2D_size, dtype=self.dtype)
+        # prefix_activity_steps,
+        # prefix_credit_steps : 2D array of ints
+        #     Prefix activity and credit decay a little on every time step.
+        #     Rather than sweep through all of them each time,
+        #     the decay is applied lazily. These record the time step
+        #     as of which each prefix's activity and credit are current.
+        #     The rest of the decay is applied the next time
+        #     it is read or written. Call settle() to bring
+        #     every prefix up to date.
+        self.prefix_activity_steps = np.zeros(_2D_size, dtype='int32')
+        self.prefix_credit_steps = np.zeros(_2D_size, dtype='int32')
+        self.prefix_occurrences = np.ones(
+            _2D_size, dtype=self.counter_dtype)
+        self.prefix_curiosities = np.zeros(_2D_size, dtype=self.dtype)
+        self.prefix_rewards = np.zeros(_2D_size, dtype=self.dtype)
+        self.prefix_uncertainties = np.zeros(_2D_size, dtype=self.dtype)
+        # sequence_backend : str
+        #     With a 'sparse' backend, only the sequences that
+        #     have been observed are stored. All the others hold the
+        #     initial value of one.
+        self.sequence_backend = sequence_backend
+        if self.sequence_backend == 'sparse':
+            self.sequence_occurrences = SparseSequences(
+                self.n_features, dtype=self.counter_dtype)
+        else:
+            self.sequence_occurrences = np.ones(
+                _3D_size, dtype=self.counter_dtype)
+        # sequence_values : 2D array of floats
+        #     The expected value of the sequences that follow each prefix.
+        self.sequence_values = np.zeros(_2D_size, dtype=self.dtype)
+        # use_sequence_values : boolean
+        #     If True, sequence values are included in the goal votes.
+        #     They are held out for now. While they are, they aren't
+        #     calculated either, since that takes a pass over every
+        #     sequence of every active feature.
+        self.use_sequence_values = False
+
+        # Feature activities and goals are sparse. Keeping track of
+        # which of them are non-zero lets the model kernels skip
+        # all the prefixes that can't change on a given time step.
+        # active_features,
+        # previous_active_features,
+        # active_goals : array of ints
+        #     The indices of live features with non-zero activity
+        #     on the current and previous time steps, and of
+        #     the live features with non-zero goals.
+        self.active_features = np.zeros(0, dtype='int32')
+        self.previous_active_features = np.zeros(0, dtype='int32')
+        self.active_goals = np.zeros(0, dtype='int32')
+        # active_prefixes,
+        # credited_prefixes : PrefixSet
+        #     The prefixes with enough activity to contribute
+        #     to sequences, and those with non-zero credit.
+        self.active_prefixes = PrefixSet(self.capacity)
+        self.credited_prefixes = PrefixSet(self.capacity)
+        # initialized_features : array of bools
+        #     True for each feature whose prefix uncertainties have
+        #     been calculated. This happens the first time it is live.
+        self.initialized_features = np.zeros(self.n_features, dtype=bool)
+        # fused_step : boolean
+        #     If True, use model_numba.step_prefixes to update
+        #     all the prefixes in one pass. Decay is applied eagerly,
+        #     and prefix uncertainties are only calculated when needed.
+        self.fused_step = fused_step
+        # n_threads : int
+        #     The number of threads the parallel kernels can use.
+        #     This can't be more than numba was configured for.
+        self.n_threads = int(max(1, min(
+            n_threads, numba.config.NUMBA_NUM_THREADS)))
+        self.parallel = self.n_threads > 1
+        # live_features : array of ints
+        #     The indices of the live features as of the latest time step,
+        #     including the two internal features.
+        self.live_features = np.zeros(0, dtype='int32')
+        # timestep : int
+        #     The number of time steps the model has taken.
+        self.timestep = 0
 
         # prefix_decay_rate : float
         #     The rate at which prefix activity decays between time steps
@@ -146,18 +300,140 @@ class Model(object):
         #     a prefix increases its curiosity.
         self.curiosity_update_rate = 3e-3
 
-    def calculate_fitness():
+    def calculate_fitness(self):
+        """
+        Find how useful each feature has been to the model.
+
+        The fitness is only worked out every fitness_interval time steps,
+        and after features are reset. In between, the last values
+        are returned.
 
-        pass
+        Returns
+        -------
+        feature_fitness : array of floats
+            See model_numba.update_fitness.
+        """
+        if (self.fitness_timestep is not None and
+                self.timestep - self.fitness_timestep < self.fitness_interval):
+            return self.feature_fitness
+        self.fitness_timestep = self.timestep
+        # Fitness doesn't depend on credit, so leave its decay deferred.
+        self._settle_prefixes()
+        if self.sequence_backend == 'sparse':
+            max_sequence_occurrences = (
+                self.sequence_occurrences.max_postfeature(self.capacity))
+        else:
+            max_sequence_occurrences = np.max(
+                self.sequence_occurrences, axis=2)
+        nb.update_fitness(
+            self.feature_fitness[:self.capacity],
+            self.prefix_occurrences,
+            self.prefix_rewards,
+            self.prefix_uncertainties,
+            max_sequence_occurrences)
+        if self.capacity < self.n_features:
+            # The prefixes that haven't been allocated yet
+            # are all still at their initial values,
+            # which work out to a fitness of one.
+            self.feature_fitness[:self.capacity] = np.maximum(
+                self.feature_fitness[:self.capacity], 1.)
+            self.feature_fitness[self.capacity:] = 1.
+        return self.feature_fitness
+
+    def settle(self):
+        """
+        Apply all the lazily deferred decay to prefix activities and credit.
+
+        After this, prefix_activities, prefix_occurrences,
+        prefix_uncertainties and prefix_credit are all current and
+        can be read directly.
+        """
+        self._settle_prefixes()
+        if self.fused_step:
+            return
+        nb.settle_credit(
+            self.live_features,
+            self.timestep,
+            self.credit_decay_rate,
+            self.prefix_credit,
+            self.prefix_credit_steps)
 
-    def update_inputs(self):
+    def _settle_prefixes(self):
         """
-        Propogate feature resets, 
+        Apply the lazily deferred decay to prefix activities only.
+
+        After this, prefix_activities, prefix_occurrences and
+        prefix_uncertainties are current. See settle.
+        """
+        if self.fused_step:
+            # Everything but the uncertainties is already current.
+            live = np.ix_(self.live_features, self.live_features)
+            self.prefix_uncertainties[live] = 1. / (
+                1. + 3. * self.prefix_occurrences[live])
+            return
+        nb.settle_prefix_rows(
+            self.live_features,
+            self.live_features,
+            self.timestep,
+            self.prefix_decay_rate,
+            self.prefix_activities,
+            self.prefix_activity_steps,
+            self.prefix_occurrences,
+            self.prefix_uncertainties)
+
+    def update_inputs(self, feature_resets):
+        """
+        Forget everything learned about features that have been reset.
+
+        A reset feature has been taken over by a new one, such as
+        a recycled bundle. Every prefix and sequence it takes part in
+        goes back to its initial value.
+
+        Parameters
+        ----------
+        feature_resets : array of ints
+            The indices of the reset features, as passed in to step.
         """
-        pass
+        features = np.asarray(feature_resets, dtype=int) + 2
+        self.feature_activities[features] = 0.
+        self.feature_goal_activities[features] = 0.
+        # Work the fitness out afresh on the next call,
+        # so the reset features don't keep their old fitness.
+        self.fitness_timestep = None
+        # The rest of the arrays haven't been grown to hold
+        # features beyond the capacity yet.
+        features = features[features < self.capacity]
+        if features.size == 0:
+            return
+        self.settle()
+        for prefix_array in (
+            self.prefix_activities,
+            self.prefix_credit,
+            self.prefix_curiosities,
+            self.prefix_rewards,
+            self.sequence_values,
+        ):
+            prefix_array[features, :] = 0.
+            prefix_array[:, features] = 0.
+        for prefix_steps in (
+            self.prefix_activity_steps,
+            self.prefix_credit_steps,
+        ):
+            prefix_steps[features, :] = self.timestep
+            prefix_steps[:, features] = self.timestep
+        self.prefix_occurrences[features, :] = 1.
+        self.prefix_occurrences[:, features] = 1.
+        self.prefix_uncertainties[features, :] = 1. / (
+            1. + 3. * self.prefix_occurrences[features, :])
+        self.prefix_uncertainties[:, features] = 1. / (
+            1. + 3. * self.prefix_occurrences[:, features])
+        if self.sequence_backend == 'sparse':
+            self.sequence_occurrences.reset_features(features)
+        else:
+            self.sequence_occurrences[features, :, :] = 1.
+            self.sequence_occurrences[:, features, :] = 1.
+            self.sequence_occurrences[:, :, features] = 1.
 
-    # TODO: Write a method to handle feature resets
-    
     def step(self, feature_activities, brain_live_features, reward):
         """
         Update the model and choose a new goal.
@@ -171,74 +447,250 @@ class Model(object):
         reward : float
             The reward reported by the world during the most recent time step.
         """
+        self.timestep += 1
+        if self.parallel:
+            numba.set_num_threads(self.n_threads)
         # TODO: Remove live_features. Assume all are live.
         live_features = self._update_activities(
             feature_activities, brain_live_features)
 
         # Update sequences before prefixes.
-        nb.update_sequences(
-            live_features,
-            self.FAIs,
-            self.prefix_activities,
-            self.sequence_occurrences)
+        if self.sequence_backend == 'sparse':
+            self.sequence_occurrences.update(self, live_features)
+        else:
+            if self.parallel:
+                update_sequences = nb.update_sequences_parallel
+            else:
+                update_sequences = nb.update_sequences
+            update_sequences(
+                self.active_prefixes.features,
+                self.active_prefixes.goals,
+                self.active_prefixes.n_members,
+                live_features,
+                self.FAIs,
+                self.timestep,
+                self.prefix_decay_rate,
+                self.prefix_activities,
+                self.prefix_activity_steps,
+                self.sequence_occurrences)
+
+        if self.fused_step:
+            self._step_prefixes_fused(live_features, reward)
+        else:
+            self._step_prefixes(live_features, reward)
+
+        if (np.isfinite(self.counter_limit) and
+                self.timestep % self.renormalize_interval == 0):
+            self._renormalize_counters()
 
-        nb.update_prefixes(
-            live_features,
+        # TODO: break this out into a separate object.
+        goal_index, max_vote = self._choose_feature_goals()
+
+        if self.fused_step:
+            nb.add_goal_credit(
+                self.active_features,
+                goal_index,
+                max_vote,
+                self.feature_activities,
+                self.prefix_credit)
+            # Trim off the first two elements.
+            # They are internal to the model only.
+            return self.feature_goal_activities[2:]
+
+        self.credited_prefixes.reserve(self.active_features.size)
+        self.credited_prefixes.n_members = nb.update_reward_credit(
+            self.credited_prefixes.features,
+            self.credited_prefixes.goals,
+            self.credited_prefixes.n_members,
+            self.credited_prefixes.mask,
+            self.active_features,
+            goal_index,
+            max_vote,
+            self.feature_activities,
+            self.timestep,
+            self.credit_decay_rate,
+            self.prefix_credit,
+            self.prefix_credit_steps)
+
+        # Trim off the first two elements. The are internal to the model only.
+        return self.feature_goal_activities[2:]
+
+
+    def _step_prefixes(self, live_features, reward):
+        """
+        Update prefixes, rewards and curiosities, and collect goal votes.
+
+        This version runs each update in a separate kernel that
+        visits only the prefixes that can change.
+
+        Parameters
+        ----------
+        live_features : array of ints
+            The indices of live features, including the two internal ones.
+        reward : float
+            The reward reported by the world during the most recent time step.
+        """
+        self.active_prefixes.reserve(
+            self.previous_active_features.size * self.active_goals.size)
+        self.active_prefixes.n_members = nb.update_prefixes(
+            self.active_prefixes.features,
+            self.active_prefixes.goals,
+            self.active_prefixes.n_members,
+            self.active_prefixes.mask,
+            self.previous_active_features,
+            self.active_goals,
+            self.timestep,
             self.prefix_decay_rate,
             self.previous_feature_activities,
             self.feature_goal_activities,
             self.prefix_activities,
+            self.prefix_activity_steps,
             self.prefix_occurrences,
             self.prefix_uncertainties)
-
-        nb.update_rewards(
+        # The curiosity and sequence value of active features' prefixes
+        # depend on up-to-date uncertainties and occurrences.
+        if self.parallel:
+            settle_prefix_rows = nb.settle_prefix_rows_parallel
+            update_curiosities = nb.update_curiosities_parallel
+            calculate_goal_votes = nb.calculate_goal_votes_parallel
+        else:
+            settle_prefix_rows = nb.settle_prefix_rows
+            update_curiosities = nb.update_curiosities
+            calculate_goal_votes = nb.calculate_goal_votes
+        settle_prefix_rows(
+            self.active_features,
             live_features,
+            self.timestep,
+            self.prefix_decay_rate,
+            self.prefix_activities,
+            self.prefix_activity_steps,
+            self.prefix_occurrences,
+            self.prefix_uncertainties)
+
+        self.credited_prefixes.n_members = nb.update_rewards(
+            self.credited_prefixes.features,
+            self.credited_prefixes.goals,
+            self.credited_prefixes.n_members,
+            self.credited_prefixes.mask,
+            self.timestep,
+            self.credit_decay_rate,
             self.reward_update_rate,
             reward,
             self.prefix_credit,
+            self.prefix_credit_steps,
             self.prefix_rewards)
 
-        nb.update_curiosities(
+        is_active = np.zeros(self.n_features, dtype=bool)
+        is_active[self.active_features] = True
+        update_curiosities(
             live_features,
+            self.active_features,
+            self.previous_active_features,
+            self.active_goals,
+            is_active,
             self.curiosity_update_rate,
-            self.prefix_occurrences,
             self.prefix_curiosities,
             self.previous_feature_activities,
             self.feature_activities,
             self.feature_goal_activities,
             self.prefix_uncertainties)
 
-        nb.update_fitness(
-            self.feature_fitness,
-            self.prefix_occurrences,
-            self.prefix_rewards,
-            self.prefix_uncertainties,
-            self.sequence_occurrences)
-
-        self.feature_goal_votes = nb.calculate_goal_votes(
+        if self.use_sequence_values:
+            self._update_sequence_values(live_features)
+        self.feature_goal_votes = calculate_goal_votes(
             self.n_features,
+            self.active_features,
             live_features,
             self.prefix_rewards,
             self.prefix_curiosities,
-            self.prefix_occurrences,
-            self.sequence_occurrences,
+            self.sequence_values,
             self.feature_activities,
-            self.feature_goal_activities)
-
-        # TODO: break this out into a separate object.
-        goal_index, max_vote = self._choose_feature_goals()
+            self.use_sequence_values,
+            self.n_threads)
 
-        nb.update_reward_credit(
-            live_features,
-            goal_index,
-            max_vote,
-            self.feature_activities,
-            self.credit_decay_rate,
-            self.prefix_credit)
+    def _step_prefixes_fused(self, live_features, reward):
+        """
+        Update prefixes, rewards and curiosities, and collect goal votes.
 
-        # Trim off the first two elements. The are internal to the model only.
-        return self.feature_goal_activities[2:]
+        This version makes a single pass over all the live prefixes.
+        See model_numba.step_prefixes.
 
+        Parameters
+        ----------
+        live_features : array of ints
+            The indices of live features, including the two internal ones.
+        reward : float
+            The reward reported by the world during the most recent time step.
+        """
+        self.feature_goal_votes = np.zeros(self.n_features)
+        if self.parallel:
+            nb.step_prefixes_parallel(
+                live_features,
+                self.timestep,
+                self.prefix_decay_rate,
+                self.credit_decay_rate,
+                self.reward_update_rate,
+                self.curiosity_update_rate,
+                reward,
+                self.previous_feature_activities,
+                self.feature_activities,
+                self.feature_goal_activities,
+                self.prefix_activities,
+                self.prefix_activity_steps,
+                self.prefix_occurrences,
+                self.prefix_credit,
+                self.prefix_rewards,
+                self.prefix_curiosities,
+                self.feature_goal_votes,
+                self.n_threads)
+            n_prefixes = nb.collect_active_prefixes(
+                live_features,
+                self.prefix_activities,
+                self.active_prefixes.features,
+                self.active_prefixes.goals)
+        else:
+            n_prefixes = nb.step_prefixes(
+                live_features,
+                self.timestep,
+                self.prefix_decay_rate,
+                self.credit_decay_rate,
+                self.reward_update_rate,
+                self.curiosity_update_rate,
+                reward,
+                self.previous_feature_activities,
+                self.feature_activities,
+                self.feature_goal_activities,
+                self.prefix_activities,
+                self.prefix_activity_steps,
+                self.prefix_occurrences,
+                self.prefix_credit,
+                self.prefix_rewards,
+                self.prefix_curiosities,
+                self.active_prefixes.features,
+                self.active_prefixes.goals,
+                self.feature_goal_votes)
+        if n_prefixes > self.active_prefixes.size:
+            self.active_prefixes.reserve(n_prefixes)
+            n_prefixes = nb.collect_active_prefixes(
+                live_features,
+                self.prefix_activities,
+                self.active_prefixes.features,
+                self.active_prefixes.goals)
+        self.active_prefixes.n_members = n_prefixes
+        if self.use_sequence_values:
+            # The fused pass leaves sequence values out of the vote.
+            # Everything else is current now, so re-collect the votes
+            # with them included.
+            self._update_sequence_values(live_features)
+            self.feature_goal_votes = nb.calculate_goal_votes(
+                self.n_features,
+                self.active_features,
+                live_features,
+                self.prefix_rewards,
+                self.prefix_curiosities,
+                self.sequence_values,
+                self.feature_activities,
+                True)
 
     def _update_activities(self, feature_activities, brain_live_features):
         """
@@ -264,6 +716,26 @@ class Model(object):
         live_features = list(live_features)
         live_features = [0, 1] + live_features
         live_features = np.array(live_features).astype('int32')
+        self.live_features = live_features
+
+        # Prefixes of newly live features need their uncertainties set.
+        new_features = live_features[
+            ~self.initialized_features[live_features]]
+        if new_features.size > 0:
+            self._grow(np.max(new_features) + 1)
+            self.initialized_features[new_features] = True
+            nb.initialize_prefixes(
+                new_features,
+                live_features,
+                self.prefix_occurrences,
+                self.prefix_uncertainties)
+
+        # Find the features and goals that are non-zero.
+        self.previous_active_features = self.active_features
+        self.active_features = live_features[np.where(
+            self.feature_activities[live_features] != 0.)[0]]
+        self.active_goals = live_features[np.where(
+            self.feature_goal_activities[live_features] != 0.)[0]]
 
         # No need to filter here. Filtering occurs in preprocessor.
         # TODO: change from FAIs to feature activities
@@ -279,6 +751,123 @@ class Model(object):
         return live_features
 
 
+    def _grow(self, n_needed):
+        """
+        Make room for at least n_needed features in the prefix
+        and sequence arrays.
+
+        The capacity is doubled until it is big enough, up to
+        n_features. Doubling keeps the total cost of copying
+        proportional to the final size of the arrays.
+
+        Parameters
+        ----------
+        n_needed : int
+            One more than the largest feature index that needs
+            to be stored.
+        """
+        if n_needed <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < n_needed:
+            capacity *= 2
+        self.capacity = min(capacity, self.n_features)
+
+        size = self.capacity
+        self.prefix_activities = tools.pad(
+            self.prefix_activities, [size, size], dtype=self.dtype)
+        self.prefix_credit = tools.pad(
+            self.prefix_credit, [size, size], dtype=self.dtype)
+        self.prefix_activity_steps = tools.pad(
+            self.prefix_activity_steps, [size, size], val=0,
+            dtype='int32')
+        self.prefix_credit_steps = tools.pad(
+            self.prefix_credit_steps, [size, size], val=0, dtype='int32')
+        self.prefix_occurrences = tools.pad(
+            self.prefix_occurrences, [size, size], val=1.,
+            dtype=self.counter_dtype)
+        self.prefix_curiosities = tools.pad(
+            self.prefix_curiosities, [size, size], dtype=self.dtype)
+        self.prefix_rewards = tools.pad(
+            self.prefix_rewards, [size, size], dtype=self.dtype)
+        self.prefix_uncertainties = tools.pad(
+            self.prefix_uncertainties, [size, size], dtype=self.dtype)
+        self.sequence_values = tools.pad(
+            self.sequence_values, [size, size], dtype=self.dtype)
+        if self.sequence_backend != 'sparse':
+            self.sequence_occurrences = tools.pad(
+                self.sequence_occurrences, [size, size, size], val=1.,
+                dtype=self.counter_dtype)
+        self.active_prefixes.grow(size)
+        self.credited_prefixes.grow(size)
+
+    def _renormalize_counters(self):
+        """
+        Keep reduced-precision occurrence counts small enough to grow.
+
+        Every prefix whose occurrences have passed counter_limit has
+        the part of its count above the initial value of one halved.
+        So does each of its sequences. A sequence can't occur more
+        often than its prefix, so this keeps every count below about
+        counter_limit. The ratio of sequence to prefix occurrences,
+        which the model's predictions are built on, hardly changes.
+        It does come to weight the latest observations a little more
+        heavily than the older ones, like a slowly decaying average.
+        Uncertainties are already close to zero at these counts.
+        """
+        self._settle_prefixes()
+        renormalize = self.prefix_occurrences > self.counter_limit
+        i_features, i_goals = np.where(renormalize)
+        if i_features.size == 0:
+            return
+        occurrences = self.prefix_occurrences[i_features, i_goals]
+        occurrences = 1. + .5 * (occurrences - 1.)
+        self.prefix_occurrences[i_features, i_goals] = occurrences
+        self.prefix_uncertainties[i_features, i_goals] = 1. / (
+            1. + 3. * occurrences)
+        if self.sequence_backend == 'sparse':
+            self.sequence_occurrences.renormalize(renormalize)
+        else:
+            self.sequence_occurrences[i_features, i_goals, :] = 1. + .5 * (
+                self.sequence_occurrences[i_features, i_goals, :] - 1.)
+        self.n_renormalized += i_features.size
+
+    def _update_sequence_values(self, live_features):
+        """
+        Find the expected value of the sequences following each prefix.
+
+        Parameters
+        ----------
+        live_features : array of ints
+            The indices of features that have had some activity
+            in their lifetime, including the two internal features.
+        """
+        if self.sequence_backend == 'sparse':
+            nb.calculate_sparse_sequence_values(
+                live_features,
+                self.prefix_occurrences,
+                self.sequence_occurrences.keys,
+                self.sequence_occurrences.values,
+                self.n_features,
+                self.sequence_occurrences.default,
+                self.feature_activities,
+                self.feature_goal_activities,
+                self.sequence_values)
+        else:
+            if self.parallel:
+                calculate_sequence_values = (
+                    nb.calculate_sequence_values_parallel)
+            else:
+                calculate_sequence_values = nb.calculate_sequence_values
+            calculate_sequence_values(
+                live_features,
+                self.prefix_occurrences,
+                self.sequence_occurrences,
+                self.feature_activities,
+                self.feature_goal_activities,
+                self.sequence_values)
+
+
     def _choose_feature_goals(self):
         """
         Using the feature_goal_votes, choose a goal.
@@ -307,4 +896,5 @@ class Model(object):
         brain : Brain
             The brain that this model belongs to.
         """
+        self.settle()
         viz.visualize(self, brain)
@@ -0,0 +1,217 @@
+"""
+The ModelBatch class.
+"""
+
+from __future__ import print_function
+
+import numba
+import numpy as np
+
+import becca.model_numba as nb
+
+
+class ModelBatch(object):
+    """
+    A batch of independent models that step together.
+
+    Running many brains side by side, for a parameter sweep or a fleet
+    of robots, with a Python loop over Model.step pays the Python and
+    kernel dispatch overhead once per model per step. A ModelBatch
+    stacks the prefix and sequence arrays of B models along a leading
+    axis and steps all of them with one kernel call per stage.
+
+    Each model in the batch behaves like a Model with fused_step=True
+    and the dense sequence backend. It is given the same activities,
+    live features and reward, and it makes the same choices.
+    The only exception is how ties between goal votes are broken.
+    Models in a batch don't share any learning.
+    """
+    def __init__(
+        self,
+        n_models,
+        n_features,
+        dtype=np.float64,
+        n_threads=1,
+    ):
+        """
+        Allocate the stacked arrays.
+
+        Parameters
+        ----------
+        n_models : int
+            The number of models in the batch, B.
+        n_features : int
+            The number of features in each model, not including
+            the two internal ones.
+        dtype : numpy dtype
+            The floating point type of the prefix arrays. See Model.dtype.
+        n_threads : int
+            The number of threads to spread the models across.
+            Default is 1.
+        """
+        # n_models : int
+        #     The number of models stepping together.
+        self.n_models = n_models
+        # n_features : int
+        #     The number of features in each model, including
+        #     the two that are internal to the model. See Model.n_features.
+        self.n_features = n_features + 2
+        # dtype,
+        # counter_dtype : numpy dtype
+        #     See Model.dtype and Model.counter_dtype.
+        self.dtype = np.dtype(dtype)
+        self.counter_dtype = np.dtype(np.float64)
+        # n_threads : int
+        #     The number of threads for the parallel kernels.
+        self.n_threads = int(max(1, min(
+            n_threads, numba.config.NUMBA_NUM_THREADS)))
+        self.parallel = self.n_threads > 1
+
+        _1D_size = (self.n_models, self.n_features)
+        _2D_size = (self.n_models, self.n_features, self.n_features)
+        _3D_size = (self.n_models, self.n_features, self.n_features,
+                    self.n_features)
+        # All of these are the same as their counterparts in Model,
+        # with one more leading axis for the model.
+        self.previous_feature_activities = np.zeros(_1D_size)
+        self.feature_activities = np.zeros(_1D_size)
+        self.feature_goal_activities = np.zeros(_1D_size)
+        self.feature_goal_votes = np.zeros(_1D_size)
+        self.FAIs = np.zeros(_1D_size)
+        self.prefix_activities = np.zeros(_2D_size, dtype=self.dtype)
+        self.prefix_activity_steps = np.zeros(_2D_size, dtype='int32')
+        self.prefix_credit = np.zeros(_2D_size, dtype=self.dtype)
+        self.prefix_occurrences = np.ones(
+            _2D_size, dtype=self.counter_dtype)
+        self.prefix_curiosities = np.zeros(_2D_size, dtype=self.dtype)
+        self.prefix_rewards = np.zeros(_2D_size, dtype=self.dtype)
+        self.sequence_occurrences = np.ones(
+            _3D_size, dtype=self.counter_dtype)
+        # live_mask : 2D array of bools
+        #     For each model, True for its live features,
+        #     including the two internal ones.
+        self.live_mask = np.zeros(_1D_size, dtype=bool)
+
+        # timestep : int
+        #     The number of time steps the models have taken.
+        self.timestep = 0
+        # See Model for descriptions of these.
+        self.prefix_decay_rate = .5
+        self.credit_decay_rate = .35
+        self.reward_update_rate = 3e-2
+        self.curiosity_update_rate = 3e-3
+
+    def step(self, feature_activities, brain_live_features, rewards):
+        """
+        Update every model and choose a new goal for each.
+
+        Parameters
+        ----------
+        feature_activities : 2D array of floats
+            The current activity levels of each model's features,
+            one row per model.
+        brain_live_features : 2D array of bools
+            For each model, True for each feature that has ever
+            been active. If None, all features are live.
+        rewards : array of floats
+            The reward reported to each model during the most recent
+            time step.
+
+        Returns
+        -------
+        feature_goals : 2D array of floats
+            The goals chosen for each model, one row per model.
+        """
+        self.timestep += 1
+        if self.parallel:
+            numba.set_num_threads(self.n_threads)
+            update_sequences = nb.update_sequences_batch_parallel
+            step_prefixes = nb.step_prefixes_batch_parallel
+            add_goal_credit = nb.add_goal_credit_batch_parallel
+        else:
+            update_sequences = nb.update_sequences_batch
+            step_prefixes = nb.step_prefixes_batch
+            add_goal_credit = nb.add_goal_credit_batch
+        rewards = np.asarray(rewards, dtype=float)
+
+        self._update_activities(feature_activities, brain_live_features)
+        update_sequences(
+            self.live_mask,
+            self.FAIs,
+            self.prefix_activities,
+            self.sequence_occurrences)
+
+        self.feature_goal_votes = np.zeros(
+            (self.n_models, self.n_features))
+        step_prefixes(
+            self.live_mask,
+            self.timestep,
+            self.prefix_decay_rate,
+            self.credit_decay_rate,
+            self.reward_update_rate,
+            self.curiosity_update_rate,
+            rewards,
+            self.previous_feature_activities,
+            self.feature_activities,
+            self.feature_goal_activities,
+            self.prefix_activities,
+            self.prefix_activity_steps,
+            self.prefix_occurrences,
+            self.prefix_credit,
+            self.prefix_rewards,
+            self.prefix_curiosities,
+            self.feature_goal_votes)
+
+        goal_indices, max_votes = self._choose_feature_goals()
+        add_goal_credit(
+            self.live_mask,
+            goal_indices,
+            max_votes,
+            self.feature_activities,
+            self.prefix_credit)
+
+        # Trim off the first two columns. They are internal to the model.
+        return self.feature_goal_activities[:, 2:]
+
+    def _update_activities(self, feature_activities, brain_live_features):
+        """
+        Calculate the change in feature activities for every model.
+
+        See Model._update_activities.
+        """
+        self.previous_feature_activities = self.feature_activities
+        self.feature_activities = np.concatenate((
+            np.zeros((self.n_models, 2)), feature_activities), axis=1)
+        # The two internal features are always live.
+        self.live_mask[:, :2] = True
+        if brain_live_features is None:
+            self.live_mask[:, 2:] = True
+        else:
+            self.live_mask[:, 2:] = brain_live_features
+
+        self.FAIs = np.maximum(
+            self.feature_activities - self.previous_feature_activities, 0.)
+        self.FAIs[:, 0] = 1.
+        total_activity = np.sum(self.FAIs[:, 2:], axis=1)
+        self.FAIs[:, 1] = np.maximum(1. - total_activity, 0.)
+
+    def _choose_feature_goals(self):
+        """
+        Choose the goal with the largest vote for each model.
+
+        Ties are broken at random.
+
+        Returns
+        -------
+        goal_indices : array of ints
+        max_votes : array of floats
+        """
+        max_votes = np.max(self.feature_goal_votes, axis=1)
+        is_max = self.feature_goal_votes == max_votes[:, np.newaxis]
+        goal_indices = np.argmax(
+            is_max * (1. + np.random.random_sample(is_max.shape)), axis=1)
+        self.feature_goal_activities = np.zeros(
+            (self.n_models, self.n_features))
+        self.feature_goal_activities[
+            np.arange(self.n_models), goal_indices] = 1.
+        return goal_indices, max_votes
@@ -0,0 +1,187 @@
+"""
+Time Model.step across feature counts and thread counts.
+
+Run it from the command line to see how much the parallel kernels
+and batching help on the current machine:
+
+    python -m becca.model_benchmark
+"""
+
+from __future__ import print_function
+import time
+
+import numba
+import numpy as np
+
+from becca.model import Model
+from becca.model_batch import ModelBatch
+
+
+def time_step(
+    n_features,
+    n_threads=1,
+    fused_step=True,
+    n_active=8,
+    n_steps=50,
+    dtype=np.float64,
+    sequence_backend='dense',
+    counter_dtype=None,
+):
+    """
+    Find the average time it takes a Model to step.
+
+    Parameters
+    ----------
+    n_features : int
+        The number of features in the model.
+    n_threads : int
+        The number of threads the model kernels can use.
+    fused_step : boolean
+        Whether to use the fused prefix kernel. See Model.fused_step.
+    n_active : int
+        The number of features that are active on each time step.
+    n_steps : int
+        The number of time steps to average over.
+    dtype : numpy dtype
+        The precision of the model's prefix arrays. See Model.dtype.
+    sequence_backend : str
+        How the model stores sequences. See Model.sequence_backend.
+    counter_dtype : numpy dtype, optional
+        The precision of the occurrence counts. See Model.counter_dtype.
+
+    Returns
+    -------
+    seconds_per_step : float
+    """
+    model = Model(
+        n_features, None, fused_step=fused_step, n_threads=n_threads,
+        dtype=dtype, counter_dtype=counter_dtype,
+        sequence_backend=sequence_backend)
+    live_features = np.arange(n_features)
+    rng = np.random.RandomState(0)
+
+    def step():
+        feature_activities = np.zeros(n_features)
+        active = rng.choice(n_features, size=n_active, replace=False)
+        feature_activities[active] = rng.random_sample(n_active)
+        model.step(feature_activities, live_features, rng.random_sample())
+
+    # The first step includes compilation. Leave it out of the timing.
+    step()
+    start = time.time()
+    for _ in range(n_steps):
+        step()
+    return (time.time() - start) / n_steps
+
+
+def time_batch_step(
+    n_models,
+    n_features,
+    n_threads=1,
+    n_active=8,
+    n_steps=50,
+    dtype=np.float64,
+):
+    """
+    Find the average time it takes each model in a ModelBatch to step.
+
+    Parameters
+    ----------
+    n_models : int
+        The number of models in the batch.
+    Other parameters are described in time_step.
+
+    Returns
+    -------
+    seconds_per_model_step : float
+        The time for the whole batch to step, divided by n_models.
+    """
+    batch = ModelBatch(n_models, n_features, dtype=dtype, n_threads=n_threads)
+    rng = np.random.RandomState(0)
+
+    # Make up the inputs ahead of time, so that generating them
+    # one model at a time doesn't count against the batch.
+    all_activities = np.zeros((n_steps + 1, n_models, n_features))
+    for activities in all_activities:
+        for i_model in range(n_models):
+            active = rng.choice(n_features, size=n_active, replace=False)
+            activities[i_model, active] = rng.random_sample(n_active)
+    all_rewards = rng.random_sample((n_steps + 1, n_models))
+
+    # The first step includes compilation. Leave it out of the timing.
+    batch.step(all_activities[0], None, all_rewards[0])
+    start = time.time()
+    for i_step in range(1, n_steps + 1):
+        batch.step(all_activities[i_step], None, all_rewards[i_step])
+    return (time.time() - start) / (n_steps * n_models)
+
+
+def run_batch(
+    n_features_list=(16, 32, 64),
+    n_models=64,
+    n_threads=1,
+):
+    """
+    Print a table comparing separate Models with a ModelBatch.
+
+    Parameters
+    ----------
+    n_features_list : list of ints
+        The feature counts to try.
+    n_models : int
+        The number of models in the batch.
+    n_threads : int
+        The number of threads for the batch to use.
+    """
+    print(' '.join(['n_features', '  Model (steps/s)',
+                    '  batch (steps/s)', '   speedup']))
+    for n_features in n_features_list:
+        separate = time_step(n_features, fused_step=True)
+        batched = time_batch_step(n_models, n_features, n_threads)
+        print(' '.join([
+            '{0:>10}'.format(n_features),
+            '{0:>17.0f}'.format(1. / separate),
+            '{0:>17.0f}'.format(1. / batched),
+            '{0:>10.2f}'.format(separate / batched)]))
+
+
+def run(
+    n_features_list=(64, 128, 256, 512),
+    n_threads_list=None,
+    fused_step=True,
+    dtype=np.float64,
+):
+    """
+    Print a table of Model.step times and the speedup from threading.
+
+    Parameters
+    ----------
+    n_features_list : list of ints
+        The feature counts to try.
+    n_threads_list : list of ints
+        The thread counts to try. By default, 1 and every power of two
+        up to the number of threads numba was configured for.
+    fused_step : boolean
+        Whether to use the fused prefix kernel.
+    dtype : numpy dtype
+        The precision of the model's prefix arrays.
+    """
+    if n_threads_list is None:
+        n_threads_list = [1]
+        while n_threads_list[-1] * 2 <= numba.config.NUMBA_NUM_THREADS:
+            n_threads_list.append(n_threads_list[-1] * 2)
+
+    print(' '.join(['n_features'] + [
+        '{0:>12}'.format('{0} thr (ms)'.format(n_threads))
+        for n_threads in n_threads_list] + ['   speedup']))
+    for n_features in n_features_list:
+        times = [time_step(n_features, n_threads, fused_step, dtype=dtype)
+                 for n_threads in n_threads_list]
+        print(' '.join(['{0:>10}'.format(n_features)] + [
+            '{0:>12.3f}'.format(1e3 * step_time) for step_time in times] + [
+                '{0:>10.2f}'.format(times[0] / min(times))]))
+
+
+if __name__ == '__main__':
+    run()
+    run_batch()
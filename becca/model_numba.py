@@ -1,17 +1,29 @@
 """
 Numba functions that support model.py
+
+Kernels with a *_parallel variant spread their outer loop across
+threads with prange. The two variants are compiled from the same
+Python function. Without parallel=True, prange acts just like range.
+Loops are only parallelized where each iteration writes to a separate
+set of elements, so there are no write races.
 """
 
 from __future__ import print_function
-from numba import jit
+from numba import jit, prange
 import numpy as np
 
 
 @jit(nopython=True)
 def update_sequences(
-    live_features,
+    prefix_features,
+    prefix_goals,
+    n_prefixes,
+    postfeatures,
     new_FAIs,
+    timestep,
+    prefix_decay_rate,
     prefix_activities,
+    prefix_activity_steps,
     sequence_occurrences,
 ):
     """
@@ -22,30 +34,220 @@ def update_sequences(
     p is the prefix activities from the previous time step and
     f is the new_FAIs
 
+    Only the prefixes in the active prefix set and the postfeatures
+    with non-zero FAIs can contribute.
+
     These are temporarily disabled, since they haven't proven themselves
     absolutely necessary yet.
     """
     small = .1
-    for j_feature in live_features:
+    # Each postfeature writes to its own set of sequences.
+    for i_postfeature in prange(postfeatures.size):
+        j_feature = postfeatures[i_postfeature]
         if new_FAIs[j_feature] < small:
             continue
+        for i_prefix in range(n_prefixes):
+            i_feature = prefix_features[i_prefix]
+            i_goal = prefix_goals[i_prefix]
+            prefix_activity = _decayed(
+                prefix_activities[i_feature][i_goal],
+                prefix_decay_rate,
+                timestep - 1 - prefix_activity_steps[i_feature][i_goal])
+            if prefix_activity < small:
+                continue
+            sequence_occurrences[i_feature][i_goal][j_feature] += (
+                prefix_activity * new_FAIs[j_feature])
+    return
+
+
+update_sequences_parallel = jit(nopython=True, parallel=True)(
+    update_sequences.py_func)
+
+
+@jit(nopython=True)
+def _decayed(value, decay_rate, n_steps):
+    """
+    Find what a value will have decayed to after n_steps time steps.
+
+    Prefix activities and credit decay exponentially. Rather than
+    decaying every prefix on every time step, each one remembers
+    the time step it was last brought up to date. Its current value
+    is calculated from that whenever it is needed.
+    """
+    if n_steps <= 0 or value == 0.:
+        return value
+    return value * (1. - decay_rate) ** n_steps
+
+
+@jit(nopython=True)
+def _settle_prefix(
+    i_feature,
+    i_goal,
+    timestep,
+    prefix_decay_rate,
+    prefix_activities,
+    prefix_activity_steps,
+    prefix_occurrences,
+    prefix_uncertainties,
+):
+    """
+    Bring a prefix's activity and occurrences up to date.
+
+    While a prefix decays, its activity is still added to its
+    occurrences on every time step. Over n steps of decay
+    from an activity a, with a decay factor of d = 1 - decay_rate,
+    the occurrences grow by
+        a * (d + d**2 + ... + d**n) = a * d * (1 - d**n) / (1 - d)
+    """
+    n_steps = timestep - prefix_activity_steps[i_feature][i_goal]
+    if n_steps <= 0:
+        return
+    prefix_activity_steps[i_feature][i_goal] = timestep
+    activity = prefix_activities[i_feature][i_goal]
+    if activity == 0.:
+        return
+
+    decay = 1. - prefix_decay_rate
+    decay_n = decay ** n_steps
+    if decay < 1.:
+        prefix_occurrences[i_feature][i_goal] += (
+            activity * decay * (1. - decay_n) / (1. - decay))
+    else:
+        prefix_occurrences[i_feature][i_goal] += activity * n_steps
+    prefix_activities[i_feature][i_goal] = activity * decay_n
+    prefix_uncertainties[i_feature][i_goal] = 1. / (
+        1. + 3. * prefix_occurrences[i_feature][i_goal])
+
+
+@jit(nopython=True)
+def settle_prefix_rows(
+    features,
+    live_features,
+    timestep,
+    prefix_decay_rate,
+    prefix_activities,
+    prefix_activity_steps,
+    prefix_occurrences,
+    prefix_uncertainties,
+):
+    """
+    Bring all the prefixes of a set of features up to date.
+    """
+    for i_row in prange(features.size):
+        i_feature = features[i_row]
         for i_goal in live_features:
-            for i_feature in live_features:
-                if prefix_activities[i_feature][i_goal] < small:
-                    continue
-                sequence_occurrences[i_feature][i_goal][j_feature] += (
-                    prefix_activities[i_feature][i_goal] *
-                    new_FAIs[j_feature])
+            _settle_prefix(
+                i_feature,
+                i_goal,
+                timestep,
+                prefix_decay_rate,
+                prefix_activities,
+                prefix_activity_steps,
+                prefix_occurrences,
+                prefix_uncertainties)
+
+
+settle_prefix_rows_parallel = jit(nopython=True, parallel=True)(
+    settle_prefix_rows.py_func)
+
+
+@jit(nopython=True)
+def settle_credit(
+    live_features,
+    timestep,
+    credit_decay_rate,
+    prefix_credit,
+    prefix_credit_steps,
+):
+    """
+    Bring the credit of every live prefix up to date.
+    """
+    for i_feature in live_features:
+        for i_goal in live_features:
+            prefix_credit[i_feature][i_goal] = _decayed(
+                prefix_credit[i_feature][i_goal],
+                credit_decay_rate,
+                timestep - prefix_credit_steps[i_feature][i_goal])
+            prefix_credit_steps[i_feature][i_goal] = timestep
+
+
+@jit(nopython=True)
+def initialize_prefixes(
+    new_features,
+    live_features,
+    prefix_occurrences,
+    prefix_uncertainties,
+):
+    """
+    Set the uncertainties of prefixes involving newly live features.
+
+    After this, the uncertainty of a prefix only needs to be recalculated
+    when its occurrences change.
+    """
+    for i_new in new_features:
+        for i_live in live_features:
+            prefix_uncertainties[i_new][i_live] = 1. / (
+                1. + 3. * prefix_occurrences[i_new][i_live])
+            prefix_uncertainties[i_live][i_new] = 1. / (
+                1. + 3. * prefix_occurrences[i_live][i_new])
     return
 
 
+@jit(nopython=True)
+def _compact_prefixes(
+    prefix_features,
+    prefix_goals,
+    n_prefixes,
+    prefix_mask,
+    prefix_values,
+    value_steps,
+    timestep,
+    decay_rate,
+    threshold,
+):
+    """
+    Drop the members of a prefix set whose values have decayed away.
+
+    Members are kept as long as their values, decayed up to timestep,
+    are greater than or equal to threshold. A threshold of zero
+    keeps everything that hasn't decayed all the way to zero.
+
+    Returns
+    -------
+    n_prefixes : int
+        The number of prefixes remaining in the set.
+    """
+    n_kept = 0
+    for i_prefix in range(n_prefixes):
+        i_feature = prefix_features[i_prefix]
+        i_goal = prefix_goals[i_prefix]
+        value = _decayed(
+            prefix_values[i_feature][i_goal],
+            decay_rate,
+            timestep - value_steps[i_feature][i_goal])
+        if value == 0. or value < threshold:
+            prefix_mask[i_feature][i_goal] = False
+            continue
+        prefix_features[n_kept] = i_feature
+        prefix_goals[n_kept] = i_goal
+        n_kept += 1
+    return n_kept
+
+
 @jit(nopython=True)
 def update_prefixes(
-    live_features,
+    prefix_features,
+    prefix_goals,
+    n_prefixes,
+    prefix_mask,
+    previous_active_features,
+    active_goals,
+    timestep,
     prefix_decay_rate,
     previous_feature_activities,
     feature_goal_activities,
     prefix_activities,
+    prefix_activity_steps,
     prefix_occurrences,
     prefix_uncertainties,
 ):
@@ -58,9 +260,33 @@ def update_prefixes(
     g is the current goal_increase.
 
     p, the prefix activity, is a decayed version of n.
+
+    Decay is applied lazily (see _decayed), so only the prefixes
+    picking up new activity need to be touched. They are brought up
+    to date through the previous time step, then given
+    this time step's decay and new activity.
+
+    The active prefix set holds the prefixes with activity of at least
+    the threshold that update_sequences cares about.
+    New prefixes join it and faded ones leave.
+
+    Returns
+    -------
+    n_prefixes : int
+        The updated number of prefixes in the active set.
     """
-    for i_feature in live_features:
-        for i_goal in live_features:
+    small = .1
+    for i_feature in previous_active_features:
+        for i_goal in active_goals:
+            _settle_prefix(
+                i_feature,
+                i_goal,
+                timestep - 1,
+                prefix_decay_rate,
+                prefix_activities,
+                prefix_activity_steps,
+                prefix_occurrences,
+                prefix_uncertainties)
             prefix_activities[i_feature][i_goal] *= (
                 1. - prefix_decay_rate)
 
@@ -69,6 +295,7 @@ def update_prefixes(
             prefix_activities[i_feature][i_goal] += new_prefix_activity
             prefix_activities[i_feature][i_goal] = min(
                 prefix_activities[i_feature][i_goal], 1.)
+            prefix_activity_steps[i_feature][i_goal] = timestep
 
             # Increment the lifetime sum of prefix activity.
             prefix_occurrences[i_feature][i_goal] += (
@@ -79,15 +306,36 @@ def update_prefixes(
             prefix_uncertainties[i_feature][i_goal] = 1. / (
                 1. + 3. * prefix_occurrences[i_feature][i_goal])
 
-    return
+            if not prefix_mask[i_feature][i_goal]:
+                prefix_mask[i_feature][i_goal] = True
+                prefix_features[n_prefixes] = i_feature
+                prefix_goals[n_prefixes] = i_goal
+                n_prefixes += 1
+
+    return _compact_prefixes(
+        prefix_features,
+        prefix_goals,
+        n_prefixes,
+        prefix_mask,
+        prefix_activities,
+        prefix_activity_steps,
+        timestep,
+        prefix_decay_rate,
+        small)
 
 
 @jit(nopython=True)
 def update_rewards(
-    live_features,
+    credit_features,
+    credit_goals,
+    n_credits,
+    credit_mask,
+    timestep,
+    credit_decay_rate,
     reward_update_rate,
     reward,
     prefix_credit,
+    prefix_credit_steps,
     prefix_rewards,
 ):
     """
@@ -101,25 +349,52 @@ def update_rewards(
     Another way to say this is:
     If either the reward discrepancy is very small
     or the sequence activity is very small, there is no change.
+
+    Prefixes without credit don't change, so only the set of
+    prefixes with credit is visited. The credit used is the one left
+    at the end of the previous time step.
+    Prefixes whose credit has decayed to zero leave the set.
+
+    Returns
+    -------
+    n_credits : int
+        The updated number of prefixes with credit.
     """
-    for i_feature in live_features:
-        for i_goal in live_features:
-            if reward > prefix_rewards[i_feature][i_goal]:
-                update_scale = .5
-            else:
-                update_scale = 1.
-            prefix_rewards[i_feature][i_goal] += (
-                (reward - prefix_rewards[i_feature][i_goal]) *
-                prefix_credit[i_feature][i_goal] *
-                reward_update_rate * update_scale)
-    return
+    for i_credit in range(n_credits):
+        i_feature = credit_features[i_credit]
+        i_goal = credit_goals[i_credit]
+        credit = _decayed(
+            prefix_credit[i_feature][i_goal],
+            credit_decay_rate,
+            timestep - 1 - prefix_credit_steps[i_feature][i_goal])
+        if reward > prefix_rewards[i_feature][i_goal]:
+            update_scale = .5
+        else:
+            update_scale = 1.
+        prefix_rewards[i_feature][i_goal] += (
+            (reward - prefix_rewards[i_feature][i_goal]) *
+            credit * reward_update_rate * update_scale)
+
+    return _compact_prefixes(
+        credit_features,
+        credit_goals,
+        n_credits,
+        credit_mask,
+        prefix_credit,
+        prefix_credit_steps,
+        timestep - 1,
+        credit_decay_rate,
+        0.)
 
 
 @jit(nopython=True)
 def update_curiosities(
     live_features,
+    active_features,
+    previous_active_features,
+    active_goals,
+    is_active,
     curiosity_update_rate,
-    prefix_occurrences,
     prefix_curiosities,
     previous_feature_activities,
     feature_activities,
@@ -128,40 +403,95 @@ def update_curiosities(
 ):
     """
     Use a collection of factors to increment the curiosity for each prefix.
+
+    Curiosity only changes for the prefixes of active features
+    and for the prefixes made up of a previously active feature
+    and a current goal. All others are left alone.
+
+    Parameters
+    ----------
+    is_active : array of bools
+        True for each feature in active_features.
     """
-    for i_feature in live_features:
+    # Each feature updates its own row of prefixes.
+    for i_row in prange(active_features.size):
+        i_feature = active_features[i_row]
         for i_goal in live_features:
+            _update_curiosity(
+                i_feature,
+                i_goal,
+                curiosity_update_rate,
+                prefix_curiosities,
+                previous_feature_activities,
+                feature_activities,
+                feature_goal_activities,
+                prefix_uncertainties)
 
-            # Fulfill curiosity on the previous time step's goals.
-            curiosity_fulfillment = (previous_feature_activities[i_feature] *
-                                     feature_goal_activities[i_goal])
-            prefix_curiosities[i_feature][i_goal] -= curiosity_fulfillment
-            prefix_curiosities[i_feature][i_goal] = max(
-                prefix_curiosities[i_feature][i_goal], 0.)
-
-            # Increment the curiosity based on several multiplicative
-            # factors.
-            #     curiosity_update_rate : a constant
-            #     uncertainty : an estimate of how much is not yet
-            #         known about this prefix. It is a function of
-            #         the total past occurrences.
-            #     feature_activities : The activity of the prefix's feature.
-            #         Only increase the curiosity if the feature
-            #         corresponding to the prefix is active.
-            prefix_curiosities[i_feature][i_goal] += (
-                curiosity_update_rate *
-                prefix_uncertainties[i_feature][i_goal] *
-                feature_activities[i_feature])
+    # Catch the goal fulfillments for features that are no longer active.
+    for i_row in prange(previous_active_features.size):
+        i_feature = previous_active_features[i_row]
+        if is_active[i_feature]:
+            continue
+        for i_goal in active_goals:
+            _update_curiosity(
+                i_feature,
+                i_goal,
+                curiosity_update_rate,
+                prefix_curiosities,
+                previous_feature_activities,
+                feature_activities,
+                feature_goal_activities,
+                prefix_uncertainties)
     return
 
 
+update_curiosities_parallel = jit(nopython=True, parallel=True)(
+    update_curiosities.py_func)
+
+
+@jit(nopython=True)
+def _update_curiosity(
+    i_feature,
+    i_goal,
+    curiosity_update_rate,
+    prefix_curiosities,
+    previous_feature_activities,
+    feature_activities,
+    feature_goal_activities,
+    prefix_uncertainties,
+):
+    """
+    Update the curiosity of a single prefix.
+    """
+    # Fulfill curiosity on the previous time step's goals.
+    curiosity_fulfillment = (previous_feature_activities[i_feature] *
+                             feature_goal_activities[i_goal])
+    prefix_curiosities[i_feature][i_goal] -= curiosity_fulfillment
+    prefix_curiosities[i_feature][i_goal] = max(
+        prefix_curiosities[i_feature][i_goal], 0.)
+
+    # Increment the curiosity based on several multiplicative
+    # factors.
+    #     curiosity_update_rate : a constant
+    #     uncertainty : an estimate of how much is not yet
+    #         known about this prefix. It is a function of
+    #         the total past occurrences.
+    #     feature_activities : The activity of the prefix's feature.
+    #         Only increase the curiosity if the feature
+    #         corresponding to the prefix is active.
+    prefix_curiosities[i_feature][i_goal] += (
+        curiosity_update_rate *
+        prefix_uncertainties[i_feature][i_goal] *
+        feature_activities[i_feature])
+
+
 # @jit(nopython=True)
 def update_fitness(
     feature_fitness,
     prefix_occurrences,
     prefix_rewards,
     prefix_uncertainties,
-    sequence_occurrences,
+    max_sequence_occurrences,
 ):
     """
     Calculate the fitness of each feature 
@@ -174,37 +504,90 @@ def update_fitness(
     prefix_occurrences: 2D array of floats
     prefix_rewards: 2D array of floats
     prefix_uncertainties: 2D array of floats
-    sequence_occurrences: 3D array of floats
+    max_sequence_occurrences: 2D array of floats
+        The largest number of occurrences of any sequence
+        starting with each prefix. For a dense sequence array this is
+        np.max(sequence_occurrences, axis=2).
     """
     # Calculate the ability of each prefix to predict the features that
     # follow it.
     # Base it on the single most successfully predicted sequence.
     postfeature_prediction_score = (
-        np.max(sequence_occurrences, axis=2) / prefix_occurrences)
+        max_sequence_occurrences / prefix_occurrences)
     # Calculate the ability of each prefix to predict reward or punishment.
     reward_prediction_score = np.abs(prefix_rewards)
-    prefix_score = feature_prediction_score + reward_prediction_score
+    prefix_score = postfeature_prediction_score + reward_prediction_score
     # Scale fitness by confidence (1 - uncertainty)
     prefix_fitness = prefix_score * (1 - prefix_uncertainties)
     # Find the maximum fitness for each feature across all prefixes,
     # whether as a prefeature or as a goal.
     prefeature_fitness = np.max(prefix_fitness, axis=1)
     goal_fitness = np.max(prefix_fitness, axis=0)
-    feature_fitness = np.maximum(prefeature_fitness, goal_fitness)
+    feature_fitness[:] = np.maximum(prefeature_fitness, goal_fitness)
 
     return
 
 
+@jit(nopython=True)
+def calculate_sequence_values(
+    live_features,
+    prefix_occurrences,
+    sequence_occurrences,
+    feature_activities,
+    feature_goal_activities,
+    sequence_values,
+):
+    """
+    Find the overall expected value of each prefix's sequences.
+
+            s = sum((o / p) * (g + t)) / sum(o / p), where
+        o is the number of occurrences of the sequence,
+        p is the number of occurrences of the prefix,
+        g is the goal value of the sequence's terminal feature, and
+        t is the top-down plan value of the sequence's terminal feature.
+
+    Only prefixes whose feature is active are evaluated.
+
+    Results
+    -------
+    Returned indirectly by modifying sequence_values.
+    """
+    small = .1
+    for i_row in prange(live_features.size):
+        i_feature = live_features[i_row]
+        if feature_activities[i_feature] < small:
+            continue
+        for i_goal in live_features:
+            # Add up the value of sequences.
+            weighted_values = 1.
+            total_weights = 1.
+            for j_feature in live_features:
+                weight = (
+                    sequence_occurrences[i_feature][i_goal][j_feature]*
+                    prefix_occurrences[i_feature][i_goal])
+                weighted_values += (
+                    weight * feature_goal_activities[j_feature])
+                total_weights += weight
+            sequence_values[i_feature][i_goal] = (
+                weighted_values / total_weights)
+    return
+
+
+calculate_sequence_values_parallel = jit(nopython=True, parallel=True)(
+    calculate_sequence_values.py_func)
+
+
 @jit(nopython=True)
 def calculate_goal_votes(
     num_features,
+    active_features,
     live_features,
     prefix_rewards,
     prefix_curiosities,
-    prefix_occurrences,
-    sequence_occurrences,
+    sequence_values,
     feature_activities,
-    feature_goal_activities,
+    use_sequence_values=False,
+    n_chunks=1,
 ):
     """
     Let each prefix cast a vote for its goal, based on its value.
@@ -217,77 +600,754 @@ def calculate_goal_votes(
         r is the prefix's reward,
         c is the prefix's curiosity, and
         s is the overall expected value of the prefix's sequences.
-
-            s = sum((o / p) * (g + t)) / sum(o / p), where
-        o is the number of occurrences of the sequence,
-        p is the number of occurrences of the prefix,
-        g is the goal value of the sequence's terminal feature, and
-        t is the top-down plan value of the sequence's terminal feature.
+            (See calculate_sequence_values.)
+            It is only included if use_sequence_values is True.
 
     For each goal, track the largest value that is calculated and
     treat it as a vote for that goal.
+
+    Only the prefixes of features with an activity of at least
+    small get to vote. All the others would cast a vote below zero,
+    which never beats the default of zero. The voting features are
+    all active, so only the rows of active_features are visited.
+    Every one of those rows changes each time step along with its
+    feature's activity, so the votes are collected from scratch
+    from just those rows.
+
+    The active features are split into n_chunks blocks.
+    Each block collects its own votes, and these are combined
+    at the end. This lets the parallel variant work on blocks
+    independently.
     """
     small = .1
+    n_active = active_features.size
+    chunk_votes = np.zeros((n_chunks, num_features))
+    for i_chunk in prange(n_chunks):
+        for i_row in range(
+                (i_chunk * n_active) // n_chunks,
+                ((i_chunk + 1) * n_active) // n_chunks):
+            i_feature = active_features[i_row]
+            activity = feature_activities[i_feature]
+            if activity < small:
+                continue
+            for i_goal in live_features:
+                value = (prefix_rewards[i_feature][i_goal] +
+                         prefix_curiosities[i_feature][i_goal])
+                if use_sequence_values:
+                    value += sequence_values[i_feature][i_goal]
+                goal_vote = activity * value
+
+                # Compile the maximum goal votes for action selection.
+                if goal_vote > chunk_votes[i_chunk][i_goal]:
+                    chunk_votes[i_chunk][i_goal] = goal_vote
+
     feature_goal_votes = np.zeros(num_features)
-    for i_feature in live_features:
+    for i_chunk in range(n_chunks):
         for i_goal in live_features:
-            if feature_activities[i_feature] < small:
-                goal_vote = -2.
-
-            else:
-                ## Hold out this code for now. As far as I know, it works.
-                ## I'll be able to tell with more certainty after additional
-                ## testing.
-                # Add up the value of sequences.
-                weighted_values = 1.
-                total_weights = 1.
-                for j_feature in live_features:
-                    weight = (
-                        sequence_occurrences[i_feature][i_goal][j_feature]*
-                        prefix_occurrences[i_feature][i_goal])
-                    weighted_values += (
-                        weight * feature_goal_activities[j_feature])
-                    total_weights += weight
-                sequence_value = weighted_values / total_weights
-                # Add up the other value components.
-                goal_vote = feature_activities[i_feature] * (
-                    prefix_rewards[i_feature][i_goal] +
-                    prefix_curiosities[i_feature][i_goal])# +
-                    #sequence_value)
-
-            # Compile the maximum goal votes for action selection.
-            if goal_vote > feature_goal_votes[i_goal]:
-                feature_goal_votes[i_goal] = goal_vote
-
+            if chunk_votes[i_chunk][i_goal] > feature_goal_votes[i_goal]:
+                feature_goal_votes[i_goal] = chunk_votes[i_chunk][i_goal]
     return feature_goal_votes
 
 
+calculate_goal_votes_parallel = jit(nopython=True, parallel=True)(
+    calculate_goal_votes.py_func)
+
+
 @jit(nopython=True)
 def update_reward_credit(
-    live_features,
+    credit_features,
+    credit_goals,
+    n_credits,
+    credit_mask,
+    active_features,
     i_new_goal,
     max_vote,
     feature_activities,
+    timestep,
     credit_decay_rate,
     prefix_credit,
+    prefix_credit_steps,
 ):
     """
     Update the credit due each prefix for upcoming reward.
-    """
-    # Age the prefix credit.
-    for i_feature in live_features:
-        for i_goal in live_features:
-            # Exponential discounting
-            prefix_credit[i_feature][i_goal] *= (1. - credit_decay_rate)
 
+    The aging of prefix credit is applied lazily (see _decayed).
+    Only the prefixes of active features that are credited with
+    the new goal are touched. They join the set of credited prefixes.
+
+    Returns
+    -------
+    n_credits : int
+        The updated number of prefixes with credit.
+    """
     if max_vote > 0.:
         # Update the prefix credit.
         if i_new_goal > -1:
-            for i_feature in live_features:
+            for i_feature in active_features:
+                # Age the prefix credit, with exponential discounting.
+                prefix_credit[i_feature][i_new_goal] = _decayed(
+                    prefix_credit[i_feature][i_new_goal],
+                    credit_decay_rate,
+                    timestep - prefix_credit_steps[i_feature][i_new_goal])
+                prefix_credit_steps[i_feature][i_new_goal] = timestep
+
                 # Accumulation strategy:
                 # add new credit to existing credit, with a max of 1.
                 prefix_credit[i_feature][i_new_goal] += (
                     feature_activities[i_feature])
                 prefix_credit[i_feature][i_new_goal] = min(
                     prefix_credit[i_feature][i_new_goal], 1.)
+
+                if not credit_mask[i_feature][i_new_goal]:
+                    credit_mask[i_feature][i_new_goal] = True
+                    credit_features[n_credits] = i_feature
+                    credit_goals[n_credits] = i_new_goal
+                    n_credits += 1
+    return n_credits
+
+
+@jit(nopython=True)
+def step_prefixes(
+    live_features,
+    timestep,
+    prefix_decay_rate,
+    credit_decay_rate,
+    reward_update_rate,
+    curiosity_update_rate,
+    reward,
+    previous_feature_activities,
+    feature_activities,
+    feature_goal_activities,
+    prefix_activities,
+    prefix_activity_steps,
+    prefix_occurrences,
+    prefix_credit,
+    prefix_rewards,
+    prefix_curiosities,
+    prefix_features,
+    prefix_goals,
+    feature_goal_votes,
+):
+    """
+    Update every prefix and collect goal votes in a single pass.
+
+    This fuses update_prefixes, update_rewards, update_curiosities,
+    calculate_goal_votes and the aging half of update_reward_credit.
+    Each prefix's values are loaded once, carried through all
+    the updates in local variables, and written back once.
+    Uncertainty is calculated from occurrences on the fly rather
+    than stored. Decay is applied eagerly, so every prefix is
+    current at the end of the pass.
+
+    The list of prefixes with at least the activity that
+    update_sequences cares about is rebuilt along the way.
+
+    Returns
+    -------
+    n_prefixes : int
+        The number of prefixes with enough activity for sequences.
+        If it is larger than the size of prefix_features and
+        prefix_goals, the list is incomplete and needs to be
+        rebuilt with collect_active_prefixes.
+    """
+    n_prefixes = 0
+    for i_feature in live_features:
+        n_prefixes = _step_prefix_row(
+            i_feature,
+            live_features,
+            timestep,
+            prefix_decay_rate,
+            credit_decay_rate,
+            reward_update_rate,
+            curiosity_update_rate,
+            reward,
+            previous_feature_activities,
+            feature_activities,
+            feature_goal_activities,
+            prefix_activities,
+            prefix_activity_steps,
+            prefix_occurrences,
+            prefix_credit,
+            prefix_rewards,
+            prefix_curiosities,
+            prefix_features,
+            prefix_goals,
+            n_prefixes,
+            feature_goal_votes)
+    return n_prefixes
+
+
+@jit(nopython=True, parallel=True)
+def step_prefixes_parallel(
+    live_features,
+    timestep,
+    prefix_decay_rate,
+    credit_decay_rate,
+    reward_update_rate,
+    curiosity_update_rate,
+    reward,
+    previous_feature_activities,
+    feature_activities,
+    feature_goal_activities,
+    prefix_activities,
+    prefix_activity_steps,
+    prefix_occurrences,
+    prefix_credit,
+    prefix_rewards,
+    prefix_curiosities,
+    feature_goal_votes,
+    n_chunks,
+):
+    """
+    Update every prefix and collect goal votes, spread across threads.
+
+    This is the parallel variant of step_prefixes. The features
+    are split into n_chunks blocks that collect their own goal votes,
+    which are combined at the end. It doesn't build the list of
+    active prefixes. Use collect_active_prefixes for that.
+    """
+    n_live = live_features.size
+    chunk_votes = np.zeros((n_chunks, feature_goal_votes.size))
+    no_prefixes = np.zeros(0, dtype=np.int32)
+    for i_chunk in prange(n_chunks):
+        for i_row in range(
+                (i_chunk * n_live) // n_chunks,
+                ((i_chunk + 1) * n_live) // n_chunks):
+            _step_prefix_row(
+                live_features[i_row],
+                live_features,
+                timestep,
+                prefix_decay_rate,
+                credit_decay_rate,
+                reward_update_rate,
+                curiosity_update_rate,
+                reward,
+                previous_feature_activities,
+                feature_activities,
+                feature_goal_activities,
+                prefix_activities,
+                prefix_activity_steps,
+                prefix_occurrences,
+                prefix_credit,
+                prefix_rewards,
+                prefix_curiosities,
+                no_prefixes,
+                no_prefixes,
+                0,
+                chunk_votes[i_chunk])
+
+    for i_chunk in range(n_chunks):
+        for i_goal in live_features:
+            if chunk_votes[i_chunk][i_goal] > feature_goal_votes[i_goal]:
+                feature_goal_votes[i_goal] = chunk_votes[i_chunk][i_goal]
+
+
+@jit(nopython=True)
+def _step_prefix_row(
+    i_feature,
+    live_features,
+    timestep,
+    prefix_decay_rate,
+    credit_decay_rate,
+    reward_update_rate,
+    curiosity_update_rate,
+    reward,
+    previous_feature_activities,
+    feature_activities,
+    feature_goal_activities,
+    prefix_activities,
+    prefix_activity_steps,
+    prefix_occurrences,
+    prefix_credit,
+    prefix_rewards,
+    prefix_curiosities,
+    prefix_features,
+    prefix_goals,
+    n_prefixes,
+    feature_goal_votes,
+):
+    """
+    Update all the prefixes of a single feature. See step_prefixes.
+
+    Returns
+    -------
+    n_prefixes : int
+        The count of prefixes with enough activity for sequences,
+        incremented by the ones found in this row.
+    """
+    small = .1
+    previous_activity = previous_feature_activities[i_feature]
+    activity = feature_activities[i_feature]
+    for i_goal in live_features:
+        goal = feature_goal_activities[i_goal]
+
+        # Prefix activities and occurrences
+        prefix_activity = prefix_activities[i_feature][i_goal] * (
+            1. - prefix_decay_rate)
+        prefix_activity = min(
+            prefix_activity + previous_activity * goal, 1.)
+        occurrences = (
+            prefix_occurrences[i_feature][i_goal] + prefix_activity)
+        uncertainty = 1. / (1. + 3. * occurrences)
+
+        # Rewards, using the credit from the previous time step
+        credit = prefix_credit[i_feature][i_goal]
+        prefix_reward = prefix_rewards[i_feature][i_goal]
+        if reward > prefix_reward:
+            update_scale = .5
+        else:
+            update_scale = 1.
+        prefix_reward += (
+            (reward - prefix_reward) *
+            credit * reward_update_rate * update_scale)
+
+        # Curiosities
+        curiosity = max(
+            prefix_curiosities[i_feature][i_goal] -
+            previous_activity * goal, 0.)
+        curiosity += curiosity_update_rate * uncertainty * activity
+
+        # Goal votes
+        if activity >= small:
+            goal_vote = activity * (prefix_reward + curiosity)
+            if goal_vote > feature_goal_votes[i_goal]:
+                feature_goal_votes[i_goal] = goal_vote
+
+        prefix_activities[i_feature][i_goal] = prefix_activity
+        prefix_occurrences[i_feature][i_goal] = occurrences
+        prefix_rewards[i_feature][i_goal] = prefix_reward
+        prefix_curiosities[i_feature][i_goal] = curiosity
+        prefix_credit[i_feature][i_goal] = credit * (
+            1. - credit_decay_rate)
+
+        if prefix_activity > 0.:
+            prefix_activity_steps[i_feature][i_goal] = timestep
+        if prefix_activity >= small:
+            if n_prefixes < prefix_features.size:
+                prefix_features[n_prefixes] = i_feature
+                prefix_goals[n_prefixes] = i_goal
+            n_prefixes += 1
+    return n_prefixes
+
+
+@jit(nopython=True)
+def collect_active_prefixes(
+    live_features,
+    prefix_activities,
+    prefix_features,
+    prefix_goals,
+):
+    """
+    List the prefixes with enough activity to contribute to sequences.
+
+    Returns
+    -------
+    n_prefixes : int
+        The number of prefixes found. If it is larger than the size of
+        prefix_features and prefix_goals, only the ones that fit
+        are listed.
+    """
+    small = .1
+    n_prefixes = 0
+    for i_feature in live_features:
+        for i_goal in live_features:
+            if prefix_activities[i_feature][i_goal] >= small:
+                if n_prefixes < prefix_features.size:
+                    prefix_features[n_prefixes] = i_feature
+                    prefix_goals[n_prefixes] = i_goal
+                n_prefixes += 1
+    return n_prefixes
+
+
+@jit(nopython=True)
+def add_goal_credit(
+    active_features,
+    i_new_goal,
+    max_vote,
+    feature_activities,
+    prefix_credit,
+):
+    """
+    Credit the prefixes of active features with the new goal.
+
+    This is the second half of update_reward_credit, for use after
+    step_prefixes, which has already aged the credit.
+    """
+    if max_vote > 0. and i_new_goal > -1:
+        for i_feature in active_features:
+            prefix_credit[i_feature][i_new_goal] = min(
+                prefix_credit[i_feature][i_new_goal] +
+                feature_activities[i_feature], 1.)
+
+
+@jit(nopython=True)
+def _sparse_sequence_slot(keys, key):
+    """
+    Find the slot in the hash table that holds key, or would hold it.
+
+    This uses open addressing with linear probing. The number of
+    slots is always a power of two, so masking takes the place of
+    the modulo operator.
+    """
+    mask = keys.size - 1
+    # Multiplicative hashing scatters the consecutive keys
+    # that belong to a single prefix.
+    i_slot = ((key * 2654435761) >> 7) & mask
+    while keys[i_slot] != -1 and keys[i_slot] != key:
+        i_slot = (i_slot + 1) & mask
+    return i_slot
+
+
+@jit(nopython=True)
+def get_sparse_sequence(keys, values, key, default):
+    """
+    Get the occurrences of the sequence stored under key.
+    """
+    i_slot = _sparse_sequence_slot(keys, key)
+    if keys[i_slot] == -1:
+        return default
+    return values[i_slot]
+
+
+@jit(nopython=True)
+def rehash_sparse_sequences(keys, values, new_keys, new_values):
+    """
+    Copy all the entries of one hash table into a new, larger one.
+
+    Results
+    -------
+    Returned indirectly by modifying new_keys and new_values.
+    """
+    for i_slot in range(keys.size):
+        key = keys[i_slot]
+        if key == -1:
+            continue
+        i_new_slot = _sparse_sequence_slot(new_keys, key)
+        new_keys[i_new_slot] = key
+        new_values[i_new_slot] = values[i_slot]
+
+
+@jit(nopython=True)
+def count_sequence_candidates(
+    prefix_features,
+    prefix_goals,
+    n_prefixes,
+    postfeatures,
+    new_FAIs,
+    timestep,
+    prefix_decay_rate,
+    prefix_activities,
+    prefix_activity_steps,
+):
+    """
+    Find an upper bound on the number of sequences update_sequences touches.
+
+    Returns
+    -------
+    n_candidates : int
+        The number of active prefixes times the number of
+        active postfeatures.
+    """
+    small = .1
+    n_postfeatures = 0
+    for j_feature in postfeatures:
+        if new_FAIs[j_feature] >= small:
+            n_postfeatures += 1
+    if n_postfeatures == 0:
+        return 0
+
+    n_active = 0
+    for i_prefix in range(n_prefixes):
+        i_feature = prefix_features[i_prefix]
+        i_goal = prefix_goals[i_prefix]
+        prefix_activity = _decayed(
+            prefix_activities[i_feature][i_goal],
+            prefix_decay_rate,
+            timestep - 1 - prefix_activity_steps[i_feature][i_goal])
+        if prefix_activity >= small:
+            n_active += 1
+    return n_active * n_postfeatures
+
+
+@jit(nopython=True)
+def update_sparse_sequences(
+    prefix_features,
+    prefix_goals,
+    n_prefixes,
+    postfeatures,
+    new_FAIs,
+    timestep,
+    prefix_decay_rate,
+    prefix_activities,
+    prefix_activity_steps,
+    n_features,
+    default,
+    keys,
+    values,
+):
+    """
+    Update the number of occurrences of each sequence in a hash table.
+
+    This is the sparse counterpart of update_sequences. Sequences
+    that haven't been observed before are added with the default
+    value before being incremented.
+    The table needs enough empty slots for every new sequence.
+    SparseSequences.reserve() makes sure of that.
+
+    Returns
+    -------
+    n_added : int
+        The number of sequences that were added to the table.
+    """
+    small = .1
+    n_added = 0
+    for j_feature in postfeatures:
+        if new_FAIs[j_feature] < small:
+            continue
+        for i_prefix in range(n_prefixes):
+            i_feature = prefix_features[i_prefix]
+            i_goal = prefix_goals[i_prefix]
+            prefix_activity = _decayed(
+                prefix_activities[i_feature][i_goal],
+                prefix_decay_rate,
+                timestep - 1 - prefix_activity_steps[i_feature][i_goal])
+            if prefix_activity < small:
+                continue
+            key = (i_feature * n_features + i_goal) * n_features
+            key += j_feature
+            i_slot = _sparse_sequence_slot(keys, key)
+            if keys[i_slot] == -1:
+                keys[i_slot] = key
+                values[i_slot] = default
+                n_added += 1
+            values[i_slot] += prefix_activity * new_FAIs[j_feature]
+    return n_added
+
+
+@jit(nopython=True)
+def max_sparse_sequences(keys, values, n_features, max_occurrences):
+    """
+    Find the largest occurrences over all postfeatures for each prefix.
+
+    Results
+    -------
+    Returned indirectly by modifying max_occurrences. It should be
+    initialized to the default sequence value.
+    """
+    n_prefix_features = n_features * n_features
+    for i_slot in range(keys.size):
+        key = keys[i_slot]
+        if key == -1:
+            continue
+        i_feature = key // n_prefix_features
+        i_goal = (key // n_features) % n_features
+        if values[i_slot] > max_occurrences[i_feature][i_goal]:
+            max_occurrences[i_feature][i_goal] = values[i_slot]
+
+
+@jit(nopython=True)
+def calculate_sparse_sequence_values(
+    live_features,
+    prefix_occurrences,
+    keys,
+    values,
+    n_features,
+    default,
+    feature_activities,
+    feature_goal_activities,
+    sequence_values,
+):
+    """
+    Find the overall expected value of each prefix's sequences.
+
+    This is the sparse counterpart of calculate_sequence_values.
+    Every sequence that isn't stored contributes the default value,
+    so the sums over postfeatures are broken into a part
+    that covers the default value for all of them and a correction
+    for the few that have been stored.
+
+    Results
+    -------
+    Returned indirectly by modifying sequence_values.
+    """
+    small = .1
+    is_live = np.zeros(n_features, dtype=np.bool_)
+    total_goals = 0.
+    for j_feature in live_features:
+        is_live[j_feature] = True
+        total_goals += feature_goal_activities[j_feature]
+
+    # Collect the departures from the default for the stored sequences.
+    stored_values = np.zeros(sequence_values.shape)
+    stored_weights = np.zeros(sequence_values.shape)
+    n_prefix_features = n_features * n_features
+    for i_slot in range(keys.size):
+        key = keys[i_slot]
+        if key == -1:
+            continue
+        i_feature = key // n_prefix_features
+        i_goal = (key // n_features) % n_features
+        j_feature = key % n_features
+        if not (is_live[i_feature] and is_live[i_goal] and
+                is_live[j_feature]):
+            continue
+        excess = values[i_slot] - default
+        stored_values[i_feature][i_goal] += (
+            excess * feature_goal_activities[j_feature])
+        stored_weights[i_feature][i_goal] += excess
+
+    n_live = float(live_features.size)
+    for i_feature in live_features:
+        if feature_activities[i_feature] < small:
+            continue
+        for i_goal in live_features:
+            weighted_values = 1. + prefix_occurrences[i_feature][i_goal] * (
+                default * total_goals + stored_values[i_feature][i_goal])
+            total_weights = 1. + prefix_occurrences[i_feature][i_goal] * (
+                default * n_live + stored_weights[i_feature][i_goal])
+            sequence_values[i_feature][i_goal] = (
+                weighted_values / total_weights)
     return
+
+
+@jit(nopython=True)
+def update_sequences_batch(
+    live_mask,
+    new_FAIs,
+    prefix_activities,
+    sequence_occurrences,
+):
+    """
+    Update the sequence occurrences of every model in a batch.
+
+    This is the batched counterpart of update_sequences for models
+    that use step_prefixes_batch. All their prefix activities are
+    current, so the prefixes with enough activity are found
+    by scanning for them.
+
+    Parameters
+    ----------
+    live_mask : 2D array of bools
+        For each model, True for each of its live features.
+    Other arrays are the same as in update_sequences,
+    stacked along a leading model axis.
+    """
+    small = .1
+    for i_model in prange(live_mask.shape[0]):
+        live_features = np.where(live_mask[i_model])[0]
+        FAIs = new_FAIs[i_model]
+        postfeatures = live_features[FAIs[live_features] >= small]
+        if postfeatures.size == 0:
+            continue
+        activities = prefix_activities[i_model]
+        occurrences = sequence_occurrences[i_model]
+        for i_feature in live_features:
+            for i_goal in live_features:
+                prefix_activity = activities[i_feature][i_goal]
+                if prefix_activity < small:
+                    continue
+                for j_feature in postfeatures:
+                    occurrences[i_feature][i_goal][j_feature] += (
+                        prefix_activity * FAIs[j_feature])
+
+
+update_sequences_batch_parallel = jit(nopython=True, parallel=True)(
+    update_sequences_batch.py_func)
+
+
+@jit(nopython=True)
+def step_prefixes_batch(
+    live_mask,
+    timestep,
+    prefix_decay_rate,
+    credit_decay_rate,
+    reward_update_rate,
+    curiosity_update_rate,
+    rewards,
+    previous_feature_activities,
+    feature_activities,
+    feature_goal_activities,
+    prefix_activities,
+    prefix_activity_steps,
+    prefix_occurrences,
+    prefix_credit,
+    prefix_rewards,
+    prefix_curiosities,
+    feature_goal_votes,
+):
+    """
+    Update every prefix of every model in a batch and collect goal votes.
+
+    Each model gets the same single pass as in step_prefixes.
+    The list of active prefixes isn't kept, since
+    update_sequences_batch doesn't need it.
+
+    Parameters
+    ----------
+    live_mask : 2D array of bools
+        For each model, True for each of its live features.
+    rewards : array of floats
+        The reward for each model.
+    Other arrays are the same as in step_prefixes,
+    stacked along a leading model axis.
+    """
+    no_prefixes = np.zeros(0, dtype=np.int32)
+    for i_model in prange(live_mask.shape[0]):
+        live_features = np.where(live_mask[i_model])[0]
+        for i_feature in live_features:
+            _step_prefix_row(
+                i_feature,
+                live_features,
+                timestep,
+                prefix_decay_rate,
+                credit_decay_rate,
+                reward_update_rate,
+                curiosity_update_rate,
+                rewards[i_model],
+                previous_feature_activities[i_model],
+                feature_activities[i_model],
+                feature_goal_activities[i_model],
+                prefix_activities[i_model],
+                prefix_activity_steps[i_model],
+                prefix_occurrences[i_model],
+                prefix_credit[i_model],
+                prefix_rewards[i_model],
+                prefix_curiosities[i_model],
+                no_prefixes,
+                no_prefixes,
+                0,
+                feature_goal_votes[i_model])
+
+
+step_prefixes_batch_parallel = jit(nopython=True, parallel=True)(
+    step_prefixes_batch.py_func)
+
+
+@jit(nopython=True)
+def add_goal_credit_batch(
+    live_mask,
+    goal_indices,
+    max_votes,
+    feature_activities,
+    prefix_credit,
+):
+    """
+    Credit the prefixes of each model's active features with its new goal.
+
+    This is the batched counterpart of add_goal_credit.
+    """
+    for i_model in prange(live_mask.shape[0]):
+        i_new_goal = goal_indices[i_model]
+        if max_votes[i_model] <= 0. or i_new_goal < 0:
+            continue
+        activities = feature_activities[i_model]
+        credit = prefix_credit[i_model]
+        for i_feature in np.where(live_mask[i_model])[0]:
+            if activities[i_feature] == 0.:
+                continue
+            credit[i_feature][i_new_goal] = min(
+                credit[i_feature][i_new_goal] + activities[i_feature], 1.)
+
+
+add_goal_credit_batch_parallel = jit(nopython=True, parallel=True)(
+    add_goal_credit_batch.py_func)
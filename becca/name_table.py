@@ -0,0 +1,87 @@
+"""
+The NameTable class.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+class NameTable(object):
+    """
+    An interning table for the strings observed by a string category tree.
+
+    Each distinct string is given an integer id the first time it is seen.
+    From then on, the table can say in constant time which leaf of the
+    tree the string belongs to, and where its count is kept
+    in that leaf's arrays. This lets the tree find a string's category
+    without testing it against each node's members on the way down.
+    The nodes of one tree all share a single table.
+    """
+    def __init__(self, initial_size=2**4):
+        """
+        Parameters
+        ----------
+        initial_size : int
+            The number of names to make room for at first.
+        """
+        # ids : dict of {string: int}
+        #     The id of each name.
+        # names : list of strings
+        #     The name with each id.
+        self.ids = {}
+        self.names = []
+        # size : int
+        #     The number of names there is currently room for.
+        self.size = initial_size
+        # leaves : array of StrCatTreeNodes
+        #     The leaf each name currently belongs to.
+        # slots : array of ints
+        #     The position of each name in its leaf's arrays.
+        self.leaves = np.empty(self.size, dtype=object)
+        self.slots = -np.ones(self.size, dtype=int)
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, name):
+        """
+        Look up the id of a name.
+
+        Parameters
+        ----------
+        name : string
+
+        Returns
+        -------
+        i_name : int
+            The id of the name, or -1 if it hasn't been seen yet.
+        """
+        return self.ids.get(name, -1)
+
+    def intern(self, name):
+        """
+        Give a new name an id.
+
+        Parameters
+        ----------
+        name : string
+            A name that isn't in the table yet.
+
+        Returns
+        -------
+        i_name : int
+            The id of the name.
+        """
+        i_name = len(self.names)
+        if i_name == self.size:
+            self.size *= 2
+            new_leaves = np.empty(self.size, dtype=object)
+            new_leaves[:i_name] = self.leaves
+            self.leaves = new_leaves
+            new_slots = -np.ones(self.size, dtype=int)
+            new_slots[:i_name] = self.slots
+            self.slots = new_slots
+        self.ids[name] = i_name
+        self.names.append(name)
+        return i_name
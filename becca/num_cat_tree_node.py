@@ -13,15 +13,27 @@ import numpy as np
 class NumCatTreeNode(object):
     """
     A node in the category tree for numerical categories.
+
+    A leaf can't keep every value it has ever seen. A sensor reporting
+    at 100 Hz would grow it without bound. Instead it keeps
+    two summaries whose size doesn't change over the life of the brain.
+        The count, mean and sum of squared deviations of all the values,
+        updated with Welford's method. These give the variance exactly.
+        A reservoir sample of up to reservoir_size of the values, each
+        one equally likely to have been kept. Candidate splits are
+        scored on this sample, and it is handed down to the children
+        when the node splits.
+    Until a leaf has seen more than reservoir_size values,
+    the sample holds all of them and nothing is approximated.
     """
     def __init__(
         self,
         bounds=None,
         depth=0.,
         i_input=0,
-        n_candidates=10,
         parent=None,
         position=0.,
+        reservoir_size=1000,
     ):
         """
         Create a new node.
@@ -36,13 +48,13 @@ class NumCatTreeNode(object):
             a more apt metaphor). The root is always at depth 0.
         @param i_input: int
             The index of this feature in the input vector.
-        @param n_candidates: int
-            The number of candidates to evaluate for each split.
         @param parent: NumCatTreeNode
             This is the node just higher in the tree.
         @param position: float
             The position of this node on the number line used for
             sorting them in visualization.
+        @param reservoir_size: int
+            The largest number of observed values to keep.
         """
         # lo_child, hi_child : NumCatTreeNodes
         #     The two children that belong (or will belong) to this node.
@@ -55,13 +67,28 @@ class NumCatTreeNode(object):
         #     Is this node a leaf int the tree? All nodes are when they
         #     are first created.
         self.leaf = True
-        # observations: list of floats
-        #     The set of values observed that belong to this node.
-        self.observations = []
+        # reservoir_size: int
+        #     The largest number of observed values to keep.
+        # reservoir: array of floats
+        #     A uniform random sample of the values observed that belong
+        #     to this node. It starts out small and is doubled as
+        #     needed, up to reservoir_size.
+        # n_reservoir: int
+        #     The number of values in the reservoir.
+        self.reservoir_size = reservoir_size
+        self.reservoir = np.zeros(0)
+        self.n_reservoir = 0
         # n_observations: int
         #     The total number of observations for which this node was
         #     the matching leaf.
+        # mean: float
+        #     The mean of all the observed values.
+        # sum_sq_dev: float
+        #     The sum of the squared deviations of all the observed
+        #     values from their mean.
         self.n_observations = 0
+        self.mean = 0.
+        self.sum_sq_dev = 0.
 
         if bounds is None:
             self.lo_bound = -np.inf
@@ -71,7 +98,6 @@ class NumCatTreeNode(object):
             self.hi_bound = bounds[1]
         self.depth = depth
         self.i_input = i_input
-        self.n_candidates = n_candidates
         self.position = position
 
     def __str__(self):
@@ -95,7 +121,29 @@ class NumCatTreeNode(object):
         @return float
             The variance of observations so far.
         """
-        return np.var(np.array(self.observations))
+        if self.n_observations == 0:
+            return 0.
+        return self.sum_sq_dev / self.n_observations
+
+    def observations(self):
+        """
+        Get the sample of observed values.
+
+        @return array of floats
+            The values in the reservoir. If no more than reservoir_size
+            values have been observed, this is all of them.
+        """
+        return self.reservoir[:self.n_reservoir]
+
+    def sample_weight(self):
+        """
+        Find how many observations each value in the reservoir stands for.
+
+        @return float
+        """
+        if self.n_reservoir == 0:
+            return 1.
+        return self.n_observations / self.n_reservoir
 
     def has(self, value):
         """
@@ -118,8 +166,95 @@ class NumCatTreeNode(object):
 
         @param new_value: float
         """
-        self.observations.append(new_value)
         self.n_observations += 1
+        delta = new_value - self.mean
+        self.mean += delta / self.n_observations
+        self.sum_sq_dev += delta * (new_value - self.mean)
+
+        # Algorithm R: the nth value replaces a random member of a full
+        # reservoir with probability reservoir_size / n.
+        if self.n_reservoir < self.reservoir_size:
+            self._reserve(1)
+            self.reservoir[self.n_reservoir] = new_value
+            self.n_reservoir += 1
+        elif self.reservoir_size > 0:
+            i_sample = np.random.randint(self.n_observations)
+            if i_sample < self.reservoir_size:
+                self.reservoir[i_sample] = new_value
+
+    def add_many(self, new_values):
+        """
+        Grow a leaf's collection of observed values by several at once.
+
+        This has the same effect as calling add on each of them in turn,
+        except for which values are kept in the reservoir.
+
+        @param new_values: array of floats
+        """
+        n_new = new_values.size
+        if n_new == 0:
+            return
+        # Combine the moments of the old and new values,
+        # as in Chan, Golub and LeVeque's pairwise update.
+        n_old = self.n_observations
+        n_total = n_old + n_new
+        new_mean = np.mean(new_values)
+        delta = new_mean - self.mean
+        self.mean += delta * n_new / n_total
+        self.sum_sq_dev += (
+            np.sum((new_values - new_mean) ** 2)
+            + delta ** 2 * n_old * n_new / n_total)
+
+        # Fill up the reservoir first, then run Algorithm R on the rest.
+        n_fill = max(0, min(n_new, self.reservoir_size - self.n_reservoir))
+        if n_fill > 0:
+            self._reserve(n_fill)
+            self.reservoir[self.n_reservoir:self.n_reservoir + n_fill] = (
+                new_values[:n_fill])
+            self.n_reservoir += n_fill
+        if n_fill < n_new and self.reservoir_size > 0:
+            # The position of each remaining value in the whole stream
+            ns = n_old + n_fill + 1 + np.arange(n_new - n_fill)
+            i_samples = (np.random.random_sample(ns.size) * ns).astype(int)
+            # Go in order, so that later values replace earlier ones.
+            for i_new in np.where(i_samples < self.reservoir_size)[0]:
+                self.reservoir[i_samples[i_new]] = new_values[n_fill + i_new]
+        self.n_observations = n_total
+
+    def _reserve(self, n_new):
+        """
+        Make sure the reservoir has room for n_new more values.
+
+        It is doubled in size as needed, up to reservoir_size.
+
+        @param n_new: int
+        """
+        n_needed = self.n_reservoir + n_new
+        if n_needed <= self.reservoir.size:
+            return
+        new_size = min(
+            max(2 * self.reservoir.size, n_needed, 16), self.reservoir_size)
+        self.reservoir = np.concatenate((
+            self.reservoir, np.zeros(new_size - self.reservoir.size)))
+
+    def add_sample(self, values, weight=1.):
+        """
+        Start an empty node out with a sample of values.
+
+        Each value stands for weight observations. This is how
+        a splitting node passes its observations on to its children.
+
+        @param values: array of floats
+        @param weight: float
+        """
+        self.reservoir = np.array(values[:self.reservoir_size], dtype=float)
+        self.n_reservoir = self.reservoir.size
+        values = self.reservoir
+        if values.size == 0:
+            return
+        self.n_observations = int(np.round(weight * values.size))
+        self.mean = np.mean(values)
+        self.sum_sq_dev = weight * np.sum((values - self.mean) ** 2)
 
     # def split(self, split_value, i_input):
     # def split(self, split_value, input_pool):
@@ -144,19 +279,22 @@ class NumCatTreeNode(object):
             # i_input=input_pool.pop(),
             i_input=i_input,
             position=self.position + delta,
+            reservoir_size=self.reservoir_size,
         )
         self.hi_child = NumCatTreeNode(
             bounds=hi_bounds,
             depth=self.depth + 1,
             i_input=i_input + 1,
             position=self.position - delta,
+            reservoir_size=self.reservoir_size,
         )
-        for value in self.observations:
-            if value < split_value:
-                self.lo_child.add(value)
-            else:
-                self.hi_child.add(value)
-        self.observations = []
+        vals = self.observations()
+        weight = self.sample_weight()
+        self.lo_child.add_sample(vals[np.where(vals < split_value)], weight)
+        self.hi_child.add_sample(vals[np.where(vals >= split_value)], weight)
+        # Only leaves need to keep their observations.
+        self.reservoir = np.zeros(0)
+        self.n_reservoir = 0
         self.leaf = False
         return
 
@@ -166,9 +304,10 @@ class NumCatTreeNode(object):
 
         @param float: split_candidate
         @return float
-            The quality of the proposed split.
+            The quality of the proposed split, estimated from the
+            reservoir sample and scaled up to all the observations.
         """
-        vals = np.array(self.observations)
+        vals = self.observations()
         lo_vals = vals[np.where(vals < split_candidate)]
         hi_vals = vals[np.where(vals >= split_candidate)]
         if lo_vals.size > 0:
@@ -179,32 +318,54 @@ class NumCatTreeNode(object):
             hi_spread = np.sum((hi_vals - np.mean(hi_vals))**2)
         else:
             hi_spread = 0.
-        return lo_spread + hi_spread
+        return (lo_spread + hi_spread) * self.sample_weight()
 
     def find_best_split(self):
         """
-        Try several options and find the best split candidate.
+        Find the split that reduces the spread of the values the most.
+
+        The values are sorted once. Cumulative sums of the values and
+        their squares then give the spread on either side of every
+        possible split point in a single pass, so the best one is
+        found exactly. Splits fall halfway between neighboring values.
 
         @returns (float, float)
             The value to split on and the split quality.
         """
+        vals = np.sort(self.observations())
+        if vals.size == 0:
+            return (self.lo_bound, 0.)
+        lo_split_bound = vals[0]
+        if vals[-1] == lo_split_bound:
+            return (lo_split_bound, 0.)
+
+        # Centering keeps the sums of squares from losing precision
+        # to cancellation.
+        vals_centered = vals - np.mean(vals)
+        sums = np.cumsum(vals_centered)
+        sums_sq = np.cumsum(vals_centered ** 2)
+        n_vals = vals.size
+        total_sum = sums[-1]
+        total_sum_sq = sums_sq[-1]
+        original_spread = total_sum_sq - total_sum ** 2 / n_vals
+
+        # Split i puts vals[:i + 1] below and vals[i + 1:] above.
+        n_lo = np.arange(1, n_vals)
+        lo_sums = sums[:-1]
+        hi_sums = total_sum - lo_sums
+        lo_spread = sums_sq[:-1] - lo_sums ** 2 / n_lo
+        hi_spread = (total_sum_sq - sums_sq[:-1]) - hi_sums ** 2 / (
+            n_vals - n_lo)
+        changes = original_spread - (lo_spread + hi_spread)
+        # A split can't fall between two copies of the same value.
+        changes[vals[1:] == vals[:-1]] = -np.inf
 
-        vals = np.array(self.observations)
-        original_spread = np.sum((vals - np.mean(vals))**2)
-
-        # Generate candidates.
-        lo_split_bound = np.min(self.observations)
-        hi_split_bound = np.max(self.observations)
-        split_candidates = lo_split_bound + (
-            hi_split_bound - lo_split_bound) * (
-                np.random.random_sample(size=self.n_candidates))
-
-        biggest_change = 0.
-        best_candidate = lo_split_bound
-        for candidate in split_candidates:
-            new_spread = self.evaluate(candidate)
-            new_change = original_spread - new_spread
-            if new_change > biggest_change:
-                biggest_change = new_change
-                best_candidate = candidate
+        i_best = np.argmax(changes)
+        biggest_change = changes[i_best] * self.sample_weight()
+        if biggest_change <= 0.:
+            return (lo_split_bound, 0.)
+        best_candidate = (vals[i_best] + vals[i_best + 1]) / 2.
+        # Neighboring values can be too close to have a float between.
+        if best_candidate <= vals[i_best]:
+            best_candidate = vals[i_best + 1]
         return (best_candidate, biggest_change)
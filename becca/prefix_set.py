@@ -0,0 +1,84 @@
+"""
+The PrefixSet class.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+import becca.tools as tools
+
+
+class PrefixSet(object):
+    """
+    An index of the prefixes that have a non-zero value.
+
+    Feature activities and goals are sparse, so at any given time
+    only a small fraction of the feature-goal prefixes have any
+    activity or credit. Keeping a list of them lets the model
+    kernels skip over all the others. Their updates would have no
+    effect anyway.
+
+    Prefixes are stored as a pair of arrays, listing the feature and
+    goal indices of each member, and a 2D mask for quick membership
+    checks. The numba kernels that update the prefixes add and remove
+    members in place.
+    """
+    def __init__(self, n_features, initial_size=2**6):
+        """
+        Parameters
+        ----------
+        n_features : int
+            The number of features there is room for, including
+            the model's internal features.
+        initial_size : int
+            The number of members to make room for at first.
+        """
+        # size : int
+        #     The number of members there is currently room for.
+        self.size = initial_size
+        # features, goals : array of ints
+        #     The feature and goal index of each prefix in the set.
+        #     Only the first n_members are valid.
+        self.features = -np.ones(self.size, dtype=np.int32)
+        self.goals = -np.ones(self.size, dtype=np.int32)
+        # n_members : int
+        #     The number of prefixes currently in the set.
+        self.n_members = 0
+        # mask : 2D array of bools
+        #     True for each prefix that is a member of the set.
+        self.mask = np.zeros((n_features, n_features), dtype=np.bool_)
+
+    def __len__(self):
+        return self.n_members
+
+    def reserve(self, n_new):
+        """
+        Make sure there is room to add n_new members.
+
+        Parameters
+        ----------
+        n_new : int
+            An upper bound on the number of members about to be added.
+        """
+        if self.n_members + n_new <= self.size:
+            return
+        while self.n_members + n_new > self.size:
+            self.size *= 2
+        self.features = tools.pad(
+            self.features, self.size, val=-1, dtype=np.int32)
+        self.goals = tools.pad(
+            self.goals, self.size, val=-1, dtype=np.int32)
+
+    def grow(self, n_features):
+        """
+        Make room in the mask for features up to n_features.
+
+        Parameters
+        ----------
+        n_features : int
+            The new number of features, including the model's
+            internal features.
+        """
+        self.mask = tools.pad(
+            self.mask, [n_features, n_features], val=False, dtype=np.bool_)
@@ -0,0 +1,120 @@
+"""
+The SensorBank class.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+import becca.cat_tree_numba as nb
+
+
+class SensorBank(object):
+    """
+    Categorize the numeric values of many sensors at once.
+
+    Each sensor has its own Discretizer, with a numeric category tree.
+    Stepping them one at a time costs several Python calls per sensor
+    per time step, which adds up with thousands of sensors. The bank
+    lays all the numeric trees end to end in one set of flattened
+    arrays (see cat_tree_numba), so that a single compiled call
+    categorizes the whole sensor vector.
+
+    The leaves' statistics live in the tree nodes, and updating them
+    one value at a time would bring back the per-sensor calls.
+    Instead, the values are held in a buffer and handed to the trees
+    in bulk when it fills up, or when the trees are about to grow.
+    The trees only change shape when they grow, so categorizing
+    against them in the meantime gives the same result.
+    """
+    def __init__(self, discretizers, buffer_size=int(1e3)):
+        """
+        Parameters
+        ----------
+        discretizers : list of Discretizers
+            One for each sensor. Only their numeric trees are used.
+        buffer_size : int
+            The number of time steps of sensor values to hold
+            before passing them on to the trees.
+        """
+        self.discretizers = discretizers
+        self.n_sensors = len(discretizers)
+        # buffer : 2D array of floats
+        #     The most recent sensor values, one row per time step.
+        #     Values that aren't finite belong to string categories
+        #     and are ignored.
+        # n_buffered : int
+        #     The number of rows of the buffer in use.
+        self.buffer_size = buffer_size
+        self.buffer = np.zeros((self.buffer_size, self.n_sensors))
+        self.n_buffered = 0
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Lay the sensors' numeric trees out end to end.
+
+        This needs to be done whenever any of the trees grows.
+        """
+        trees = [discretizer.numeric_cats
+                 for discretizer in self.discretizers]
+        n_nodes = np.array([tree.split_values.size for tree in trees],
+                           dtype=int)
+        # i_roots : array of ints
+        #     The index of each sensor's root node.
+        self.i_roots = np.cumsum(n_nodes) - n_nodes
+        # split_values, lo_children, hi_children, i_inputs : arrays
+        #     The flattened trees, as described in cat_tree_numba.
+        self.split_values = np.concatenate(
+            [tree.split_values for tree in trees])
+        self.lo_children = np.concatenate([
+            np.where(tree.lo_children == -1, -1, tree.lo_children + i_root)
+            for tree, i_root in zip(trees, self.i_roots)])
+        self.hi_children = np.concatenate([
+            np.where(tree.hi_children == -1, -1, tree.hi_children + i_root)
+            for tree, i_root in zip(trees, self.i_roots)])
+        self.i_inputs = np.concatenate([tree.i_inputs for tree in trees])
+        # lineage : array of ints
+        #     Scratch space for cat_tree_numba.categorize_all.
+        max_depth = max([int(tree.depth) for tree in trees] + [0])
+        self.lineage = np.zeros(max_depth + 1, dtype=int)
+
+    def step(self, values, input_activities):
+        """
+        Categorize the numeric value of every sensor.
+
+        Parameters
+        ----------
+        values : array of floats
+            The value of each sensor. Sensors whose values aren't
+            finite are skipped.
+        input_activities : array of floats
+            The under-construction array of input activities
+            for this time step. Modified.
+        """
+        if self.n_buffered == self.buffer_size:
+            self.flush()
+        self.buffer[self.n_buffered] = values
+        self.n_buffered += 1
+        # As in CatTree.categorize, the discount is held at .5 for now.
+        nb.categorize_all(
+            values,
+            self.i_roots,
+            self.split_values,
+            self.lo_children,
+            self.hi_children,
+            self.i_inputs,
+            .5,
+            self.lineage,
+            input_activities)
+
+    def flush(self):
+        """
+        Add the buffered values to the numeric trees.
+        """
+        for i_sensor, discretizer in enumerate(self.discretizers):
+            values = self.buffer[:self.n_buffered, i_sensor]
+            values = values[np.isfinite(values)]
+            if values.size > 0:
+                discretizer.numeric_cats.add_many(values)
+        self.n_buffered = 0
@@ -0,0 +1,252 @@
+"""
+The SparseSequences class.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+import becca.model_numba as nb
+
+
+class SparseSequences(object):
+    """
+    A hashed store for the model's sequence occurrences.
+
+    The dense sequence_occurrences array has N**3 elements, one for
+    each feature-goal-feature sequence. Nearly all of them stay at their
+    initial value of one for the life of the brain. This store keeps
+    only the sequences that have been observed, in an open-addressing
+    hash table. Each key is the (feature, goal, next feature) triplet
+    packed into a single int64,
+        key = (i_feature * N + i_goal) * N + j_feature,
+    and every sequence that isn't in the table is assumed
+    to still hold the default value.
+
+    Memory grows with the number of observed sequences, rather than
+    with the cube of the number of features.
+    """
+    def __init__(
+        self,
+        n_features,
+        default=1.,
+        dtype=np.float64,
+        initial_size=2**10,
+    ):
+        """
+        Set up an empty table.
+
+        Parameters
+        ----------
+        n_features : int
+            The number of features, N, including the model's
+            internal features.
+        default : float
+            The value of every sequence that hasn't been stored yet.
+        dtype : numpy dtype
+            The floating point type of the stored occurrences.
+        initial_size : int
+            The number of slots to start out with. This is rounded up
+            to a power of two.
+        """
+        self.n_features = n_features
+        self.default = default
+        # max_load : float
+        #     The fraction of slots that can be filled before the
+        #     table is grown. Linear probing gets slow when it
+        #     gets much fuller than half.
+        self.max_load = .5
+        # size : int
+        #     The number of slots in the table. Always a power of two.
+        self.size = int(2 ** np.ceil(np.log2(max(initial_size, 2))))
+        # keys : array of ints
+        #     The packed sequence indices. Empty slots are -1.
+        # values : array of floats
+        #     The occurrences associated with each key.
+        self.keys = -np.ones(self.size, dtype=np.int64)
+        self.values = np.zeros(self.size, dtype=dtype)
+        # n_entries : int
+        #     The number of sequences stored so far.
+        self.n_entries = 0
+
+    def __getitem__(self, indices):
+        """
+        Look up the occurrences of a single sequence.
+
+        Parameters
+        ----------
+        indices : tuple of (int, int, int)
+            The (feature, goal, next feature) of the sequence.
+
+        Returns
+        -------
+        occurrences : float
+        """
+        i_feature, i_goal, j_feature = indices
+        key = (i_feature * self.n_features + i_goal) * self.n_features
+        key += j_feature
+        return nb.get_sparse_sequence(
+            self.keys, self.values, key, self.default)
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes held by the table.
+        """
+        return self.keys.nbytes + self.values.nbytes
+
+    def reserve(self, n_new):
+        """
+        Make sure there is room to add n_new sequences.
+
+        Parameters
+        ----------
+        n_new : int
+            An upper bound on the number of sequences about to be added.
+        """
+        new_size = self.size
+        while self.n_entries + n_new > self.max_load * new_size:
+            new_size *= 2
+        if new_size == self.size:
+            return
+
+        new_keys = -np.ones(new_size, dtype=np.int64)
+        new_values = np.zeros(new_size, dtype=self.values.dtype)
+        nb.rehash_sparse_sequences(
+            self.keys, self.values, new_keys, new_values)
+        self.keys = new_keys
+        self.values = new_values
+        self.size = new_size
+
+    def update(self, model, postfeatures):
+        """
+        Add the latest round of observed sequences.
+
+        This is the sparse counterpart of model_numba.update_sequences.
+
+        Parameters
+        ----------
+        model : Model
+            The model these sequences belong to. Its active prefixes,
+            their activities and its new FAIs are used.
+        postfeatures : array of ints
+            The features that can follow the prefixes.
+        """
+        active_prefixes = model.active_prefixes
+        n_candidates = nb.count_sequence_candidates(
+            active_prefixes.features,
+            active_prefixes.goals,
+            active_prefixes.n_members,
+            postfeatures,
+            model.FAIs,
+            model.timestep,
+            model.prefix_decay_rate,
+            model.prefix_activities,
+            model.prefix_activity_steps)
+        if n_candidates == 0:
+            return
+        self.reserve(n_candidates)
+        self.n_entries += nb.update_sparse_sequences(
+            active_prefixes.features,
+            active_prefixes.goals,
+            active_prefixes.n_members,
+            postfeatures,
+            model.FAIs,
+            model.timestep,
+            model.prefix_decay_rate,
+            model.prefix_activities,
+            model.prefix_activity_steps,
+            self.n_features,
+            self.default,
+            self.keys,
+            self.values)
+
+    def reset_features(self, features):
+        """
+        Drop every stored sequence that involves any of a set of features.
+
+        Those sequences go back to the default value.
+
+        Parameters
+        ----------
+        features : array of ints
+        """
+        occupied = self.keys > -1
+        keys = self.keys[occupied]
+        n = self.n_features
+        involved = (
+            np.isin(keys // (n * n), features)
+            | np.isin((keys // n) % n, features)
+            | np.isin(keys % n, features))
+        if not np.any(involved):
+            return
+        kept_keys = -np.ones(self.size, dtype=np.int64)
+        kept_keys[np.where(occupied)[0][~involved]] = keys[~involved]
+        new_keys = -np.ones(self.size, dtype=np.int64)
+        new_values = np.zeros(self.size, dtype=self.values.dtype)
+        nb.rehash_sparse_sequences(
+            kept_keys, self.values, new_keys, new_values)
+        self.keys = new_keys
+        self.values = new_values
+        self.n_entries -= int(np.sum(involved))
+
+    def renormalize(self, prefix_mask):
+        """
+        Halve how far each stored sequence of some prefixes is above default.
+
+        This is the sparse counterpart of the renormalization in
+        Model._renormalize_counters.
+
+        Parameters
+        ----------
+        prefix_mask : 2D array of bools
+            True for each (feature, goal) prefix to renormalize.
+            Every stored sequence has to start with a feature and
+            a goal that fall within it.
+        """
+        occupied = np.where(self.keys > -1)[0]
+        keys = self.keys[occupied]
+        n = self.n_features
+        slots = occupied[prefix_mask[keys // (n * n), (keys // n) % n]]
+        self.values[slots] = self.default + .5 * (
+            self.values[slots] - self.default)
+
+    def max_postfeature(self, n_rows=None):
+        """
+        Find the largest occurrence over all next features for each prefix.
+
+        Parameters
+        ----------
+        n_rows : int, optional
+            The number of features to report on. Every stored sequence
+            has to start with a feature and a goal below this.
+            By default, all n_features.
+
+        Returns
+        -------
+        max_occurrences : 2D array of floats
+            The equivalent of np.max(sequence_occurrences, axis=2).
+        """
+        if n_rows is None:
+            n_rows = self.n_features
+        max_occurrences = self.default * np.ones((n_rows, n_rows))
+        nb.max_sparse_sequences(
+            self.keys, self.values, self.n_features, max_occurrences)
+        return max_occurrences
+
+    def to_dense(self):
+        """
+        Expand the table into a full N x N x N array.
+
+        This is for inspection and debugging only. It needs all the
+        memory that the sparse store was built to avoid.
+
+        Returns
+        -------
+        sequence_occurrences : 3D array of floats
+        """
+        n = self.n_features
+        dense = self.default * np.ones(n ** 3)
+        occupied = np.where(self.keys > -1)[0]
+        dense[self.keys[occupied]] = self.values[occupied]
+        return dense.reshape((n, n, n))
@@ -7,15 +7,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import operator
 import numpy as np
 
+from becca.name_table import NameTable
 import becca.str_cat_utils as scu
 
 
 class StrCatTreeNode(object):
     """
     A node in the category tree for string categories.
+
+    Every string is interned in a NameTable shared by the whole tree.
+    A leaf keeps the ids of its strings and their counts in
+    a pair of arrays. The table records where each string's count is,
+    so adding an observation takes constant time. Variances and
+    split scores are computed from the count arrays in closed form.
     """
     def __init__(
         self,
@@ -23,7 +29,7 @@ class StrCatTreeNode(object):
         depth=0.,
         i_input=0,
         in_crowd=None,
-        n_candidates=10,
+        name_table=None,
         parent=None,
         position=0.,
     ):
@@ -41,8 +47,9 @@ class StrCatTreeNode(object):
         @param in_crowd: list of strings
             These are the names that belong to this node.
             If it is a catch_all, then the in_crowd will be empty.
-        @param n_candidates: int
-            The number of candidates to evaluate for each split.
+        @param name_table: NameTable
+            The table of strings shared by the tree.
+            If None, the node starts a new one.
         @param parent: StrCatTreeNode
             This is the node just higher in the tree.
         @param position: float
@@ -58,10 +65,22 @@ class StrCatTreeNode(object):
         #     Is this node a leaf int the tree? All nodes are when they
         #     are first created.
         self.leaf = True
-        # observations: dict of {string: int}
-        #     The strings observed in this node during recent history.
-        #     Each string has an associated count.
-        self.observations = {}
+        # name_table: NameTable
+        #     The ids of all the strings in the tree, and the leaf
+        #     each one belongs to.
+        if name_table is None:
+            name_table = NameTable()
+        self.name_table = name_table
+        # name_ids: array of ints
+        #     The ids of the strings observed in this node.
+        # counts: array of ints
+        #     The number of times each of these strings was observed.
+        # n_names: int
+        #     The number of distinct strings in this node. Only the
+        #     first n_names elements of name_ids and counts are valid.
+        self.name_ids = np.zeros(0, dtype=int)
+        self.counts = np.zeros(0, dtype=int)
+        self.n_names = 0
         # n_observations: int
         #     The total number of observations for which this node was
         #     the matching leaf.
@@ -69,9 +88,9 @@ class StrCatTreeNode(object):
 
         self.catch_all = catch_all
         self.depth = depth
-        self.in_crowd = in_crowd
+        # in_crowd: set of strings
+        self.in_crowd = set(in_crowd) if in_crowd is not None else set()
         self.i_input = i_input
-        self.n_candidates = n_candidates
         self.position = position
 
     def __str__(self):
@@ -79,13 +98,13 @@ class StrCatTreeNode(object):
         Create a useful string representation.
 
         This method is called when
-        print(NumCatTreeNode) is run.
+        print(StrCatTreeNode) is run.
 
         @return: string
         """
         n_names = 3
         top_names, _ = self.top_n_names(n_names)
-        node_str = (str(len(list(self.observations.keys()))) +
+        node_str = (str(self.n_names) +
                     ' member categories, including  ')
         for name in top_names:
             node_str += ''.join(['\'', name, '\', '])
@@ -99,7 +118,7 @@ class StrCatTreeNode(object):
         @return float
             The variance of observations so far.
         """
-        return scu.variance(self.observations)
+        return scu.variance(self.counts[:self.n_names])
 
     def top_n_names(self, n_names):
         """
@@ -112,18 +131,11 @@ class StrCatTreeNode(object):
             The top n most common names
             and the number of times each has occcurred.
         """
-        names = []
-        counts = []
-        if len(list(self.observations.keys())) == 0:
-            return names, counts
-        if len(list(self.observations.keys())) <= n_names:
-            n_names = len(self.observations)
-        sorted_names = sorted(self.observations.items(),
-                              key=operator.itemgetter(1))
-        for i in range(n_names):
-            names.append(sorted_names[i][0])
-            counts.append(sorted_names[i][1])
-        return names, counts
+        counts = self.counts[:self.n_names]
+        order = np.argsort(-counts, kind='stable')[:n_names]
+        names = [self.name_table.names[self.name_ids[i_slot]]
+                 for i_slot in order]
+        return names, list(counts[order])
 
     def has(self, name):
         """
@@ -147,12 +159,54 @@ class StrCatTreeNode(object):
         Grow a leaf's collection of observed names.
 
         @param new_name: string
+        @param count: int
         """
-        if new_name in self.observations:
-            self.observations[new_name] += count
+        i_name = self.name_table.find(new_name)
+        if i_name == -1:
+            i_name = self.name_table.intern(new_name)
+            self.add_ids(np.array([i_name]), np.array([count]))
         else:
-            self.observations[new_name] = count
-        self.n_observations += count
+            self.counts[self.name_table.slots[i_name]] += count
+            self.n_observations += count
+
+    def add_ids(self, name_ids, counts):
+        """
+        Add interned names that aren't in the leaf yet.
+
+        The name table is updated to show that they belong here.
+
+        @param name_ids: array of ints
+        @param counts: array of ints
+        """
+        n_new = name_ids.size
+        if self.n_names + n_new > self.name_ids.size:
+            new_size = max(2 * self.name_ids.size, self.n_names + n_new, 4)
+            new_name_ids = np.zeros(new_size, dtype=int)
+            new_name_ids[:self.n_names] = self.name_ids[:self.n_names]
+            self.name_ids = new_name_ids
+            new_counts = np.zeros(new_size, dtype=int)
+            new_counts[:self.n_names] = self.counts[:self.n_names]
+            self.counts = new_counts
+        slots = np.arange(self.n_names, self.n_names + n_new)
+        self.name_ids[slots] = name_ids
+        self.counts[slots] = counts
+        self.name_table.leaves[name_ids] = self
+        self.name_table.slots[name_ids] = slots
+        self.n_names += n_new
+        self.n_observations += int(np.sum(counts))
+
+    def in_crowd_mask(self, split_names):
+        """
+        Find which of the leaf's names are in a list.
+
+        @param split_names: list of strings
+
+        @return: array of bools
+            True for each of the first n_names slots whose name
+            is in split_names.
+        """
+        split_ids = [self.name_table.find(name) for name in split_names]
+        return np.isin(self.name_ids[:self.n_names], split_ids)
 
     # def split(self, split_names, input_pool):
     def split(self, split_names, i_input):
@@ -175,21 +229,26 @@ class StrCatTreeNode(object):
             # i_input=input_pool.pop(),
             i_input=i_input,
             in_crowd=split_names,
+            name_table=self.name_table,
             position=self.position + delta,
         )
         self.lo_child = StrCatTreeNode(
             depth=self.depth + 1,
             # i_input=input_pool.pop(),
             i_input=i_input + 1,
+            name_table=self.name_table,
             position=self.position - delta,
         )
 
-        for name, count in self.observations.items():
-            if name in self.hi_child.in_crowd:
-                self.hi_child.add(name, count)
-            else:
-                self.lo_child.add(name, count)
-        self.observations = []
+        name_ids = self.name_ids[:self.n_names]
+        counts = self.counts[:self.n_names]
+        is_in = self.in_crowd_mask(split_names)
+        self.hi_child.add_ids(name_ids[is_in], counts[is_in])
+        self.lo_child.add_ids(
+            name_ids[np.logical_not(is_in)], counts[np.logical_not(is_in)])
+        self.name_ids = np.zeros(0, dtype=int)
+        self.counts = np.zeros(0, dtype=int)
+        self.n_names = 0
         self.leaf = False
 
     def evaluate(self, split_candidate):
@@ -200,20 +259,17 @@ class StrCatTreeNode(object):
         @return float
             The quality of the proposed split.
         """
-        in_names = {}
-        out_names = {}
-        for name, count in self.observations.items():
-            if name in split_candidate:
-                in_names[name] = count
-            else:
-                out_names[name] = count
-        return in_names.variance() + out_names.variance()
+        counts = self.counts[:self.n_names]
+        is_in = self.in_crowd_mask(split_candidate)
+        return (scu.variance(counts[is_in])
+                + scu.variance(counts[np.logical_not(is_in)]))
 
     def find_best_split(self):
         """
-        Try several options and find the best split candidate.
+        Find the best split candidate.
 
         For now, just consider splitting on one name at a time.
+        Every name is tried, all at once.
 
         @returns a tuple of (list of strings, float)
             The in group names to split on and
@@ -221,23 +277,14 @@ class StrCatTreeNode(object):
         """
         biggest_change = 0.
         best_candidate = []
-        if len(self.observations.keys()) > 1:
+        if self.n_names > 1:
             original_variance = self.variance()
-
-            # Generate candidates.
-            if len(self.observations.keys()) < self.n_candidates:
-                candidates = self.observations.keys()
-            else:
-                candidates = np.random.choice(
-                    self.observations.keys(),
-                    size=self.n_candidates,
-                    replace=False)
-
-            for candidate in candidates:
-                new_variance = self.evaluate(candidate)
-                new_change = original_variance - new_variance
-                if new_change > biggest_change:
-                    biggest_change = new_change
-                    best_candidate = candidate
+            changes = original_variance - scu.single_out_variances(
+                self.counts[:self.n_names])
+            i_best = np.argmax(changes)
+            if changes[i_best] > biggest_change:
+                biggest_change = changes[i_best]
+                best_candidate = [
+                    self.name_table.names[self.name_ids[i_best]]]
 
         return (best_candidate, biggest_change)
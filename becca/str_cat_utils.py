@@ -7,31 +7,54 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import numpy as np
 
-def variance(names):
+
+def variance(counts):
     """
     Determine a variance-like quantity for a set of strings.
 
-    @param names: dict of <string, int>
-        A set strings to find variance for, and their associated counts.
+    For now, the distance between two strings is
+        0 if the strings are identical
+        1 if the strings aren't identical.
+    The variance is the sum of the distances between every pair of
+    observations with different strings, divided by the number of
+    observations. With n the total count and c_i the count of each
+    string, this comes out to
+        (sum over i != j of c_i * c_j) / n = n - (sum of c_i**2) / n.
+    TODO: Create a more sophisticated measure of
+    the distance between two strings.
+
+    @param counts: array of ints
+        The number of times each distinct string has been observed.
     @return: float
         A variance-like measure of how distributed the items are.
     """
-    # In case there is only one name or no names.
-    if len(names.keys()) < 2:
+    counts = np.asarray(counts, dtype=float)
+    total = np.sum(counts)
+    if total == 0.:
         return 0.
+    return total - np.sum(counts ** 2) / total
 
-    total_distance = 0.
-    sum_counts = 0.
-    for name_a, count_a in names.items():
-        sum_counts += count_a
-        for name_b, count_b in names.items():
-            if name_a != name_b:
-                # TODO: Create a more sophisticated measure of
-                # the distance between two strings.
-                # In it's current form it is
-                #     0 if the strings are identical
-                #     1 if the strings aren't identical
-                distance_a_b = 1.
-                total_distance += distance_a_b * count_a * count_b
-    return total_distance / sum_counts
+
+def single_out_variances(counts):
+    """
+    Find the variance left after splitting off each string on its own.
+
+    A string by itself has no variance, so this is
+    the variance of all the others.
+
+    @param counts: array of ints
+        The number of times each distinct string has been observed.
+    @return: array of floats
+        For each string, the variance of all the other strings.
+    """
+    counts = np.asarray(counts, dtype=float)
+    rest_totals = np.sum(counts) - counts
+    rest_sums_sq = np.sum(counts ** 2) - counts ** 2
+    variances = np.zeros(counts.size)
+    has_rest = rest_totals > 0.
+    variances[has_rest] = (
+        rest_totals[has_rest]
+        - rest_sums_sq[has_rest] / rest_totals[has_rest])
+    return variances
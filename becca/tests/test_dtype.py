@@ -0,0 +1,157 @@
+"""
+Check that reduced precision learns nearly the same as float64.
+
+Each Model runs on the same fixed-seed toy world, once with float64
+state and once with float32. The goals it chooses, the fitness
+of its features and what it learns about sequences should match.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from becca.model import Model
+
+
+def run_world(
+    dtype,
+    counter_dtype=None,
+    counter_limit=None,
+    fused_step=False,
+    sequence_backend='dense',
+    n_steps=3000,
+):
+    """
+    Step a Model through a small, partly controllable world.
+
+    The world has n_states states, each of which is a feature.
+    When the model's goal is the next state around the ring,
+    it moves there and is rewarded. Otherwise it wanders at random.
+    A few other features flicker on and off as noise.
+
+    Returns
+    -------
+    goals : array of ints
+        The goal the model chose on each time step.
+    model : Model
+    """
+    n_states = 6
+    n_noise = 4
+    n_features = n_states + n_noise
+    world_rng = np.random.RandomState(7)
+    # The model breaks ties between goals with np.random.
+    np.random.seed(11)
+    model = Model(
+        n_features,
+        None,
+        counter_dtype=counter_dtype,
+        dtype=dtype,
+        fused_step=fused_step,
+        sequence_backend=sequence_backend,
+    )
+    if counter_limit is not None:
+        model.counter_limit = counter_limit
+    live_features = np.arange(n_features)
+
+    state = 0
+    reward = 0.
+    goals = np.zeros(n_steps, dtype=int)
+    for i_step in range(n_steps):
+        feature_activities = np.zeros(n_features)
+        feature_activities[state] = 1.
+        feature_activities[n_states:] = (
+            world_rng.random_sample(n_noise) < .2)
+        feature_goals = model.step(feature_activities, live_features, reward)
+        goal = int(np.argmax(feature_goals))
+        goals[i_step] = goal
+
+        next_state = (state + 1) % n_states
+        if goal == next_state:
+            state = next_state
+            reward = 1.
+        else:
+            state = world_rng.randint(n_states)
+            reward = 0.
+    model.settle()
+    return goals, model
+
+
+def dense_sequences(model):
+    """
+    Get the sequence occurrences of the live features as a dense array.
+    """
+    n = model.capacity
+    if model.sequence_backend == 'sparse':
+        return model.sequence_occurrences.to_dense()[:n, :n, :n]
+    return model.sequence_occurrences
+
+
+def assert_close(
+    model_64, model_32, goals_64, goals_32, rtol, sequence_atol=None):
+    assert np.array_equal(goals_64, goals_32)
+    np.testing.assert_allclose(
+        model_32.calculate_fitness(), model_64.calculate_fitness(),
+        rtol=rtol, atol=rtol)
+    np.testing.assert_allclose(
+        model_32.prefix_rewards, model_64.prefix_rewards,
+        rtol=rtol, atol=rtol)
+    # What the model predicts from is how often each sequence follows
+    # its prefix.
+    if sequence_atol is None:
+        sequence_atol = rtol
+    np.testing.assert_allclose(
+        dense_sequences(model_32) / model_32.prefix_occurrences[:, :, None],
+        dense_sequences(model_64) / model_64.prefix_occurrences[:, :, None],
+        rtol=rtol, atol=sequence_atol)
+
+
+@pytest.mark.parametrize('fused_step', [False, True])
+@pytest.mark.parametrize('sequence_backend', ['dense', 'sparse'])
+def test_float32_matches_float64(fused_step, sequence_backend):
+    goals_64, model_64 = run_world(
+        np.float64, fused_step=fused_step, sequence_backend=sequence_backend)
+    goals_32, model_32 = run_world(
+        np.float32, fused_step=fused_step, sequence_backend=sequence_backend)
+    assert model_32.prefix_activities.dtype == np.float32
+    assert model_32.prefix_occurrences.dtype == np.float64
+    assert_close(model_64, model_32, goals_64, goals_32, rtol=1e-4)
+
+
+@pytest.mark.parametrize('fused_step', [False, True])
+@pytest.mark.parametrize('sequence_backend', ['dense', 'sparse'])
+def test_float32_counters_match_float64(fused_step, sequence_backend):
+    goals_64, model_64 = run_world(
+        np.float64, fused_step=fused_step, sequence_backend=sequence_backend)
+    goals_32, model_32 = run_world(
+        np.float32,
+        counter_dtype=np.float32,
+        fused_step=fused_step,
+        sequence_backend=sequence_backend)
+    assert model_32.prefix_occurrences.dtype == np.float32
+    if sequence_backend == 'dense':
+        assert model_32.sequence_occurrences.dtype == np.float32
+    else:
+        assert model_32.sequence_occurrences.values.dtype == np.float32
+    assert_close(model_64, model_32, goals_64, goals_32, rtol=1e-4)
+
+
+@pytest.mark.parametrize('sequence_backend', ['dense', 'sparse'])
+def test_renormalized_counters_stay_close(sequence_backend):
+    # A limit below the default makes the float32 counts of the
+    # most common prefixes renormalize many times over the run.
+    goals_64, model_64 = run_world(
+        np.float64, sequence_backend=sequence_backend)
+    goals_32, model_32 = run_world(
+        np.float32,
+        counter_dtype=np.float32,
+        counter_limit=256.,
+        sequence_backend=sequence_backend)
+    assert model_32.n_renormalized > 0
+    assert np.max(model_32.prefix_occurrences) < 2 * 256.
+    # Renormalizing weights the latest observations more heavily,
+    # so the fraction of the time each sequence follows its prefix
+    # drifts a little from the lifetime average.
+    assert_close(
+        model_64, model_32, goals_64, goals_32, rtol=1e-2,
+        sequence_atol=5e-2)
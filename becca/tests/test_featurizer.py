@@ -0,0 +1,101 @@
+"""
+Check the Featurizer's stack of levels.
+
+The inputs come from a small world where a few of them tend to
+be active together, so that bundles form on more than one level.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from becca.featurizer import Featurizer
+
+
+def world_inputs(n_steps, n_inputs=8):
+    """
+    Generate the inputs for each time step.
+
+    Inputs 0 and 1 are active together, as are 2 and 3,
+    and sometimes all four are. One of the rest flickers as noise.
+
+    Returns
+    -------
+    inputs : 2D array of floats
+        One row of input activities per time step.
+    """
+    world_rng = np.random.RandomState(0)
+    patterns = [[0, 1], [2, 3], [0, 1, 2, 3]]
+    inputs = np.zeros((n_steps, n_inputs))
+    for i_step in range(n_steps):
+        inputs[i_step, patterns[world_rng.randint(len(patterns))]] = 1.
+        inputs[i_step, 4 + world_rng.randint(n_inputs - 4)] = (
+            world_rng.rand() < .3)
+    return inputs
+
+
+def bundle_inputs(featurizer, i_level, i_bundle):
+    """
+    Find the inputs that a bundle is built from, through every level.
+    """
+    cables = featurizer.zipties[i_level].get_index_projection_cables(i_bundle)
+    for ziptie in reversed(featurizer.zipties[:i_level]):
+        cables = np.unique(np.concatenate([
+            ziptie.get_index_projection_cables(i_cable)
+            for i_cable in cables]))
+    return np.sort(cables)
+
+
+@pytest.mark.parametrize('n_levels', [2, 3])
+def test_round_trip_across_levels(n_levels):
+    featurizer = Featurizer(8, n_levels=n_levels, threshold=20.)
+    for input_activities in world_inputs(3000):
+        featurizer.featurize(input_activities)
+    top = n_levels - 1
+    assert featurizer.zipties[top].n_bundles_created > 0
+
+    for i_bundle in range(featurizer.zipties[top].n_bundles_created):
+        i_feature = featurizer.level_offsets[top] + i_bundle
+        # A goal for a top level bundle is passed down to
+        # every input it is built from, and no others.
+        feature_goals = np.zeros(featurizer.n_features)
+        feature_goals[i_feature] = 1.
+        input_goals = featurizer.defeaturize(feature_goals)
+        assert np.array_equal(
+            np.where(input_goals > 0.)[0],
+            bundle_inputs(featurizer, top, i_bundle))
+        # Those inputs, in turn, activate the bundle.
+        feature_activities = featurizer.featurize(input_goals)
+        assert feature_activities[i_feature] == 1.
+
+
+def test_pipelined_matches_unpipelined():
+    featurizer = Featurizer(8, n_levels=2, threshold=20.)
+    pipelined = Featurizer(8, n_levels=2, pipelined=True, threshold=20.)
+    for input_activities in world_inputs(3000):
+        n_bundles_created = [
+            ziptie.n_bundles_created for ziptie in featurizer.zipties]
+        feature_activities = featurizer.featurize(input_activities)
+        # Pipelining lets the learning run in the meantime,
+        # but doesn't change what is learned.
+        assert np.array_equal(
+            feature_activities, pipelined.featurize(input_activities))
+        featurizer.update_inputs()
+        pipelined.update_inputs()
+        for i_level, (ziptie, pipelined_ziptie) in enumerate(zip(
+                featurizer.zipties, pipelined.zipties)):
+            assert (ziptie.n_bundles_created ==
+                    pipelined_ziptie.n_bundles_created)
+            # In both, the bundles learned on one time step are
+            # first used on the next.
+            new_features = featurizer.level_offsets[i_level] + np.arange(
+                n_bundles_created[i_level], ziptie.n_bundles_created)
+            assert np.all(feature_activities[new_features] == 0.)
+    assert featurizer.zipties[1].n_bundles_created > 0
+    for ziptie, pipelined_ziptie in zip(
+            featurizer.zipties, pipelined.zipties):
+        np.testing.assert_array_equal(
+            ziptie.agglomeration_energy, pipelined_ziptie.agglomeration_energy)
+        np.testing.assert_array_equal(
+            ziptie.nucleation_energy, pipelined_ziptie.nucleation_energy)
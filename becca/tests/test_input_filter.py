@@ -0,0 +1,49 @@
+"""
+Check that the Preprocessor stays within the inputs it has room for.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from becca.input_filter import Preprocessor
+
+
+def run_preprocessor(max_n_inputs, n_steps=3000):
+    """
+    Feed uniformly random sensors to a quickly splitting Preprocessor.
+
+    Returns
+    -------
+    preprocessor : Preprocessor
+    n_inputs : int
+        The size of the last set of inputs it passed on.
+    """
+    world_rng = np.random.RandomState(1)
+    preprocessor = Preprocessor(
+        max_n_inputs=max_n_inputs,
+        n_actions=2,
+        n_sensors=2,
+        split_frequency=10,
+    )
+    for _ in range(n_steps):
+        input_activities = preprocessor.convert_to_inputs(
+            np.zeros(2), world_rng.random_sample(2))
+    return preprocessor, input_activities.size
+
+
+def test_discretizers_stop_at_max_n_inputs(tmp_path, monkeypatch):
+    # The discretizers write their reports to the working directory.
+    monkeypatch.chdir(tmp_path)
+    _, n_inputs_unbounded = run_preprocessor(None)
+    assert n_inputs_unbounded > 9
+    bounded, n_inputs_bounded = run_preprocessor(9)
+    assert bounded.n_inputs <= 9
+    assert n_inputs_bounded == bounded.n_inputs
+
+
+def test_too_small_max_n_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError):
+        Preprocessor(max_n_inputs=5, n_actions=2, n_sensors=2)
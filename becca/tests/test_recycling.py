@@ -0,0 +1,64 @@
+"""
+Check that a Brain's model forgets the features of recycled bundles.
+
+When the featurizer is full, it evicts its least useful bundle to
+make room for a new one. The new bundle takes over the old one's
+feature, so everything the model learned about it starts over.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from becca.brain import Brain
+
+
+def test_evicted_bundles_reset_model(tmp_path):
+    np.random.seed(3)
+    world_rng = np.random.RandomState(5)
+    brain = Brain(
+        backup_interval=int(1e9),
+        log_directory=str(tmp_path),
+        n_actions=2,
+        n_features=10,
+        n_sensors=2,
+        recycle_bundles=True,
+    )
+    # Bundle quickly and recycle young bundles,
+    # so the featurizer fills up and starts evicting early on.
+    ziptie = brain.featurizer.ziptie
+    ziptie.nucleation_threshold = .1
+    ziptie.agglomeration_threshold = .1
+    ziptie.min_bundle_age = 10
+    model = brain.model
+
+    # Wait for the eviction of a bundle that the model has learned about.
+    # The model's first two features are internal.
+    offset = brain.featurizer.level_offsets[0] + 2
+    features = np.zeros(0, dtype=int)
+    for _ in range(20000):
+        n_evictions = ziptie.n_evictions
+        occurrences = model.prefix_occurrences.copy()
+        brain.sense_act_learn(world_rng.random_sample(2), world_rng.rand())
+        if ziptie.n_evictions > n_evictions:
+            features = offset + np.array(ziptie.evicted_bundles)
+            features = features[features < occurrences.shape[0]]
+            if np.any(occurrences[features, :] > 1.):
+                break
+    assert np.any(occurrences[features, :] > 1.)
+
+    for feature in features:
+        for prefix_array in (
+            model.prefix_activities,
+            model.prefix_credit,
+            model.prefix_rewards,
+        ):
+            assert np.all(prefix_array[feature, :] == 0.)
+            assert np.all(prefix_array[:, feature] == 0.)
+        assert np.all(model.prefix_occurrences[feature, :] == 1.)
+        assert np.all(model.prefix_occurrences[:, feature] == 1.)
+        assert np.all(model.sequence_occurrences[feature, :, :] == 1.)
+        assert np.all(model.sequence_occurrences[:, feature, :] == 1.)
+        assert np.all(model.sequence_occurrences[:, :, feature] == 1.)
+    # Features that weren't evicted keep what has been learned.
+    assert np.max(model.prefix_occurrences) > 1.
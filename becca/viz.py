@@ -363,6 +363,9 @@ def brain_activity(brain=None, dpi=300):
         for i_conn in range(ziptie.n_map_entries):
             i_cable = ziptie.bundle_map_cols[i_conn]
             i_bundle = ziptie.bundle_map_rows[i_conn]
+            # Skip the entries of evicted bundles.
+            if i_bundle < 0:
+                continue
             y_cable = y_cables[i_cable]
             cables_per_bundle[i_bundle] += 1.
             summed_cable_positions[i_bundle] += y_cable
@@ -385,6 +388,9 @@ def brain_activity(brain=None, dpi=300):
         for i_conn in range(ziptie.n_map_entries):
             i_cable = ziptie.bundle_map_cols[i_conn]
             i_bundle = ziptie.bundle_map_rows[i_conn]
+            # Skip the entries of evicted bundles.
+            if i_bundle < 0:
+                continue
             y_cable = y_cables[i_cable]
             y_bundle = y_bundles[i_bundle]
             activity = (ziptie.bundle_activities[i_bundle] *
@@ -411,20 +417,28 @@ def brain_activity(brain=None, dpi=300):
     reward_color = [0., 158. / 255., 115. / 255.]
     punishment_color = [230. / 255., 159. / 255., 0.]
     curiosity_color = [86. / 255., 180. / 255., 233. / 255.]
+    # The model only allocates room for the features that have
+    # come to life. Fill out the rest with their initial values.
+    n_model_features = brain.model.n_features
+    prefix_rewards = bt.pad(
+        brain.model.prefix_rewards, [n_model_features, n_model_features])
+    prefix_curiosities = bt.pad(
+        brain.model.prefix_curiosities,
+        [n_model_features, n_model_features])
     reward_image = np.concatenate([
-        reward_color[0] * brain.model.prefix_rewards[:, :, np.newaxis],
-        reward_color[1] * brain.model.prefix_rewards[:, :, np.newaxis],
-        reward_color[2] * brain.model.prefix_rewards[:, :, np.newaxis],
+        reward_color[0] * prefix_rewards[:, :, np.newaxis],
+        reward_color[1] * prefix_rewards[:, :, np.newaxis],
+        reward_color[2] * prefix_rewards[:, :, np.newaxis],
         ], axis=2)
     punishment_image = np.concatenate([
-        -punishment_color[0] * brain.model.prefix_rewards[:, :, np.newaxis],
-        -punishment_color[1] * brain.model.prefix_rewards[:, :, np.newaxis],
-        -punishment_color[2] * brain.model.prefix_rewards[:, :, np.newaxis],
+        -punishment_color[0] * prefix_rewards[:, :, np.newaxis],
+        -punishment_color[1] * prefix_rewards[:, :, np.newaxis],
+        -punishment_color[2] * prefix_rewards[:, :, np.newaxis],
         ], axis=2)
     curiosity_image = np.concatenate([
-        curiosity_color[0] * brain.model.prefix_curiosities[:, :, np.newaxis],
-        curiosity_color[1] * brain.model.prefix_curiosities[:, :, np.newaxis],
-        curiosity_color[2] * brain.model.prefix_curiosities[:, :, np.newaxis],
+        curiosity_color[0] * prefix_curiosities[:, :, np.newaxis],
+        curiosity_color[1] * prefix_curiosities[:, :, np.newaxis],
+        curiosity_color[2] * prefix_curiosities[:, :, np.newaxis],
         ], axis=2)
     model_image = (
         np.maximum(reward_image, 0.) +
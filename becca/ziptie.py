@@ -3,9 +3,11 @@ The Ziptie class.
 """
 
 from __future__ import print_function
+import numba
 import numpy as np
 import matplotlib.pyplot as plt
 
+from becca.max_tracker import MaxTracker
 import becca.tools as tools
 import becca.ziptie_numba as nb
 
@@ -38,8 +40,12 @@ class Ziptie(object):
             self,
             n_cables=16,
             n_bundles=None,
+            dtype=np.float64,
             name=None,
+            n_threads=1,
             threshold=1e4,
+            featurize_mode='min',
+            recycle_bundles=False,
             debug=False,
     ):
         """
@@ -50,6 +56,12 @@ class Ziptie(object):
         debug : boolean, optional
             Indicate whether to print informative status messages
             during execution. Default is False.
+        dtype : numpy dtype, optional
+            The floating point type of the energy arrays.
+            np.float32 halves their memory. Default is np.float64.
+        featurize_mode : str, optional
+            How featurize finds bundle activities, either 'min' or
+            'greedy'. See Ziptie.featurize_mode. Default is 'min'.
         n_bundles : int, optional
             The number of bundle outputs from the Ziptie.
         n_cables : int
@@ -57,6 +69,13 @@ class Ziptie(object):
         name : str, optional
             The name assigned to the Ziptie.
             Default is 'ziptie'.
+        n_threads : int, optional
+            The number of threads to spread the energy kernels across.
+            Default is 1.
+        recycle_bundles : boolean, optional
+            If True, once every bundle has been created, the least
+            useful bundles are replaced by new ones and learning
+            carries on. See Ziptie.recycle_bundles. Default is False.
         threshold : float
             The point at which to nucleate a new bundle or
             agglomerate to an existing one.
@@ -71,15 +90,46 @@ class Ziptie(object):
         #     Indicate whether to print informative status messages
         #     during execution.
         self.debug = debug
+        # n_threads : int
+        #     The number of threads for the parallel kernels to use.
+        #     With only one, the serial kernels are used.
+        self.n_threads = int(max(1, min(
+            n_threads, numba.config.NUMBA_NUM_THREADS)))
         # n_cables : int
         #     The maximum number of cable inputs allowed.
         self.n_cables = n_cables
         # n_bundles : int
-        #     The number of bundle outputs.
+        #     The number of bundle outputs. This is the most bundles
+        #     the Ziptie can create.
         if not n_bundles:
             self.n_bundles = self.n_cables
         else:
             self.n_bundles = n_bundles
+        # n_bundles_created : int
+        #     The number of bundle indices that have been used so far.
+        #     New bundles take the next unused index, unless there is
+        #     one on the free list.
+        self.n_bundles_created = 0
+        # recycle_bundles : boolean
+        #     If True, learning doesn't stop when the bundles are full.
+        #     When a new bundle is needed and there is no room,
+        #     the least useful bundle is evicted to make room.
+        #     Otherwise, learning stops once all the bundles are created.
+        self.recycle_bundles = recycle_bundles
+        # free_bundles : list of ints
+        #     The indices of bundles that have been evicted and
+        #     are ready to be reused.
+        self.free_bundles = []
+        # n_evictions : int
+        #     The number of bundles that have been evicted.
+        self.n_evictions = 0
+        # evicted_bundles : list of ints
+        #     The bundles evicted during the latest call to learn or fit.
+        #     Their indices may already hold new bundles.
+        self.evicted_bundles = []
+        # timestep : int
+        #     The number of times learn has been called.
+        self.timestep = 0
 
         # nucleation_threshold : float
         #     Threshold above which nucleation energy results in nucleation.
@@ -93,6 +143,21 @@ class Ziptie(object):
         #     By ignoring the small activity values,
         #     computation gets much faster.
         self.activity_threshold = .1
+        # sparse_gather_density : float
+        #     When the fraction of cables that are active is below this,
+        #     energy is gathered from a compacted list of the active
+        #     cables and bundles, rather than by testing every one.
+        #     On a 2000 cable Ziptie, the two broke even with
+        #     30 to 50 percent of the cables active.
+        self.sparse_gather_density = .3
+        # featurize_mode : str
+        #     With 'min', each bundle's activity is the smallest
+        #     activity of its cables. With 'greedy', cable activity
+        #     is explained by the strongest bundles first,
+        #     and each cable's activity is only counted once.
+        #     What's left over is kept in nonbundle_activities.
+        #     See ziptie_numba.find_bundle_activities.
+        self.featurize_mode = featurize_mode
         # bundles_full : bool
         #     If True, all the bundles in the Ziptie are full
         #     and learning stops. This is another way to speed up
@@ -108,6 +173,29 @@ class Ziptie(object):
         #     The set of input activities that do not contribute
         #     to any of the current bundle activities.
         self.nonbundle_activities = np.zeros(self.n_cables)
+        # bundle_usage : array of floats
+        #     A running average of each bundle's activity.
+        # usage_update_rate : float
+        #     How quickly the running average changes.
+        #     Its inverse is roughly the number of time steps
+        #     the average covers.
+        # bundle_fitness : array of floats
+        #     How useful each bundle is to the rest of the brain,
+        #     where that is known. It starts at one.
+        #     See Featurizer.update_fitness.
+        # bundle_birth_steps : array of ints
+        #     The time step on which each bundle was created.
+        # min_bundle_age : int
+        #     A bundle younger than this isn't evicted, unless all of
+        #     them are. This gives each new bundle a chance to build up
+        #     its usage.
+        # The least useful bundle is the one with the lowest
+        # product of usage and fitness.
+        self.bundle_usage = np.zeros(self.n_bundles)
+        self.usage_update_rate = 1e-3
+        self.bundle_fitness = np.ones(self.n_bundles)
+        self.bundle_birth_steps = np.zeros(self.n_bundles, dtype=int)
+        self.min_bundle_age = int(1. / self.usage_update_rate)
 
         # bundle_map_size : int
         #     The maximum number of non-zero entries in the bundle map.
@@ -122,59 +210,121 @@ class Ziptie(object):
         # n_map_entries: int
         #     The total number of bundle map entries that
         #     have been created so far.
+        # n_dead_entries : int
+        #     The number of those that belonged to evicted bundles.
+        #     Their rows are set to -1. They are squeezed out once
+        #     they make up half the map.
         self.n_map_entries = 0
+        self.n_dead_entries = 0
+        # bundle_map_starts,
+        # bundle_map_stops : array of ints
+        #     Bundles are added to the bundle map one at a time, with
+        #     all their cables together, so the entries are already
+        #     grouped by bundle. The entries for bundle i run from
+        #     bundle_map_starts[i] up to bundle_map_stops[i].
+        #     This makes bundle_map_cols the cable list of a compressed
+        #     sparse row (CSR) index of the bundle map. Free bundles
+        #     have no entries. Until a bundle has been evicted,
+        #     each bundle's entries start where the last one's stopped.
+        self.bundle_map_starts = np.zeros(self.n_bundles, dtype=int)
+        self.bundle_map_stops = np.zeros(self.n_bundles, dtype=int)
+        # bundle_cable_sets : dict of frozenset to int
+        #     The bundle made of each set of cables. This makes it
+        #     quick to check whether a new bundle would duplicate
+        #     an existing one.
+        # n_duplicates_rejected : int
+        #     The number of new bundles that weren't created
+        #     because they already existed.
+        self.bundle_cable_sets = {}
+        self.n_duplicates_rejected = 0
+        # cable_bundle_offsets,
+        # cable_bundles : array of ints
+        #     The inverse index, from cables to the bundles they
+        #     belong to. The bundles that cable j belongs to are
+        #     cable_bundles[cable_bundle_offsets[j]:
+        #                   cable_bundle_offsets[j + 1]].
+        #     It is rebuilt each time a bundle is created.
+        self.cable_bundle_offsets = np.zeros(self.n_cables + 1, dtype=int)
+        self.cable_bundles = np.zeros(0, dtype=int)
+        # dtype : numpy dtype
+        #     The precision of the energy arrays.
+        self.dtype = np.dtype(dtype)
         # agglomeration_energy: 2D array of floats
         #     The accumulated agglomeration energy for each bundle-cable pair.
         self.agglomeration_energy = np.zeros((self.n_bundles,
-                                              self.n_cables))
-        # agglomeration_mask: 2D array of floats
-        #     A binary array indicating which cable-bundle
-        #     pairs are allowed to accumulate
-        #     energy and which are not. Some combinations are
+                                              self.n_cables),
+                                             dtype=self.dtype)
+        # agglomeration_mask: 2D array of uint64
+        #     A bitset indicating which cable-bundle
+        #     pairs are blocked from accumulating energy.
+        #     Some combinations are
         #     disallowed because they result in redundant bundles.
-        self.agglomeration_mask = np.ones((self.n_bundles,
-                                           self.n_cables))
-        # nucleation_energy: 2D array of floats
+        #     See ziptie_numba.make_bitset.
+        self.agglomeration_mask = nb.make_bitset(
+            self.n_bundles, self.n_cables)
+        # nucleation_energy: array of floats
         #     The accumualted nucleation energy associated
-        #     with each cable-cable pair.
-        self.nucleation_energy = np.zeros((self.n_cables,
-                                           self.n_cables))
-        # nucleation_mask: 2D array of floats
-        #     A binary array indicating which cable-cable
-        #     pairs are allowed to accumulate
-        #     energy and which are not. Some combinations are
+        #     with each cable-cable pair. It is symmetric and zero
+        #     on the diagonal, so only the upper triangle is kept,
+        #     packed into n_cables * (n_cables - 1) / 2 elements.
+        #     See ziptie_numba.packed_index.
+        self.nucleation_energy = np.zeros(
+            self.n_cables * (self.n_cables - 1) // 2, dtype=self.dtype)
+        # nucleation_mask: 2D array of uint64
+        #     A bitset indicating which cable-cable
+        #     pairs are blocked from accumulating energy.
+        #     Some combinations are
         #     disallowed because they result in redundant bundles.
-        self.nucleation_mask = np.ones((self.n_cables,
-                                        self.n_cables))
+        self.nucleation_mask = nb.make_bitset(self.n_cables, self.n_cables)
+        # Don't accumulate nucleation energy between a cable and itself.
+        for i_cable in range(self.n_cables):
+            nb.bit_set(self.nucleation_mask, i_cable, np.array([i_cable]))
+        # nucleation_max,
+        # agglomeration_max : MaxTracker
+        #     The largest nucleation and agglomeration energies and
+        #     where they are. These are kept current as energy is
+        #     gathered and reset, so that finding them doesn't take
+        #     a full scan of the energy arrays.
+        self.nucleation_max = MaxTracker(
+            self.nucleation_energy, n_packed=self.n_cables)
+        self.agglomeration_max = MaxTracker(self.agglomeration_energy)
 
     def featurize(self, new_cable_activities, bundle_weights=None):
         """
         Calculate how much the cables' activities contribute to each bundle.
 
         Find bundle activities by taking the minimum input value
-        in the set of cables in the bundle. The bulk of the computation
-        occurs in ziptie_numba.find_bundle_activities.
+        in the set of cables in the bundle. Using the CSR index of the
+        bundle map, this is a single pass over each bundle's cables.
+        Bundles that haven't been created yet have no activity.
+        In 'greedy' featurize_mode, the bundles are found one at a time,
+        using up cable activity as they go.
         """
         self.cable_activities = new_cable_activities.copy()
-        #self.nonbundle_activities = self.cable_activities.copy()
-        #self.bundle_activities = np.zeros(self.n_bundles)
-        self.bundle_activities = 1e3 * np.ones(self.n_bundles)
+        self.bundle_activities = np.zeros(self.n_bundles)
         if bundle_weights is None:
             bundle_weights = np.ones(self.n_bundles)
-        if self.n_map_entries > 0:
-            #nb.find_bundle_activities(
-            #    self.bundle_map_rows[:self.n_map_entries],
-            #    self.bundle_map_cols[:self.n_map_entries],
-            #    self.nonbundle_activities,
-            #    self.bundle_activities,
-            #    bundle_weights, self.activity_threshold)
-            for i_map_entry in range(self.n_map_entries):
-                i_bundle = self.bundle_map_rows[i_map_entry]
-                i_cable = self.bundle_map_cols[i_map_entry]
-                self.bundle_activities[i_bundle] = (
-                    np.minimum(self.bundle_activities[i_bundle],
-                               self.cable_activities[i_cable]))
-        self.bundle_activities[np.where(self.bundle_activities == 1e3)] = 0.
+        if self.featurize_mode == 'greedy':
+            self.nonbundle_activities = self.cable_activities.copy()
+            nb.find_bundle_activities(
+                self.bundle_map_starts,
+                self.bundle_map_stops,
+                self.bundle_map_cols,
+                self.cable_bundle_offsets,
+                self.cable_bundles,
+                self.n_bundles_created,
+                self.nonbundle_activities,
+                self.bundle_activities,
+                np.zeros(self.n_bundles),
+                self.activity_threshold)
+        else:
+            nb.find_min_bundle_activities(
+                self.bundle_map_starts,
+                self.bundle_map_stops,
+                self.bundle_map_cols,
+                self.n_bundles_created,
+                self.cable_activities,
+                self.bundle_activities)
         self.bundle_activities *= bundle_weights
         # The residual cable_activities after calculating
         # bundle_activities are the nonbundle_activities.
@@ -185,6 +335,50 @@ class Ziptie(object):
         return self.bundle_activities
 
 
+    def featurize_batch(self, cable_activities):
+        """
+        Find the bundle activities for many time steps at once.
+
+        This is the same as featurize, one row at a time, but it
+        doesn't change the state of the Ziptie.
+        In 'greedy' featurize_mode, the rows are handled one at a time.
+
+        Parameters
+        ----------
+        cable_activities : 2D array of floats
+            One row of cable activities per time step.
+
+        Returns
+        -------
+        bundle_activities : 2D array of floats
+            One row of bundle activities per time step.
+        """
+        bundle_activities = np.zeros(
+            (cable_activities.shape[0], self.n_bundles))
+        if self.featurize_mode == 'greedy':
+            weights = np.zeros(self.n_bundles)
+            for i_step, cables in enumerate(cable_activities):
+                nb.find_bundle_activities(
+                    self.bundle_map_starts,
+                    self.bundle_map_stops,
+                    self.bundle_map_cols,
+                    self.cable_bundle_offsets,
+                    self.cable_bundles,
+                    self.n_bundles_created,
+                    cables.copy(),
+                    bundle_activities[i_step],
+                    weights,
+                    self.activity_threshold)
+        else:
+            nb.find_min_bundle_activities_batch(
+                self.bundle_map_starts,
+                self.bundle_map_stops,
+                self.bundle_map_cols,
+                self.n_bundles_created,
+                np.ascontiguousarray(cable_activities, dtype=float),
+                bundle_activities)
+        return bundle_activities
+
     def learn(self, cable_activities):
         """
         Update co-activity estimates and calculate bundle activity
@@ -195,156 +389,324 @@ class Ziptie(object):
 
         Parameters
         ----------
-        none
+        cable_activities : array of floats
 
         Returns
         -------
-        none
+        evicted_bundles : array of ints
+            The bundles that were evicted to make room for new ones.
+            Anything built on top of them, in the model or
+            in higher levels, no longer applies.
         """
-        if not self.bundles_full:
-            self._create_new_bundles(cable_activities)
+        self.evicted_bundles = []
+        if self.bundles_full:
+            return np.zeros(0, dtype=int)
+        self.timestep += 1
+        n_bundles = self.n_bundles_created
+        self.bundle_usage[:n_bundles] += (
+            self.bundle_activities[:n_bundles] - self.bundle_usage[:n_bundles]
+        ) * self.usage_update_rate
+        self._create_new_bundles(cable_activities)
         if not self.bundles_full:
             self._grow_bundles(cable_activities)
-        return
+        return np.array(self.evicted_bundles, dtype=int)
+
+
+    def fit(self, cable_activities, chunk_size=2 ** 14):
+        """
+        Learn from a recorded sequence of cable activities all at once.
+
+        This gives the same bundles and energies as calling
+        featurize and learn on each time step in turn, but most of
+        the time steps are handled in a single compiled loop.
+        The loop runs until a nucleation or agglomeration passes
+        its threshold. The new bundle is then created just as it would
+        be online, and the loop picks up again on the next time step.
+
+        Parameters
+        ----------
+        cable_activities : 2D array of floats or str
+            One row of cable activities per time step. It can be a
+            numpy memmap or the name of a .npy file, which is memory
+            mapped. Rows are read chunk_size at a time.
+        chunk_size : int
+            The number of time steps to read into memory at once.
+
+        Returns
+        -------
+        evicted_bundles : array of ints
+            Every bundle that was evicted along the way. See learn.
+
+        The compiled loop finds bundle activities the 'min' way.
+        In 'greedy' featurize_mode, each row is instead passed through
+        featurize and learn.
+        """
+        if isinstance(cable_activities, str):
+            cable_activities = np.load(cable_activities, mmap_mode='r')
+        n_steps = cable_activities.shape[0]
+        evicted_bundles = []
+        for i_chunk_start in range(0, n_steps, chunk_size):
+            if self.bundles_full:
+                break
+            chunk = np.ascontiguousarray(
+                cable_activities[i_chunk_start:i_chunk_start + chunk_size],
+                dtype=float)
+            if self.featurize_mode == 'greedy':
+                for cables in chunk:
+                    if self.bundles_full:
+                        break
+                    self.featurize(cables)
+                    evicted_bundles.extend(self.learn(cables))
+            else:
+                self.evicted_bundles = []
+                self._fit_chunk(chunk)
+                evicted_bundles.extend(self.evicted_bundles)
+        self.evicted_bundles = evicted_bundles
+        return np.unique(np.array(evicted_bundles, dtype=int))
 
+    def _fit_chunk(self, chunk):
+        """
+        Learn from each of the rows of cable activities in a chunk.
+
+        Rows are learned from until the chunk runs out or the
+        bundles fill up.
+        """
+        i_step = 0
+        first_timestep = self.timestep
+        while i_step < chunk.shape[0] and not self.bundles_full:
+            i_step, i_event = nb.fit_steps(
+                chunk,
+                i_step,
+                self.sparse_gather_density,
+                self.bundle_map_starts,
+                self.bundle_map_stops,
+                self.bundle_map_cols,
+                self.n_bundles_created,
+                self.bundle_activities,
+                self.bundle_usage,
+                self.usage_update_rate,
+                self.nucleation_energy,
+                self.nucleation_mask,
+                self.nucleation_max.row_max,
+                self.nucleation_max.row_argmax,
+                self.nucleation_max.tree,
+                self.nucleation_threshold,
+                self.agglomeration_energy,
+                self.agglomeration_mask,
+                self.agglomeration_max.row_max,
+                self.agglomeration_max.row_argmax,
+                self.agglomeration_max.tree,
+                self.agglomeration_threshold)
+            self.timestep = first_timestep + i_step + 1
+            if i_event == nb.FIT_NUCLEATION:
+                # Finish the time step the way learn would.
+                self._nucleate()
+                if not self.bundles_full:
+                    self._grow_bundles(chunk[i_step])
+            elif i_event == nb.FIT_AGGLOMERATION:
+                self._agglomerate()
+            i_step += 1
+        # If the chunk was empty or the bundles were already full,
+        # nothing was learned, and the latest cable activities
+        # are still those from before.
+        if i_step > 0:
+            self.cable_activities = chunk[i_step - 1].copy()
 
     def _create_new_bundles(self, cable_activities):
         """
         If the right conditions have been reached, create a new bundle.
         """
         # Incrementally accumulate nucleation energy.
-        nb.nucleation_energy_gather(cable_activities,
-                                    self.nucleation_energy,
-                                    self.nucleation_mask)
-
-        # Don't accumulate nucleation energy between a cable and itself
-        ind = np.arange(self.cable_activities.size).astype(int)
-        self.nucleation_energy[ind, ind] = 0.
+        if self.n_threads > 1:
+            numba.set_num_threads(self.n_threads)
+        active_cables = np.where(cable_activities > 0.)[0]
+        if active_cables.size < self.sparse_gather_density * self.n_cables:
+            if self.n_threads > 1:
+                nucleation_energy_gather = (
+                    nb.nucleation_energy_gather_sparse_parallel)
+            else:
+                nucleation_energy_gather = nb.nucleation_energy_gather_sparse
+            nucleation_energy_gather(active_cables,
+                                     cable_activities,
+                                     self.nucleation_energy,
+                                     self.nucleation_mask,
+                                     self.nucleation_max.row_max,
+                                     self.nucleation_max.row_argmax)
+        else:
+            if self.n_threads > 1:
+                nucleation_energy_gather = (
+                    nb.nucleation_energy_gather_parallel)
+            else:
+                nucleation_energy_gather = nb.nucleation_energy_gather
+            nucleation_energy_gather(cable_activities,
+                                     self.nucleation_energy,
+                                     self.nucleation_mask,
+                                     self.nucleation_max.row_max,
+                                     self.nucleation_max.row_argmax)
+        self.nucleation_max.update(active_cables)
+        self._nucleate()
 
-        results = -np.ones(3)
-        nb.max_dense(self.nucleation_energy, results)
-        max_energy = results[0]
-        cable_index_a = int(results[1])
-        cable_index_b = int(results[2])
+    def _nucleate(self):
+        """
+        Create a new bundle from the pair of cables with the most
+        nucleation energy, if it has passed the threshold.
+        """
+        max_energy, cable_index_a, cable_index_b = self.nucleation_max.max()
+        cable_index_a = int(cable_index_a)
+        cable_index_b = int(cable_index_b)
 
         # Add a new bundle if appropriate
         if max_energy > self.nucleation_threshold:
-            self.bundle_map_rows[self.n_map_entries] = self.n_bundles
-            self.bundle_map_cols[self.n_map_entries] = cable_index_a
-            self.increment_n_map_entries()
-            self.bundle_map_rows[self.n_map_entries] = self.n_bundles
-            self.bundle_map_cols[self.n_map_entries] = cable_index_b
-            self.increment_n_map_entries()
+            if self._find_bundle([cable_index_a, cable_index_b]) is not None:
+                # There is already a bundle with just these two cables.
+                # Reset the energy and keep it from building up again.
+                i_packed = nb.packed_index(
+                    cable_index_a, cable_index_b, self.n_cables)
+                self.nucleation_energy[i_packed] = 0.
+                self.nucleation_max.rescan(
+                    self.nucleation_energy, [cable_index_a])
+                nb.bit_set(
+                    self.nucleation_mask, cable_index_a,
+                    np.array([cable_index_b]))
+                nb.bit_set(
+                    self.nucleation_mask, cable_index_b,
+                    np.array([cable_index_a]))
+                self.n_duplicates_rejected += 1
+                return
+            i_new_bundle = self._add_bundle([cable_index_a, cable_index_b])
 
             # Reset the accumulated nucleation and agglomeration energy
             # for the two cables involved.
-            self.nucleation_energy[cable_index_a, :] = 0.
-            self.nucleation_energy[cable_index_b, :] = 0.
-            self.nucleation_energy[:, cable_index_a] = 0.
-            self.nucleation_energy[:, cable_index_b] = 0.
+            nb.clear_packed(
+                self.nucleation_energy, self.n_cables, cable_index_a)
+            nb.clear_packed(
+                self.nucleation_energy, self.n_cables, cable_index_b)
             self.agglomeration_energy[:, cable_index_a] = 0.
             self.agglomeration_energy[:, cable_index_b] = 0.
+            cable_indices = [cable_index_a, cable_index_b]
+            self.nucleation_max.rescan(self.nucleation_energy, cable_indices)
+            self.nucleation_max.rescan_cols(
+                self.nucleation_energy, cable_indices)
+            self.agglomeration_max.rescan_cols(
+                self.agglomeration_energy, cable_indices)
 
             # Update nucleation_mask to prevent the two cables from
             # accumulating nucleation energy in the future.
-            self.nucleation_mask[cable_index_a, cable_index_b] = 0.
-            self.nucleation_mask[cable_index_b, cable_index_a] = 0.
+            nb.bit_set(
+                self.nucleation_mask, cable_index_a,
+                np.array([cable_index_b]))
+            nb.bit_set(
+                self.nucleation_mask, cable_index_b,
+                np.array([cable_index_a]))
 
             # Update agglomeration_mask to account for the new bundle.
             # The new bundle should not accumulate agglomeration energy
             # with any of the cables that any of its constituent cables
             # are blocked from nucleating with.
-            blocked_a = np.where(self.nucleation_mask[cable_index_a, :] == 0.)
-            blocked_b = np.where(self.nucleation_mask[cable_index_b, :] == 0.)
-            blocked = np.union1d(blocked_a[0], blocked_b[0])
-            self.agglomeration_mask[self.n_bundles, blocked] = 0.
+            nb.bit_row_union(
+                self.agglomeration_mask, i_new_bundle,
+                self.nucleation_mask, cable_index_a)
+            nb.bit_row_union(
+                self.agglomeration_mask, i_new_bundle,
+                self.nucleation_mask, cable_index_b)
 
-            self.n_bundles += 1
             if self.debug:
                 print(' '.join([
                     '    ', self.name,
-                    'bundle', str(self.n_bundles),
+                    'bundle', str(i_new_bundle),
                     'added with cables', str(cable_index_a),
                     str(cable_index_b)
                 ]))
 
-            # Check whether the Ziptie's capacity has been reached.
-            if self.n_bundles == self.n_bundles:
-                self.bundles_full = True
-
     def _grow_bundles(self, cable_activities):
         """
         Update an estimate of co-activity between all cables.
         """
         # Incrementally accumulate agglomeration energy.
-        nb.agglomeration_energy_gather(self.bundle_activities,
-                                       cable_activities,
-                                       self.n_bundles,
-                                       self.agglomeration_energy,
-                                       self.agglomeration_mask)
-
-        # Don't accumulate agglomeration energy between cables already
-        # in the same bundle
-        val = 0.
-        if self.n_map_entries > 0:
-            nb.set_dense_val(self.agglomeration_energy,
-                             self.bundle_map_rows[:self.n_map_entries],
-                             self.bundle_map_cols[:self.n_map_entries],
-                             val)
-
-        results = -np.ones(3)
-        nb.max_dense(self.agglomeration_energy, results)
-        max_energy = results[0]
-        cable_index = int(results[2])
-        bundle_index = int(results[1])
+        if self.n_threads > 1:
+            numba.set_num_threads(self.n_threads)
+        active_bundles = np.where(
+            self.bundle_activities[:self.n_bundles_created] > 0.)[0]
+        active_cables = np.where(cable_activities > 0.)[0]
+        if active_cables.size < self.sparse_gather_density * self.n_cables:
+            if self.n_threads > 1:
+                agglomeration_energy_gather = (
+                    nb.agglomeration_energy_gather_sparse_parallel)
+            else:
+                agglomeration_energy_gather = (
+                    nb.agglomeration_energy_gather_sparse)
+            agglomeration_energy_gather(active_bundles,
+                                        active_cables,
+                                        self.bundle_activities,
+                                        cable_activities,
+                                        self.agglomeration_energy,
+                                        self.agglomeration_mask,
+                                        self.agglomeration_max.row_max,
+                                        self.agglomeration_max.row_argmax)
+        else:
+            if self.n_threads > 1:
+                agglomeration_energy_gather = (
+                    nb.agglomeration_energy_gather_parallel)
+            else:
+                agglomeration_energy_gather = nb.agglomeration_energy_gather
+            agglomeration_energy_gather(self.bundle_activities,
+                                        cable_activities,
+                                        self.n_bundles_created,
+                                        self.agglomeration_energy,
+                                        self.agglomeration_mask,
+                                        self.agglomeration_max.row_max,
+                                        self.agglomeration_max.row_argmax)
+        self.agglomeration_max.update(active_bundles)
+        self._agglomerate()
+
+    def _agglomerate(self):
+        """
+        Create a new bundle from the bundle-cable pair with the most
+        agglomeration energy, if it has passed the threshold.
+        """
+        max_energy, bundle_index, cable_index = (
+            self.agglomeration_max.max())
+        bundle_index = int(bundle_index)
+        cable_index = int(cable_index)
 
         # Add a new bundle if appropriate
         if max_energy > self.agglomeration_threshold:
             # Find which cables are in the new bundle.
-            cables = [cable_index]
-            for i in range(self.n_map_entries):
-                if self.bundle_map_rows[i] == bundle_index:
-                    cables.append(self.bundle_map_cols[i])
+            cables = [cable_index] + list(
+                self.get_index_projection_cables(bundle_index))
 
-            # TODO: Check whether masks make this step obsolete
-            '''
             # Check whether the agglomeration is already in the bundle map.
-            candidate_bundles = np.arange(self.n_bundles)
-            for cable in cables:
-                matches = np.where(self.bundle_map_cols == cable)[0]
-                candidate_bundles = np.intersect1d(
-                    candidate_bundles,
-                    self.bundle_map_rows[matches],
-                    assume_unique=True)
-            if candidate_bundles.size != 0:
+            if self._find_bundle(cables) is not None:
                 # The agglomeration has already been used to create a
-                # bundle. Ignore and reset they count. This can happen
-                # under normal circumstances, because of how nonbundle
-                # activities are calculated.
+                # bundle. Ignore and reset the count, and keep it
+                # from building up again. This can happen when two
+                # different bundles grow into the same set of cables.
                 self.agglomeration_energy[bundle_index, cable_index] = 0.
+                self.agglomeration_max.rescan(
+                    self.agglomeration_energy, [bundle_index])
+                nb.bit_set(
+                    self.agglomeration_mask, bundle_index,
+                    np.array([cable_index]))
+                self.n_duplicates_rejected += 1
                 return
-            '''
-
-            # Make a copy of the growing bundle.
-            for i in range(self.n_map_entries):
-                if self.bundle_map_rows[i] == bundle_index:
-                    self.bundle_map_rows[self.n_map_entries] = self.n_bundles
-                    self.bundle_map_cols[self.n_map_entries] = (
-                        self.bundle_map_cols[i])
-                    self.increment_n_map_entries()
-            # Add in the new cable.
-            self.bundle_map_rows[self.n_map_entries] = self.n_bundles
-            self.bundle_map_cols[self.n_map_entries] = cable_index
-            self.increment_n_map_entries()
+
+            # Make a copy of the growing bundle, with the new cable added.
+            i_new_bundle = self._add_bundle(
+                cables[1:] + [cable_index], keep=bundle_index)
 
             # Reset the accumulated nucleation and agglomeration energy
             # for the two cables involved.
-            self.nucleation_energy[cable_index, :] = 0.
-            self.nucleation_energy[cable_index, :] = 0.
-            self.nucleation_energy[:, cable_index] = 0.
-            self.nucleation_energy[:, cable_index] = 0.
+            nb.clear_packed(
+                self.nucleation_energy, self.n_cables, cable_index)
             self.agglomeration_energy[:, cable_index] = 0.
             self.agglomeration_energy[bundle_index, :] = 0.
+            self.nucleation_max.rescan(self.nucleation_energy, [cable_index])
+            self.nucleation_max.rescan_cols(
+                self.nucleation_energy, [cable_index])
+            self.agglomeration_max.rescan(
+                self.agglomeration_energy, [bundle_index])
+            self.agglomeration_max.rescan_cols(
+                self.agglomeration_energy, [cable_index])
 
             # Update agglomeration_mask to account for the new bundle.
             # The new bundle should not accumulate agglomeration energy with
@@ -352,24 +714,253 @@ class Ziptie(object):
             #    are blocked from nucleating with or
             # 2) the cables that its constituent bundle
             #    are blocked from agglomerating with.
-            blocked_cable = np.where(
-                self.nucleation_mask[cable_index, :] == 0.)
-            blocked_bundle = np.where(
-                self.agglomeration_mask[bundle_index, :] == 0.)
-            blocked = np.union1d(blocked_cable[0], blocked_bundle[0])
-            self.agglomeration_energy[self.n_bundles, blocked] = 0.
-
-            self.n_bundles += 1
+            nb.bit_row_union(
+                self.agglomeration_mask, i_new_bundle,
+                self.nucleation_mask, cable_index)
+            nb.bit_row_union(
+                self.agglomeration_mask, i_new_bundle,
+                self.agglomeration_mask, bundle_index)
 
             if self.debug:
                 print(' '.join(['    ', self.name,
-                                'bundle', str(self.n_bundles),
+                                'bundle', str(i_new_bundle),
                                 'added: bundle', str(bundle_index),
                                 'and cable', str(cable_index)]))
 
-            # Check whether the Ziptie's capacity has been reached.
-            if self.n_bundles == self.n_bundles:
-                self.bundles_full = True
+    def _add_bundle(self, cables, keep=None):
+        """
+        Add a new bundle to the bundle map and both of its indices.
+
+        Parameters
+        ----------
+        cables : list of ints
+            The cables that make up the new bundle.
+        keep : int, optional
+            A bundle that mustn't be evicted to make room.
+
+        Returns
+        -------
+        i_new_bundle : int
+            The index of the new bundle.
+        """
+        if (not self.free_bundles and
+                self.n_bundles_created == self.n_bundles):
+            self._evict_bundle(self._least_useful_bundle(keep))
+        if self.free_bundles:
+            i_new_bundle = self.free_bundles.pop()
+        else:
+            i_new_bundle = self.n_bundles_created
+            self.n_bundles_created += 1
+
+        if 2 * self.n_dead_entries > self.n_map_entries:
+            self._compact_bundle_map()
+        self.bundle_map_starts[i_new_bundle] = self.n_map_entries
+        for i_cable in cables:
+            self.bundle_map_rows[self.n_map_entries] = i_new_bundle
+            self.bundle_map_cols[self.n_map_entries] = i_cable
+            self.increment_n_map_entries()
+        self.bundle_map_stops[i_new_bundle] = self.n_map_entries
+        self.bundle_cable_sets[frozenset(cables)] = i_new_bundle
+        # Don't accumulate agglomeration energy between a bundle
+        # and the cables already in it.
+        nb.bit_set(self.agglomeration_mask, i_new_bundle, np.array(cables))
+        self.bundle_birth_steps[i_new_bundle] = self.timestep
+        self._index_cables()
+
+        # Check whether the Ziptie's capacity has been reached.
+        if (not self.recycle_bundles and not self.free_bundles and
+                self.n_bundles_created == self.n_bundles):
+            self.bundles_full = True
+        return i_new_bundle
+
+    def _find_bundle(self, cables):
+        """
+        Find the bundle made of exactly a set of cables.
+
+        Parameters
+        ----------
+        cables : list of ints
+
+        Returns
+        -------
+        i_bundle : int or None
+            The bundle's index, or None if there isn't one.
+        """
+        return self.bundle_cable_sets.get(frozenset(cables))
+
+    def _least_useful_bundle(self, keep=None):
+        """
+        Choose the bundle to evict.
+
+        Parameters
+        ----------
+        keep : int, optional
+            A bundle that can't be chosen.
+
+        Returns
+        -------
+        i_bundle : int
+            The bundle with the lowest usage times fitness,
+            of those at least min_bundle_age time steps old.
+            If none are that old, the lowest of all of them.
+        """
+        usefulness = self.bundle_usage * self.bundle_fitness
+        candidates = (self.bundle_map_stops > self.bundle_map_starts)
+        if keep is not None:
+            candidates[keep] = False
+        mature = candidates & (
+            self.timestep - self.bundle_birth_steps >= self.min_bundle_age)
+        if np.any(mature):
+            candidates = mature
+        return int(np.where(candidates)[0][
+            np.argmin(usefulness[candidates])])
+
+    def _evict_bundle(self, i_bundle):
+        """
+        Clear out a bundle and put it on the free list.
+
+        This takes time proportional to the number of cables in the
+        bundle, plus a pass over its rows of the agglomeration energy
+        and mask. The inverse index is left for _add_bundle to rebuild.
+
+        The mask bits that kept the bundle from being formed twice are
+        cleared, so the same cables can come together again.
+
+        Parameters
+        ----------
+        i_bundle : int
+        """
+        i_start = self.bundle_map_starts[i_bundle]
+        i_stop = self.bundle_map_stops[i_bundle]
+        cables = self.bundle_map_cols[i_start:i_stop].tolist()
+        del self.bundle_cable_sets[frozenset(cables)]
+        if len(cables) == 2:
+            # It was nucleated from this pair of cables.
+            nb.bit_clear(
+                self.nucleation_mask, cables[0], np.array([cables[1]]))
+            nb.bit_clear(
+                self.nucleation_mask, cables[1], np.array([cables[0]]))
+        else:
+            # It was agglomerated onto a bundle made of
+            # all but one of its cables.
+            for i_cable in cables:
+                i_parent = self._find_bundle(
+                    [j_cable for j_cable in cables if j_cable != i_cable])
+                if i_parent is not None:
+                    nb.bit_clear(
+                        self.agglomeration_mask, i_parent,
+                        np.array([i_cable]))
+        self.bundle_map_rows[i_start:i_stop] = -1
+        self.bundle_map_cols[i_start:i_stop] = -1
+        self.n_dead_entries += i_stop - i_start
+        self.bundle_map_starts[i_bundle] = 0
+        self.bundle_map_stops[i_bundle] = 0
+
+        self.agglomeration_energy[i_bundle, :] = 0.
+        self.agglomeration_mask[i_bundle, :] = 0
+        self.agglomeration_max.rescan(self.agglomeration_energy, [i_bundle])
+        self.bundle_activities[i_bundle] = 0.
+        self.bundle_usage[i_bundle] = 0.
+        self.bundle_fitness[i_bundle] = 1.
+        self.free_bundles.append(i_bundle)
+        self.evicted_bundles.append(i_bundle)
+        self.n_evictions += 1
+        # With a free bundle, there is room to learn again.
+        self.bundles_full = False
+
+        if self.debug:
+            print(' '.join(['    ', self.name,
+                            'bundle', str(i_bundle), 'evicted']))
+
+    def reset_cables(self, cable_indices):
+        """
+        Start over with cables that now carry a different signal.
+
+        When a bundle in the level below is evicted, its index is
+        reused by a new bundle. Here, the corresponding cable is
+        a different cable. Every bundle built on it is evicted,
+        and its energies and mask bits are cleared.
+
+        Parameters
+        ----------
+        cable_indices : array of ints
+
+        Returns
+        -------
+        evicted_bundles : array of ints
+            The bundles that contained any of the cables.
+        """
+        self.evicted_bundles = []
+        cable_indices = np.unique(np.asarray(cable_indices, dtype=int))
+        if cable_indices.size == 0:
+            return np.zeros(0, dtype=int)
+        bundles = np.unique(np.concatenate([
+            self.cable_bundles[self.cable_bundle_offsets[i_cable]:
+                               self.cable_bundle_offsets[i_cable + 1]]
+            for i_cable in cable_indices]))
+        for i_bundle in bundles:
+            self._evict_bundle(int(i_bundle))
+        self._index_cables()
+
+        for i_cable in cable_indices:
+            nb.clear_packed(self.nucleation_energy, self.n_cables, i_cable)
+            # Clear the cable's row and column of each mask.
+            self.nucleation_mask[i_cable, :] = 0
+            bit = ~(np.uint64(1) << np.uint64(i_cable & 63))
+            self.nucleation_mask[:, i_cable >> 6] &= bit
+            self.agglomeration_mask[:, i_cable >> 6] &= bit
+        # Don't accumulate nucleation energy between a cable and itself.
+        for i_cable in cable_indices:
+            nb.bit_set(self.nucleation_mask, i_cable, np.array([i_cable]))
+        self.agglomeration_energy[:, cable_indices] = 0.
+        self.cable_activities[cable_indices] = 0.
+        self.nucleation_max.rescan(self.nucleation_energy, cable_indices)
+        self.nucleation_max.rescan_cols(self.nucleation_energy, cable_indices)
+        self.agglomeration_max.rescan_cols(
+            self.agglomeration_energy, cable_indices)
+
+        if self.debug:
+            print(' '.join(['    ', self.name,
+                            'cables', str(list(cable_indices)), 'reset']))
+        return np.array(self.evicted_bundles, dtype=int)
+
+    def _compact_bundle_map(self):
+        """
+        Squeeze the entries of evicted bundles out of the bundle map.
+        """
+        rows = self.bundle_map_rows[:self.n_map_entries]
+        is_live = rows > -1
+        # Where each live entry will end up.
+        new_positions = np.cumsum(is_live) - 1
+        n_cables = self.bundle_map_stops - self.bundle_map_starts
+        has_cables = n_cables > 0
+        self.bundle_map_starts[has_cables] = new_positions[
+            self.bundle_map_starts[has_cables]]
+        self.bundle_map_stops = self.bundle_map_starts + n_cables
+
+        n_live = int(np.sum(is_live))
+        self.bundle_map_rows[:n_live] = rows[is_live]
+        self.bundle_map_cols[:n_live] = (
+            self.bundle_map_cols[:self.n_map_entries][is_live])
+        self.bundle_map_rows[n_live:] = -1
+        self.bundle_map_cols[n_live:] = -1
+        self.n_map_entries = n_live
+        self.n_dead_entries = 0
+
+    def _index_cables(self):
+        """
+        Rebuild the inverse index, from each cable to its bundles.
+        """
+        rows = self.bundle_map_rows[:self.n_map_entries]
+        cols = self.bundle_map_cols[:self.n_map_entries]
+        is_live = rows > -1
+        rows = rows[is_live]
+        cols = cols[is_live]
+        order = np.argsort(cols, kind='stable')
+        self.cable_bundles = rows[order]
+        self.cable_bundle_offsets[0] = 0
+        self.cable_bundle_offsets[1:] = np.cumsum(
+            np.bincount(cols, minlength=self.n_cables))
 
     def update_masks(self, child_index, parent_index):
         """
@@ -381,9 +972,12 @@ class Ziptie(object):
         @param child_index: int
         @param parent_index: list of int
         """
-        self.nucleation_mask[child_index, child_index] = 0.
-        self.nucleation_mask[parent_index, child_index] = 0.
-        self.nucleation_mask[child_index, parent_index] = 0.
+        parent_index = np.atleast_1d(parent_index)
+        nb.bit_set(self.nucleation_mask, child_index,
+                   np.append(parent_index, child_index))
+        for i_parent in parent_index:
+            nb.bit_set(self.nucleation_mask, i_parent,
+                       np.array([child_index]))
 
     def increment_n_map_entries(self):
         """
@@ -417,9 +1011,7 @@ class Ziptie(object):
             corresponding to all the cables that contribute are 1.
         """
         projection = np.zeros(self.n_cables)
-        for i in range(self.n_map_entries):
-            if self.bundle_map_rows[i] == bundle_index:
-                projection[self.bundle_map_cols[i]] = 1.
+        projection[self.get_index_projection_cables(bundle_index)] = 1.
         return projection
 
 
@@ -438,24 +1030,32 @@ class Ziptie(object):
             An array of cable indices, representing all the cables that
             contribute to the bundle.
         """
-        projection = []
-        for i in range(self.n_map_entries):
-            if self.bundle_map_rows[i] == bundle_index:
-                projection.append(self.bundle_map_cols[i])
-        projection_indices = np.array(projection)
+        if bundle_index >= self.n_bundles_created:
+            return np.zeros(0, dtype=int)
+        projection_indices = self.bundle_map_cols[
+            self.bundle_map_starts[bundle_index]:
+            self.bundle_map_stops[bundle_index]].copy()
         return projection_indices
 
 
     def project_bundle_activities(self, bundle_activities):
         """
         Take a set of bundle activities and project them to cable activities.
+
+        Each cable takes on the largest activity of any of
+        the bundles it belongs to. Using the inverse index, this is
+        a single max-reduction per cable.
         """
         cable_activities = np.zeros(self.n_cables)
-        for i in range(self.n_map_entries):
-            i_bundle = self.bundle_map_rows[i]
-            i_cable = self.bundle_map_cols[i]
-            cable_activities[i_cable] = max(cable_activities[i_cable],
-                                            bundle_activities[i_bundle])
+        if self.n_map_entries == 0:
+            return cable_activities
+        # Only reduce over the cables that belong to a bundle.
+        # The empty stretches for the others would throw off reduceat.
+        n_cable_bundles = np.diff(self.cable_bundle_offsets)
+        bundled = np.where(n_cable_bundles > 0)[0]
+        cable_activities[bundled] = np.maximum(np.maximum.reduceat(
+            bundle_activities[self.cable_bundles],
+            self.cable_bundle_offsets[bundled]), 0.)
         return cable_activities
 
 
@@ -467,6 +1067,8 @@ class Ziptie(object):
         # First list the bundles and the cables in each.
         i_bundles = self.bundle_map_rows[:self.n_map_entries]
         i_cables = self.bundle_map_cols[:self.n_map_entries]
+        i_cables = i_cables[i_bundles > -1]
+        i_bundles = i_bundles[i_bundles > -1]
         i_bundles_unique = np.unique(i_bundles)
         if i_bundles_unique is not None:
             for i_bundle in i_bundles_unique:
@@ -481,9 +1083,7 @@ class Ziptie(object):
                 # Render the bundle map.
                 bundle_map = np.zeros((self.n_cables,
                                        self.n_bundles))
-                nb.set_dense_val(bundle_map,
-                                 self.bundle_map_rows[:self.n_map_entries],
-                                 self.bundle_map_cols[:self.n_map_entries], 1.)
+                nb.set_dense_val(bundle_map, i_bundles, i_cables, 1.)
                 tools.visualize_array(bundle_map,
                                       label=self.name + '_bundle_map')
 
@@ -493,6 +1093,11 @@ class Ziptie(object):
                 plt.xlabel(str(np.max(self.agglomeration_energy)))
 
                 # Render the nucleation energy.
+                nucleation_energy = np.zeros((self.n_cables,
+                                              self.n_cables))
+                i_rows, i_cols = np.triu_indices(self.n_cables, 1)
+                nucleation_energy[i_rows, i_cols] = self.nucleation_energy
+                nucleation_energy[i_cols, i_rows] = self.nucleation_energy
                 label = '_'.join([self.name, 'nuc_energy'])
-                tools.visualize_array(self.nucleation_energy, label=label)
+                tools.visualize_array(nucleation_energy, label=label)
                 plt.xlabel(str(np.max(self.nucleation_energy)))
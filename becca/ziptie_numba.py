@@ -11,11 +11,22 @@ as possible.
 The (nopython=True) call makes it so that if numba can't compile the code
 to C (very fast), but is forced to fall back to python instead (dead slow
 when doing loops), the function will fail and throw an error.
+
+Kernels with a *_parallel variant spread their outer loop across
+threads with prange. Loops are only parallelized where each iteration
+writes to a separate set of elements, so there are no write races.
+
+Every kernel is compiled with nogil=True, so that zipties in
+separate threads, such as the levels of a pipelined Featurizer,
+can run their kernels at the same time.
 """
-from numba import jit
+import heapq
+
+import numpy as np
+from numba import jit, prange
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True)
 def set_dense_val(array2d, i_rows, i_cols, val):
     """
     Set values in a dense 2D array using a list of indices.
@@ -37,147 +48,298 @@ def set_dense_val(array2d, i_rows, i_cols, val):
         array2d[i_rows[i], i_cols[i]] = val
 
 
-@jit(nopython=True)
-def max_dense(array2d, results):
+@jit(nopython=True, nogil=True)
+def find_bundle_activities(
+    bundle_map_starts,
+    bundle_map_stops,
+    bundle_map_cols,
+    cable_bundle_offsets,
+    cable_bundles,
+    n_bundles,
+    cables,
+    bundles,
+    weights,
+    threshold,
+):
     """
-    Find the maximum value of a dense 2D array, with its row and column
+    Use a greedy method to sparsely translate cables to bundles.
+
+    Repeatedly pick the bundle with the strongest vote. Its activity is
+    the minimum value of each of its constituent cables. Then subtract
+    out the bundle activity from each of its cables. Stop once
+    the winning vote is no more than threshold.
+
+    The votes are kept in a max-heap. After a bundle's activity is
+    subtracted out, only the bundles that share one of its cables
+    can change their vote, so only those are scored again.
+    Out of date entries in the heap are skipped when they come up.
+    Each iteration takes time proportional to the number of bundles
+    sharing cables with the winner, rather than to the size of the
+    whole bundle map.
 
     Parameters
     ----------
-    array2d : 2D array of floats
-        The array to find the maximum value of.
-    results : array of floats, size 3
-        An array for holding the results of the operation.
+    bundle_map_starts, bundle_map_stops, bundle_map_cols : arrays of ints
+        The cables in each bundle. See Ziptie.bundle_map_starts.
+        Bundles with no cables have no vote.
+    cable_bundle_offsets, cable_bundles : arrays of ints
+        The bundles each cable belongs to, in the same form.
+        See Ziptie.cable_bundle_offsets.
+    n_bundles : int
+        The number of bundles that have been created.
+    cables : 1D array of floats
+        An array of cable activity values.
+    bundles : 1D array of floats
+        An array of bundle activity values. Initially it is all zeros.
+    weights : array of floats
+        A multiplier for how strongly the activity of each bundle should
+        be considered when greedily selecting the next one to activate.
+    threshold : float
+        The amount of bundle activity below which, we just don't care.
+
+    Results
+    -------
+    Returned indirectly by modifying `cables` and `bundles`. The cables
+    are left with the residual cable activities that are not
+    represented by any bundle activities.
+    Ties between votes go to the most recently added bundle.
+    """
+    # votes : array of floats
+    #     The current vote of each bundle. An entry in the heap is
+    #     out of date if its vote doesn't match.
+    votes = np.zeros(n_bundles)
+    for i_bundle in range(n_bundles):
+        votes[i_bundle] = _bundle_vote(
+            bundle_map_starts, bundle_map_stops, bundle_map_cols,
+            cables, weights, i_bundle)
+    # Entries are (-vote, -bundle), so that the heap's smallest entry
+    # has the largest vote and, of those, the largest bundle index.
+    heap = [(-votes[i_bundle], -i_bundle)
+            for i_bundle in range(n_bundles) if votes[i_bundle] > 0.]
+    heapq.heapify(heap)
+
+    while len(heap) > 0:
+        neg_vote, neg_bundle = heapq.heappop(heap)
+        best_bundle = -neg_bundle
+        max_vote = -neg_vote
+        if max_vote != votes[best_bundle]:
+            continue
+
+        # The bundle's activity is the smallest of its cables'.
+        i_first = bundle_map_starts[best_bundle]
+        i_last = bundle_map_stops[best_bundle]
+        best_val = cables[bundle_map_cols[i_first]]
+        for i_entry in range(i_first + 1, i_last):
+            best_val = min(best_val, cables[bundle_map_cols[i_entry]])
+        bundles[best_bundle] = best_val
+
+        # Subtract the bundle activity from each of the cables
+        # and score again every bundle that shares one of them.
+        for i_entry in range(i_first, i_last):
+            cables[bundle_map_cols[i_entry]] -= best_val
+        for i_entry in range(i_first, i_last):
+            i_cable = bundle_map_cols[i_entry]
+            for i_neighbor in range(
+                    cable_bundle_offsets[i_cable],
+                    cable_bundle_offsets[i_cable + 1]):
+                i_bundle = cable_bundles[i_neighbor]
+                vote = _bundle_vote(
+                    bundle_map_starts, bundle_map_stops, bundle_map_cols,
+                    cables, weights, i_bundle)
+                if vote != votes[i_bundle]:
+                    votes[i_bundle] = vote
+                    if vote > 0.:
+                        heapq.heappush(heap, (-vote, -i_bundle))
+
+        # The bundle that brings the vote to or below the threshold is
+        # the last one to be activated.
+        if max_vote <= threshold:
+            break
+
+
+@jit(nopython=True, nogil=True)
+def _bundle_vote(bundle_map_starts, bundle_map_stops, bundle_map_cols,
+                 cables, weights, i_bundle):
+    """
+    Score how strongly the cables' activities point to a bundle.
+
+    The strength of the vote for the bundle is the minimum cable
+    activity multiplied by the number of cables. This weights
+    bundles with many member cables more highly than bundles
+    with few cables. It is a way to encourage sparsity and to
+    avoid creating more bundles than necessary.
+    """
+    i_first = bundle_map_starts[i_bundle]
+    i_last = bundle_map_stops[i_bundle]
+    if i_first == i_last:
+        return 0.
+    min_val = cables[bundle_map_cols[i_first]]
+    for i_entry in range(i_first + 1, i_last):
+        min_val = min(min_val, cables[bundle_map_cols[i_entry]])
+    n_cables = i_last - i_first
+    return min_val * (1. + .1 * (n_cables - 1.)) * (1. + weights[i_bundle])
+
+
+@jit(nopython=True, nogil=True)
+def find_min_bundle_activities(
+    bundle_map_starts,
+    bundle_map_stops,
+    bundle_map_cols,
+    n_bundles,
+    cables,
+    bundles,
+):
+    """
+    Find each bundle's activity, the smallest activity of its cables.
+
+    Parameters
+    ----------
+    bundle_map_starts, bundle_map_stops, bundle_map_cols : arrays of ints
+        The cables in each bundle. See Ziptie.bundle_map_starts.
+        Bundles with no cables have no activity.
+    n_bundles : int
+        The number of bundles that have been created.
+    cables : 1D array of floats
+        An array of cable activity values.
+    bundles : 1D array of floats
+        The bundle activities, modified in place.
+    """
+    for i_bundle in range(n_bundles):
+        i_first = bundle_map_starts[i_bundle]
+        i_last = bundle_map_stops[i_bundle]
+        if i_first == i_last:
+            bundles[i_bundle] = 0.
+            continue
+        activity = cables[bundle_map_cols[i_first]]
+        for i_entry in range(i_first + 1, i_last):
+            activity = min(activity, cables[bundle_map_cols[i_entry]])
+        bundles[i_bundle] = activity
+
+
+@jit(nopython=True, nogil=True)
+def find_min_bundle_activities_batch(
+    bundle_map_starts,
+    bundle_map_stops,
+    bundle_map_cols,
+    n_bundles,
+    cable_matrix,
+    bundle_matrix,
+):
+    """
+    Find bundle activities for many rows of cable activities.
+
+    See find_min_bundle_activities. Each row of cable_matrix
+    gives a row of bundle_matrix.
+    """
+    for i_row in range(cable_matrix.shape[0]):
+        find_min_bundle_activities(
+            bundle_map_starts, bundle_map_stops, bundle_map_cols,
+            n_bundles, cable_matrix[i_row], bundle_matrix[i_row])
+
+
+def make_bitset(n_rows, n_cols):
+    """
+    Create a 2D bitset with all of its bits clear.
+
+    Each row is packed into 64-bit words, with column i_col held in
+    bit i_col % 64 of word i_col // 64. This takes one sixty-fourth
+    of the memory of an array of float64 zeros and ones.
+
+    Parameters
+    ----------
+    n_rows, n_cols : int
+        The shape of the 2D array of bits.
 
     Returns
     -------
-    Results are returned indirectly by modifying results.
-    The results array has three elements and holds
-        [0] the maximum value found
-        [1] the row number in which it was found
-        [2] the column number in which it was found
-    """
-    max_val = results[0]
-    i_row_max = results[1]
-    i_col_max = results[2]
-    for i_row in range(array2d.shape[0]):
-        for i_col in range(array2d.shape[1]):
-            if array2d[i_row, i_col] > max_val:
-                max_val = array2d[i_row, i_col]
-                i_row_max = i_row
-                i_col_max = i_col
-    results[0] = max_val
-    results[1] = i_row_max
-    results[2] = i_col_max
+    bits : 2D array of uint64
+    """
+    n_words = (n_cols + 63) // 64
+    return np.zeros((n_rows, n_words), dtype=np.uint64)
 
 
-@jit(nopython=True)
-def find_bundle_activities(i_rows, i_cols, cables, bundles, weights, threshold):
+@jit(nopython=True, nogil=True)
+def bit_test(bits, i_row, i_col):
     """
-    Use a greedy method to sparsely translate cables to bundles.
+    Check whether a bit is set.
+
+    Parameters
+    ----------
+    bits : 2D array of uint64
+        A bitset, as created by make_bitset.
+    i_row, i_col : int
+        The location of the bit.
+
+    Returns
+    -------
+    is_set : boolean
+    """
+    word = bits[i_row, i_col >> 6]
+    return (word >> np.uint64(i_col & 63)) & np.uint64(1) != np.uint64(0)
+
 
-    Start at the last bundle added and work backward to the first.
-    For each, calculate the bundle activity by finding the minimum
-    value of each of its constituent cables. Then subtract out
-    the bundle activity from each of its cables.
+@jit(nopython=True, nogil=True)
+def bit_set(bits, i_row, i_cols):
+    """
+    Set a group of bits within a row.
 
     Parameters
     ----------
-    bundles : 1D array of floats
-        An array of bundle activity values. Initially it is all zeros.
-    cables : 1D array of floats
-        An array of cable activity values.
-    i_rows : array of ints
-        The row indices for the non-zero sparse 2D array..
+    bits : 2D array of uint64
+    i_row : int
     i_cols : array of ints
-        The column indices for the non-zero sparse 2D array elements.
-        All non-zero elements are assumed to be 1.
-        i_rows and i_cols must be the same length.
-        Each column represents a cable and each row represents a bundle.
-        The 2D array is a map from cables to bundles.
-    threshold : float
-        The amount of bundle activity below which, we just don't care.
-    weights : array of floats
-        A multiplier for how strongly the activity of each bundle should
-        be considered when greedily selecting the next one to activate.
+        The columns to set.
+    """
+    for i_col in i_cols:
+        bits[i_row, i_col >> 6] |= np.uint64(1) << np.uint64(i_col & 63)
 
-    Results
-    -------
-    Returned indirectly by modifying `cables. These are the residual
-    cable activities that are not represented by any bundle activities.
-    """
-    large = 1e10
-    max_vote = large
-
-    # Repeat this process until the residual cable activities don't match
-    # any bundles well.
-    while max_vote > threshold:
-        # Initialize the loop that greedily looks for the most strongly
-        # activated bundle.
-        max_vote = 0.
-        best_val = 0.
-        best_bundle = 0
-        # This is the index in i_row and i_col where the
-        # current bundle's cable constituents are listed. Cable indices
-        # are assumed to be contiguous and bundles are assumed to be
-        # listed in ascending order of index.
-        i_best_bundle = 0
-
-        # Iterate over each bundle, that is, over each row.
-        i = len(i_rows) - 1
-        row = i_rows[i]
-        while row > -1:
-
-            # For each bundle, find the minimum cable activity that
-            # contribues to it.
-            min_val = large
-            n_cables = 0.
-            i_bundle = i
-            while i_rows[i] == row and i > -1:
-                col = i_cols[i]
-                val = cables[col]
-                if val < min_val:
-                    min_val = val
-                n_cables += 1.
-                i -= 1
-
-            # The strength of the vote for the bundle is the minimum cable
-            # activity multiplied by the number of cables. This weights
-            # bundles with many member cables more highly than bundles
-            # with few cables. It is a way to encourage sparsity and to
-            # avoid creating more bundles than necessary.
-            vote = min_val * (1. + .1 * (n_cables - 1.)) * (1. + weights[row])
-
-            # Update the winning bundle if appropriate.
-            if vote > max_vote:
-                max_vote = vote
-                best_val = min_val
-                i_best_bundle = i_bundle
-                best_bundle = row
-
-            # Move on to the next bundle.
-            row -= 1
-
-        if best_val > 0.:
-            # Set the bundle activity.
-            bundles[best_bundle] = best_val
-
-            # Subtract the bundle activity from each of the cables.
-            # Using i_best_bundle lets us jump right to the place in
-            # the list of indices where the cables for the winning bundle
-            # are listed.
-            i = i_best_bundle
-            while i_rows[i] == best_bundle and i > -1:
-                col = i_cols[i]
-                cables[col] -= best_val
-                i -= 1
-
-
-@jit(nopython=True)
+
+@jit(nopython=True, nogil=True)
+def bit_clear(bits, i_row, i_cols):
+    """
+    Clear a group of bits within a row.
+
+    Parameters
+    ----------
+    bits : 2D array of uint64
+    i_row : int
+    i_cols : array of ints
+        The columns to clear.
+    """
+    for i_col in i_cols:
+        bits[i_row, i_col >> 6] &= ~(
+            np.uint64(1) << np.uint64(i_col & 63))
+
+
+@jit(nopython=True, nogil=True)
+def bit_row_union(bits, i_row, other_bits, i_other_row):
+    """
+    Set every bit in a row that is set in a row of another bitset.
+
+    This is the bitset version of
+        bits[i_row, :] = bits[i_row, :] | other_bits[i_other_row, :]
+    Both bitsets need the same number of columns.
+
+    Parameters
+    ----------
+    bits : 2D array of uint64
+        The bitset to update.
+    i_row : int
+    other_bits : 2D array of uint64
+        The bitset to take the bits from. It can be the same as bits.
+    i_other_row : int
+    """
+    for i_word in range(bits.shape[1]):
+        bits[i_row, i_word] |= other_bits[i_other_row, i_word]
+
+
+@jit(nopython=True, nogil=True)
 def nucleation_energy_gather(
     cable_activities,
     nucleation_energy,
     nucleation_mask,
+    row_max,
+    row_argmax,
 ):
     """
     Gather nucleation energy.
@@ -187,38 +349,55 @@ def nucleation_energy_gather(
         nucleation_energy += (cable_activities *
                               cable_activities.T *
                               nucleation_energy_rate)
+    Nucleation energy is symmetric and a cable has none with itself,
+    so only the upper triangle, i_cable1 < i_cable2, is stored.
+    See packed_index.
+
     Parameters
     ----------
     cable_activities : array of floats
         The current activity of each input feature.
-    nucleation_energy : 2D array of floats
+    nucleation_energy : array of floats
         The amount of nucleation energy accumulated between each pair of
-        input features.
-    nucleation_mask: 2D array of floats
-        A mask showing which input-input pairs are allowed
-        to accumulate energy.
+        input features, packed.
+    nucleation_mask: 2D array of uint64
+        A bitset showing which input-input pairs are blocked
+        from accumulating energy. See bit_test.
+    row_max, row_argmax : arrays
+        The largest energy in each row and its column. These are kept
+        current as energy is added. See MaxTracker.
 
     Results
     -------
-    Returned indirectly by modifying nucleation_energy.
+    Returned indirectly by modifying nucleation_energy,
+    row_max and row_argmax.
     """
-    for i_cable1, activity1 in enumerate(cable_activities):
+    # Each cable writes to its own row of nucleation energy.
+    n_cables = cable_activities.size
+    for i_cable1 in prange(n_cables):
+        activity1 = cable_activities[i_cable1]
         if activity1 > 0.:
-            for i_cable2, _ in enumerate(cable_activities):
+            i_row_start = packed_index(i_cable1, i_cable1 + 1, n_cables)
+            for i_cable2 in range(i_cable1 + 1, n_cables):
                 activity2 = cable_activities[i_cable2]
                 if activity2 > 0.:
-                    if nucleation_mask[i_cable1, i_cable2]:
-                        nucleation_energy[i_cable1, i_cable2] += (
-                            activity1 * activity2)
+                    if not bit_test(nucleation_mask, i_cable1, i_cable2):
+                        i_packed = i_row_start + i_cable2 - i_cable1 - 1
+                        nucleation_energy[i_packed] += activity1 * activity2
+                        _raise_row_max(
+                            nucleation_energy[i_packed], i_cable1, i_cable2,
+                            row_max, row_argmax)
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True)
 def agglomeration_energy_gather(
     bundle_activities,
     cable_activities,
     n_bundles,
     agglomeration_energy,
     agglomeration_mask,
+    row_max,
+    row_argmax,
 ):
     """
     Accumulate the energy binding a new feature to an existing bundle..
@@ -240,19 +419,418 @@ def agglomeration_energy_gather(
     agglomeration_energy : 2D array of floats
         The total energy that has been accumulated between each input feature
         and each bundle.
-    agglomeration_mask: 2D array of floats
-        A mask showing which input-input pairs are allowed
-        to accumulate energy.
+    agglomeration_mask: 2D array of uint64
+        A bitset showing which bundle-input pairs are blocked
+        from accumulating energy. See bit_test.
+    row_max, row_argmax : arrays
+        The largest energy in each row and its column. These are kept
+        current as energy is added. See MaxTracker.
 
     Results
     -------
-    Returned indirectly by modifying agglomeration_energy.
-    """
-    for i_cable, activity in enumerate(cable_activities):
-        if activity > 0.:
-            # Only decay bundles that have been created
-            for i_bundle in range(n_bundles):
-                if bundle_activities[i_bundle] > 0.:
-                    if agglomeration_mask[i_bundle, i_cable]:
-                        coactivity = activity * bundle_activities[i_bundle]
+    Returned indirectly by modifying agglomeration_energy,
+    row_max and row_argmax.
+    """
+    # Each bundle writes to its own row of agglomeration energy.
+    # Only bundles that have been created can be active.
+    for i_bundle in prange(n_bundles):
+        bundle_activity = bundle_activities[i_bundle]
+        if bundle_activity > 0.:
+            for i_cable, activity in enumerate(cable_activities):
+                if activity > 0.:
+                    if not bit_test(agglomeration_mask, i_bundle, i_cable):
+                        coactivity = activity * bundle_activity
                         agglomeration_energy[i_bundle, i_cable] += coactivity
+                        _raise_row_max(
+                            agglomeration_energy[i_bundle, i_cable],
+                            i_bundle, i_cable, row_max, row_argmax)
+
+
+@jit(nopython=True, nogil=True)
+def nucleation_energy_gather_sparse(
+    active_cables,
+    cable_activities,
+    nucleation_energy,
+    nucleation_mask,
+    row_max,
+    row_argmax,
+):
+    """
+    Gather nucleation energy, visiting only pairs of active cables.
+
+    This gives the same result as nucleation_energy_gather, but
+    rather than test every cable for activity, it is handed the list
+    of active ones. The work is proportional to the square of
+    the number of active cables, rather than to the number of
+    active cables times the total number of cables.
+
+    Parameters
+    ----------
+    active_cables : array of ints
+        The indices of the cables with non-zero activity,
+        in increasing order.
+    Other parameters are described in nucleation_energy_gather.
+    """
+    n_cables = cable_activities.size
+    n_active = active_cables.size
+    for i_row in prange(n_active):
+        i_cable1 = active_cables[i_row]
+        activity1 = cable_activities[i_cable1]
+        i_row_start = packed_index(i_cable1, i_cable1 + 1, n_cables)
+        for i_col in range(i_row + 1, n_active):
+            i_cable2 = active_cables[i_col]
+            if not bit_test(nucleation_mask, i_cable1, i_cable2):
+                i_packed = i_row_start + i_cable2 - i_cable1 - 1
+                nucleation_energy[i_packed] += (
+                    activity1 * cable_activities[i_cable2])
+                _raise_row_max(
+                    nucleation_energy[i_packed], i_cable1, i_cable2,
+                    row_max, row_argmax)
+
+
+@jit(nopython=True, nogil=True)
+def agglomeration_energy_gather_sparse(
+    active_bundles,
+    active_cables,
+    bundle_activities,
+    cable_activities,
+    agglomeration_energy,
+    agglomeration_mask,
+    row_max,
+    row_argmax,
+):
+    """
+    Gather agglomeration energy, visiting only active bundle-cable pairs.
+
+    This gives the same result as agglomeration_energy_gather,
+    with work proportional to the number of active bundles
+    times the number of active cables.
+
+    Parameters
+    ----------
+    active_bundles, active_cables : array of ints
+        The indices of the bundles and cables with non-zero activity,
+        in increasing order.
+    Other parameters are described in agglomeration_energy_gather.
+    """
+    for i_row in prange(active_bundles.size):
+        i_bundle = active_bundles[i_row]
+        bundle_activity = bundle_activities[i_bundle]
+        for i_cable in active_cables:
+            if not bit_test(agglomeration_mask, i_bundle, i_cable):
+                agglomeration_energy[i_bundle, i_cable] += (
+                    cable_activities[i_cable] * bundle_activity)
+                _raise_row_max(
+                    agglomeration_energy[i_bundle, i_cable],
+                    i_bundle, i_cable, row_max, row_argmax)
+
+
+nucleation_energy_gather_parallel = jit(
+    nopython=True, nogil=True, parallel=True)(
+        nucleation_energy_gather.py_func)
+agglomeration_energy_gather_parallel = jit(
+    nopython=True, nogil=True, parallel=True)(
+        agglomeration_energy_gather.py_func)
+nucleation_energy_gather_sparse_parallel = jit(
+    nopython=True, nogil=True, parallel=True)(
+        nucleation_energy_gather_sparse.py_func)
+agglomeration_energy_gather_sparse_parallel = jit(
+    nopython=True, nogil=True, parallel=True)(
+        agglomeration_energy_gather_sparse.py_func)
+
+
+# The reasons fit_steps can stop early.
+FIT_NUCLEATION = 0
+FIT_AGGLOMERATION = 1
+FIT_DONE = -1
+
+
+@jit(nopython=True, nogil=True)
+def fit_steps(
+    cable_matrix,
+    i_start,
+    sparse_gather_density,
+    bundle_map_starts,
+    bundle_map_stops,
+    bundle_map_cols,
+    n_bundles,
+    bundle_activities,
+    bundle_usage,
+    usage_update_rate,
+    nucleation_energy,
+    nucleation_mask,
+    nucleation_row_max,
+    nucleation_row_argmax,
+    nucleation_tree,
+    nucleation_threshold,
+    agglomeration_energy,
+    agglomeration_mask,
+    agglomeration_row_max,
+    agglomeration_row_argmax,
+    agglomeration_tree,
+    agglomeration_threshold,
+):
+    """
+    Step a Ziptie through many rows of cable activities.
+
+    Each row is handled just as Ziptie.featurize followed by
+    Ziptie.learn would handle it: bundle activities are found and
+    bundle usage is updated, then nucleation energy is gathered,
+    then agglomeration energy.
+    This keeps going until the largest nucleation or agglomeration
+    energy passes its threshold, at which point a bundle needs
+    to be created. That is left to the Ziptie.
+
+    Parameters
+    ----------
+    cable_matrix : 2D array of floats
+        The cable activities, one row per time step.
+    i_start : int
+        The first row to handle.
+    sparse_gather_density : float
+        See Ziptie.sparse_gather_density.
+    bundle_map_starts, bundle_map_stops, bundle_map_cols : arrays of ints
+        The bundle map. See Ziptie.bundle_map_starts.
+    n_bundles : int
+        The number of bundles that have been created so far.
+    bundle_activities : array of floats
+        The activity of each bundle. Modified in place.
+    bundle_usage : array of floats
+        See Ziptie.bundle_usage. Modified in place.
+    usage_update_rate : float
+    nucleation_energy, nucleation_mask,
+    agglomeration_energy, agglomeration_mask : arrays
+        See Ziptie. Modified in place.
+    *_row_max, *_row_argmax, *_tree : arrays
+        The state of the Ziptie's MaxTrackers. Modified in place.
+    nucleation_threshold, agglomeration_threshold : float
+
+    Returns
+    -------
+    i_step : int
+        The last row handled.
+    i_event : int
+        FIT_NUCLEATION if nucleation energy passed its threshold on
+        row i_step. Agglomeration energy hasn't been gathered yet
+        for that row. FIT_AGGLOMERATION if agglomeration energy
+        passed its threshold. FIT_DONE if every row was handled.
+    """
+    n_steps, n_cables = cable_matrix.shape
+    bundle_activities[n_bundles:] = 0.
+    for i_step in range(i_start, n_steps):
+        cable_activities = cable_matrix[i_step]
+
+        find_min_bundle_activities(
+            bundle_map_starts, bundle_map_stops, bundle_map_cols,
+            n_bundles, cable_activities, bundle_activities)
+        for i_bundle in range(n_bundles):
+            bundle_usage[i_bundle] += (
+                bundle_activities[i_bundle] - bundle_usage[i_bundle]
+            ) * usage_update_rate
+
+        active_cables = np.where(cable_activities > 0.)[0]
+        sparse = active_cables.size < sparse_gather_density * n_cables
+        if sparse:
+            nucleation_energy_gather_sparse(
+                active_cables, cable_activities, nucleation_energy,
+                nucleation_mask, nucleation_row_max, nucleation_row_argmax)
+        else:
+            nucleation_energy_gather(
+                cable_activities, nucleation_energy, nucleation_mask,
+                nucleation_row_max, nucleation_row_argmax)
+        update_max_tree(nucleation_row_max, nucleation_tree, active_cables)
+        if nucleation_row_max[nucleation_tree[1]] > nucleation_threshold:
+            return i_step, FIT_NUCLEATION
+
+        active_bundles = np.where(bundle_activities[:n_bundles] > 0.)[0]
+        if sparse:
+            agglomeration_energy_gather_sparse(
+                active_bundles, active_cables, bundle_activities,
+                cable_activities, agglomeration_energy, agglomeration_mask,
+                agglomeration_row_max, agglomeration_row_argmax)
+        else:
+            agglomeration_energy_gather(
+                bundle_activities, cable_activities, n_bundles,
+                agglomeration_energy, agglomeration_mask,
+                agglomeration_row_max, agglomeration_row_argmax)
+        update_max_tree(
+            agglomeration_row_max, agglomeration_tree, active_bundles)
+        if (agglomeration_row_max[agglomeration_tree[1]] >
+                agglomeration_threshold):
+            return i_step, FIT_AGGLOMERATION
+    return n_steps - 1, FIT_DONE
+
+
+@jit(nopython=True, nogil=True)
+def _raise_row_max(val, i_row, i_col, row_max, row_argmax):
+    """
+    Update a row's maximum after one of its elements has increased to val.
+
+    When val equals the row's maximum, the earlier column wins.
+    """
+    if (val > row_max[i_row] or
+            (val == row_max[i_row] and i_col < row_argmax[i_row])):
+        row_max[i_row] = val
+        row_argmax[i_row] = i_col
+
+
+@jit(nopython=True, nogil=True)
+def find_row_maxima(array2d, i_rows, row_max, row_argmax):
+    """
+    Scan a set of rows for their largest value and its column.
+
+    This is needed when elements of a row decrease, for instance
+    when they are reset to zero.
+
+    Parameters
+    ----------
+    array2d : 2D array of floats
+    i_rows : array of ints
+        The rows to scan.
+    row_max, row_argmax : arrays
+        The maximum of each row and its column, modified in place.
+    """
+    for i_row in i_rows:
+        max_val = array2d[i_row, 0]
+        i_col_max = 0
+        for i_col in range(1, array2d.shape[1]):
+            if array2d[i_row, i_col] > max_val:
+                max_val = array2d[i_row, i_col]
+                i_col_max = i_col
+        row_max[i_row] = max_val
+        row_argmax[i_row] = i_col_max
+
+
+@jit(nopython=True, nogil=True)
+def packed_index(i_row, i_col, n):
+    """
+    Find where an element of an upper triangle is kept in packed storage.
+
+    The elements above the diagonal of an n x n array,
+    i_row < i_col, are stored row after row in a 1D array
+    of n * (n - 1) / 2 elements. This is the same order that
+    np.triu_indices(n, 1) lists them in.
+    """
+    return i_row * n - (i_row * (i_row + 1)) // 2 + i_col - i_row - 1
+
+
+@jit(nopython=True, nogil=True)
+def find_packed_row_maxima(packed, n, i_rows, row_max, row_argmax):
+    """
+    Scan a set of rows of a packed upper triangle for their largest value.
+
+    This is the packed counterpart of find_row_maxima. Only the part of
+    each row above the diagonal is scanned. The last row has no
+    elements there. It is given a maximum of -1 and a column of -1,
+    so that it never wins against the non-negative energies.
+
+    Parameters
+    ----------
+    packed : array of floats
+        An n x n upper triangle in packed storage. See packed_index.
+    n : int
+    i_rows : array of ints
+        The rows to scan.
+    row_max, row_argmax : arrays
+        The maximum of each row and its column, modified in place.
+    """
+    for i_row in i_rows:
+        if i_row >= n - 1:
+            row_max[i_row] = -1.
+            row_argmax[i_row] = -1
+            continue
+        i_start = packed_index(i_row, i_row + 1, n)
+        max_val = packed[i_start]
+        i_col_max = i_row + 1
+        for i_col in range(i_row + 2, n):
+            val = packed[i_start + i_col - i_row - 1]
+            if val > max_val:
+                max_val = val
+                i_col_max = i_col
+        row_max[i_row] = max_val
+        row_argmax[i_row] = i_col_max
+
+
+@jit(nopython=True, nogil=True)
+def clear_packed(packed, n, i_clear):
+    """
+    Set a row and column of a packed upper triangle to zero.
+
+    In terms of the full symmetric array, this clears
+    row i_clear and column i_clear.
+    """
+    for i_row in range(i_clear):
+        packed[packed_index(i_row, i_clear, n)] = 0.
+    for i_col in range(i_clear + 1, n):
+        packed[packed_index(i_clear, i_col, n)] = 0.
+
+
+@jit(nopython=True, nogil=True)
+def _beats(row_max, i_row_a, i_row_b):
+    """
+    Check whether row a has a larger maximum than row b.
+
+    Ties go to the earlier row. A row index of -1 marks
+    an empty leaf and never wins.
+    """
+    if i_row_a < 0:
+        return False
+    if i_row_b < 0:
+        return True
+    if row_max[i_row_a] != row_max[i_row_b]:
+        return row_max[i_row_a] > row_max[i_row_b]
+    return i_row_a < i_row_b
+
+
+@jit(nopython=True, nogil=True)
+def build_max_tree(row_max, tree):
+    """
+    Build a tournament tree over the row maxima.
+
+    Parameters
+    ----------
+    row_max : array of floats
+        The largest value in each row.
+    tree : array of ints
+        The tree, stored as a binary heap. Its size is twice the number
+        of leaves, a power of two at least as large as the number
+        of rows. Node k has children 2k and 2k + 1. Each node holds
+        the row with the largest maximum below it, so the overall
+        winner is at node 1.
+    """
+    n_leaves = tree.size // 2
+    for i_leaf in range(n_leaves):
+        if i_leaf < row_max.size:
+            tree[n_leaves + i_leaf] = i_leaf
+        else:
+            tree[n_leaves + i_leaf] = -1
+    for node in range(n_leaves - 1, 0, -1):
+        _play_match(row_max, tree, node)
+
+
+@jit(nopython=True, nogil=True)
+def update_max_tree(row_max, tree, i_rows):
+    """
+    Replay the matches above a set of rows whose maxima have changed.
+
+    This takes log(n) matches per row.
+    """
+    n_leaves = tree.size // 2
+    for i_row in i_rows:
+        node = (n_leaves + i_row) // 2
+        while node > 0:
+            _play_match(row_max, tree, node)
+            node //= 2
+
+
+@jit(nopython=True, nogil=True)
+def _play_match(row_max, tree, node):
+    """
+    Let a node's two children compete, and pass the winner up.
+    """
+    left = tree[2 * node]
+    right = tree[2 * node + 1]
+    if _beats(row_max, right, left):
+        tree[node] = right
+    else:
+        tree[node] = left